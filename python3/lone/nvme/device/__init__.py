@@ -1,11 +1,13 @@
 import ctypes
 import time
 import enum
+from collections import deque
 
 from lone.system import System, DMADirection
 from lone.injection import Injection
 from lone.nvme.spec.queues import QueueMgr, NVMeSubmissionQueue, NVMeCompletionQueue
-from lone.nvme.spec.prp import PRP
+from lone.nvme.spec.prp import PRP, PRPPool
+from lone.nvme.spec.sgl import SGL
 from lone.nvme.spec.structures import CQE
 from lone.nvme.spec.commands.admin.create_io_completion_q import CreateIOCompletionQueue
 from lone.nvme.spec.commands.admin.create_io_submission_q import CreateIOSubmissionQueue
@@ -13,6 +15,7 @@ from lone.nvme.spec.commands.admin.delete_io_completion_q import DeleteIOComplet
 from lone.nvme.spec.commands.admin.delete_io_submission_q import DeleteIOSubmissionQueue
 from lone.nvme.spec.commands.status_codes import status_codes
 from lone.nvme.device.identify import NVMeDeviceIdentifyData
+from lone.nvme.device.latency import NVMeLatencyStats
 
 import logging
 logger = logging.getLogger('nvme_device')
@@ -26,28 +29,90 @@ class NVMeDeviceIntType(enum.Enum):
 
 
 class CidMgr:
-    ''' Manager class to track CID values for NVMe commands
-        TODO: Need to add tracking and checks to forbid allocating
-        a sqid/cid pair that is currently outstanding. Not an issue
-        unless the user is sending more than max_value - init_value
-        commands at a time.
+    ''' Manager class to track CID values for NVMe commands in one SQ. CIDs
+        come from a free list and only go back to it once the command that
+        used them completes, so a CID that is outstanding is never reused.
     '''
-    def __init__(self, init_value=0x1000, max_value=0xFFFE):
-        self.init_value = init_value
-        self.max_value = max_value
-        self.value = self.init_value
+    def __init__(self, num_cids):
+        self.num_cids = num_cids
+        self.free_cids = deque(range(num_cids))
+        self.in_use = bytearray(num_cids)
 
     def alloc(self):
-        # Get next value
-        value = self.value
+        assert len(self.free_cids) != 0, 'No free CIDs, {} outstanding'.format(self.num_cids)
+        cid = self.free_cids.popleft()
+        self.in_use[cid] = 1
+        return cid
 
-        # Increment and wrap if needed
-        self.value = self.value + 1
-        if self.value >= self.max_value:
-            self.value = self.init_value
+    def free(self, cid):
+        assert self.in_use[cid] == 1, 'Freeing CID {} that is not in use'.format(cid)
+        self.in_use[cid] = 0
+        self.free_cids.append(cid)
 
-        # Return it
-        return value
+    def num_free(self):
+        return len(self.free_cids)
+
+
+class OutstandingCommands:
+    ''' Tracks commands posted to the device that have not completed yet. Each SQ
+          gets its own CidMgr and a table of slots sized to its number of entries,
+          and commands are placed in the slot indexed by their CID.
+    '''
+    def __init__(self):
+        # Keys = sqid, values = list of slots
+        self.tables = {}
+
+        # Keys = sqid, values = CidMgr for the queue
+        self.cid_mgrs = {}
+
+    def add_queue(self, sqid, entries):
+        self.tables[sqid] = [None] * entries
+        self.cid_mgrs[sqid] = CidMgr(entries)
+
+    def remove_queue(self, sqid):
+        # Any command outstanding in the queue is gone with it
+        self.tables.pop(sqid)
+        self.cid_mgrs.pop(sqid)
+
+    def add(self, sqid, command):
+        ''' Allocates a CID for command in sqid and tracks it. Returns the CID
+        '''
+        cid = self.cid_mgrs[sqid].alloc()
+        self.tables[sqid][cid] = command
+        return cid
+
+    def get(self, sqid, cid):
+        ''' Returns the outstanding command for sqid/cid, or None
+        '''
+        table = self.tables.get(sqid)
+        if table is None or cid >= len(table):
+            return None
+        return table[cid]
+
+    def pop(self, sqid, cid):
+        ''' Removes and returns the outstanding command for sqid/cid, and frees
+              its CID
+        '''
+        table = self.tables[sqid]
+        command = table[cid]
+        assert command is not None, 'CID {} not outstanding on SQID {}'.format(cid, sqid)
+        table[cid] = None
+        self.cid_mgrs[sqid].free(cid)
+        return command
+
+    def __len__(self):
+        # Counted from each queue's CidMgr, so there is no state shared between
+        #  queues that threads owning different queues would race on
+        return sum(cid_mgr.num_cids - cid_mgr.num_free() for cid_mgr in self.cid_mgrs.values())
+
+    def __iter__(self):
+        ''' Iterates over every outstanding command, for example to look for
+              commands that timed out
+        '''
+        for table in self.tables.values():
+            for command in table:
+                if command is not None:
+                    yield command
 
 
 class NVMeDeviceCommon:
@@ -68,29 +133,50 @@ class NVMeDeviceCommon:
         self.sq_entry_size = sq_entry_size
         self.cq_entry_size = cq_entry_size
 
-        # CID manager
-        self.cid_mgr = CidMgr()
-
         # NVMe Queue manager
         self.queue_mgr = QueueMgr()
 
-        # List of outstanding commands
-        self.outstanding_commands = {}
+        # Table of outstanding commands, also manages CIDs for each queue
+        self.outstanding_commands = OutstandingCommands()
 
         # Injectors
         self.injectors = Injection()
 
+        # When True, data_in for completed commands is mapped straight over their
+        #  PRP's memory (if contiguous) instead of copied out of it. The data is then
+        #  only valid while the PRP memory is, use from_buffer_copy to keep a copy
+        self.data_in_zero_copy = False
+
+        # Optional PRPPool, when set alloc reuses PRPs from it instead of
+        #  allocating new memory for every command
+        self.prp_pool = None
+
+        # Optional NVMeLatencyStats, when set every completed command's latency is
+        #  recorded in it
+        self.latency_stats = None
+
+        # When True, alloc creates contiguous PRPs, with all data in one buffer
+        self.contiguous_prps = False
+
+        # When True, alloc describes NVM command data with a SGL (PSDT = 1) instead
+        #  of PRPs, if SGLS in identify controller says the controller supports them.
+        #  Admin commands always use PRPs
+        self.use_sgls = False
+
         # Interrupt type for this drive, None is polling
         self.int_type = NVMeDeviceIntType.POLLING
         self.get_completions = self.poll_cq_completions
 
+        # MSI-X vectors that fired but were not processed yet
+        self.msix_pending_vectors = set()
+
         # Identify data for the device, no init until the user
         #   requests it
         self.id_data = NVMeDeviceIdentifyData(self, initialize=False)
 
     def initiate_flr(self):
-        pcie_cap = [cap for cap in self.pcie_regs.capabilities if
-                    cap._cap_id_ is self.pcie_regs.PCICapExpress._cap_id_][0]
+        pcie_cap = self.pcie_regs.get_capability(self.pcie_regs.PCICapExpress._cap_id_)
+        assert pcie_cap is not None, 'Device does not have a PCI Express capability!'
         pcie_cap.PXDC.IFLR = 1
 
     def cc_disable(self, timeout_s=10):
@@ -124,7 +210,7 @@ class NVMeDeviceCommon:
         self.queue_mgr = QueueMgr()
 
         # Any command that was outstanding is gone now. All their memory is now free as well.
-        self.outstanding_commands = {}
+        self.outstanding_commands = OutstandingCommands()
 
     def cc_enable(self, timeout_s=10):
         start_time = time.time()
@@ -174,6 +260,7 @@ class NVMeDeviceCommon:
         self.pcie_regs.CMD.BME = 1
 
         # Add the Admin queue pair
+        self.outstanding_commands.add_queue(0, asq_entries)
         self.queue_mgr.add(NVMeSubmissionQueue(
                            asq_mem,
                            asq_entries,
@@ -234,6 +321,7 @@ class NVMeDeviceCommon:
         self.sync_cmd(create_iosq_cmd, timeout_s=1)
 
         # Add the NVM queue pair to the queue manager
+        self.outstanding_commands.add_queue(sq_id, sq_entries)
         self.queue_mgr.add(NVMeSubmissionQueue(
                            sq_mem,
                            sq_entries,
@@ -276,6 +364,7 @@ class NVMeDeviceCommon:
             del_sq_cmd = DeleteIOSubmissionQueue(QID=sqid)
             self.sync_cmd(del_sq_cmd, timeout_s=1)
             self.queue_mgr.remove_sq(sqid)
+            self.outstanding_commands.remove_queue(sqid)
 
         # Then delete all completion queues
         for (sqid, cqid), (sq, cq) in list(self.queue_mgr.nvme_queues.items()):
@@ -297,18 +386,48 @@ class NVMeDeviceCommon:
 
     def post_command(self, command):
 
-        # Set a CID for the command
-        command.CID = self.cid_mgr.alloc()
+        # Set a CID for the command and keep track of it as outstanding
+        command.CID = self.outstanding_commands.add(command.sq.qid, command)
 
         # Post the command on the next available sq slot
-        command.sq.post_command(command)
+        try:
+            command.sq.post_command(command)
+        except Exception:
+            self.outstanding_commands.pop(command.sq.qid, command.CID)
+            raise
         self.posted_command()
 
-        # Keep track of outstanding commands
-        self.outstanding_commands[(command.CID, command.sq.qid)] = command
-
         command.start_time_ns = time.perf_counter_ns()
 
+    def post_commands(self, commands):
+        ''' Posts a list of commands that share the same sq with a single tail
+              doorbell write
+        '''
+        if len(commands) == 0:
+            return
+
+        sqid = commands[0].sq.qid
+
+        # Set a CID for each command and keep track of them as outstanding, then post
+        #  all commands on the sq. Only the CIDs we got are released if either fails
+        num_added = 0
+        try:
+            for command in commands:
+                command.CID = self.outstanding_commands.add(sqid, command)
+                num_added += 1
+            commands[0].sq.post_commands(commands)
+        except Exception:
+            for command in commands[:num_added]:
+                self.outstanding_commands.pop(sqid, command.CID)
+            raise
+
+        # Let the device know once
+        self.posted_command()
+
+        start_time_ns = time.perf_counter_ns()
+        for command in commands:
+            command.start_time_ns = start_time_ns
+
     def poll_cq_completions(self, cqids=None, max_completions=1, max_time_s=0):
 
         if cqids is None:
@@ -353,12 +472,46 @@ class NVMeDeviceCommon:
         # Wait for the completion by polling for the phase bit change
         if cqe.SF.P == cq.phase:
 
-            command = self.outstanding_commands[(cqe.CID, cqe.SQID)]
+            command = self.outstanding_commands.get(cqe.SQID, cqe.CID)
             self.complete_command(command, cqe)
             return True
         else:
             return False
 
+    def reap_completions(self, cqid, max_completions=None):
+        ''' Completes every new entry in the cqid completion queue (up to max_completions)
+              in one pass, writing the CQ head doorbell once for all of them before
+              any of them is completed. Returns the number of entries reaped.
+        '''
+        if cqid == 0:
+            _, cq = self.queue_mgr.get(0, 0)
+        else:
+            _, cq = self.queue_mgr.get(None, cqid)
+
+        # Copy the entries out, the device can reuse their slots once they are consumed
+        cqes = [CQE.from_buffer_copy(cqe) for cqe in cq.get_completions(max_completions)]
+        if len(cqes) == 0:
+            return 0
+
+        # Let the device know about all of them at once, before any callback runs, so
+        #  a callback looking for completions in this queue (sync_cmd) does not see them
+        cq.consume_completions(len(cqes))
+
+        # Every entry is completed even if completing an earlier one raises, nobody would
+        #  complete them later. The first exception is raised once they all are
+        exception = None
+        for cqe in cqes:
+            try:
+                command = self.outstanding_commands.get(cqe.SQID, cqe.CID)
+                self.complete_command(command, cqe, consume=False)
+            except Exception as e:
+                if exception is None:
+                    exception = e
+        if exception is not None:
+            raise exception
+
+        return len(cqes)
+
     def get_msix_completions(self, cqids=None, max_completions=1, max_time_s=0):
         cqs = []
 
@@ -378,17 +531,19 @@ class NVMeDeviceCommon:
         max_time = time.time() + max_time_s
         num_completions = 0
 
-        # Process completion by first waiting on the MSI-X interrupt for the
-        #   completion queue we are waiting for a completion at
+        # Process completions by blocking until any MSI-X vector fires, then reaping
+        #   the completion queues we are waiting on that use the vectors that fired.
+        #   Vectors for other queues are kept pending for the next caller
+        vectors = set(cq.int_vector for cq in cqs)
         while True:
-            # Yield in case other threads are running
-            time.sleep(0)
+            if self.msix_pending_vectors.isdisjoint(vectors):
+                timeout_s = max(0, max_time - time.time())
+                self.msix_pending_vectors.update(self.wait_msix_vectors(timeout_s))
 
             for cq in cqs:
-                vector = cq.int_vector
-                if self.get_msix_vector_pending_count(vector):
-                    while self.get_completion(cq.qid):
-                        num_completions += 1
+                if cq.int_vector in self.msix_pending_vectors:
+                    num_completions += self.reap_completions(cq.qid)
+            self.msix_pending_vectors.difference_update(vectors)
 
             if num_completions >= max_completions:
                 break
@@ -402,7 +557,7 @@ class NVMeDeviceCommon:
 
         return num_completions
 
-    def complete_command(self, command, cqe):
+    def complete_command(self, command, cqe, consume=True):
 
         # Mark the time the command was completed as soon as we find it!
         command.end_time_ns = time.perf_counter_ns()
@@ -418,20 +573,34 @@ class NVMeDeviceCommon:
                        ctypes.addressof(cqe),
                        ctypes.sizeof(CQE))
 
-        # Remove from our outstanding_commands list
-        del self.outstanding_commands[(command.CID, command.sq.qid)]
+        # Remove from our outstanding commands table
+        self.outstanding_commands.pop(command.sq.qid, command.CID)
+
+        if self.latency_stats is not None:
+            self.latency_stats.record(command)
 
-        # If there was data in, then grab it from PRPs and copy to
-        #   the data in object
+        # If there was data in, then grab it from PRPs, either mapping the data in
+        #   object over them or copying to it
         if command.data_in is not None:
-            command.data_in = command.data_in_type.from_buffer_copy(command.prp.get_data_buffer())
+            data_view = command.prp.get_data_view() if self.data_in_zero_copy else None
+            if data_view is not None:
+                command.data_in = command.data_in_type.from_buffer(data_view)
+            else:
+                command.data_in = command.data_in_type.from_buffer_copy(
+                    command.prp.get_data_buffer())
 
-        # Consume the completion we just processed in the queue
-        command.cq.consume_completion()
+        # Consume the completion we just processed in the queue, unless the caller
+        #  is going to consume a batch of them at once
+        if consume:
+            command.cq.consume_completion()
 
         # Advance the SQ head for the command based on what is on the completion
         command.sq.head.set(cqe.SQHD)
 
+        # Let whoever is waiting on this command know it is done
+        if command.callback is not None:
+            command.callback(command)
+
     def process_completions(self, cqids=None, max_completions=1, max_time_s=0):
         return self.get_completions(cqids, max_completions, max_time_s)
 
@@ -465,7 +634,7 @@ class NVMeDeviceCommon:
         command.sq, command.cq = sq, cq
 
         # Sanity checks
-        assert (command.CID, command.sq.qid) not in self.outstanding_commands.keys(), (
+        assert self.outstanding_commands.get(sq.qid, command.CID) is not command, (
             'Command already with the drive, impossible to identify completion')
         assert command.posted is not True, 'Command already posted'
         assert command.complete is not True, 'Command already completed'
@@ -477,6 +646,60 @@ class NVMeDeviceCommon:
         # Return the qpair in which the command was posted
         return sqid, cq.qid
 
+    def start_cmds(self, commands, sqid=None, cqid=None):
+        ''' Starts all commands in the same queue pair, ringing the sq doorbell
+              only once. The queue pair is picked the same way start_cmd does
+              for the first command in the list
+        '''
+        if len(commands) == 0:
+            return sqid, cqid
+
+        if sqid is None:
+            if commands[0].cmdset_admin:
+                sqid = 0
+                cqid = 0
+            else:
+                sqid = self.queue_mgr.next_iosq_id()
+
+        # Get command queues
+        sq, cq = self.queue_mgr.get(sqid, cqid)
+        assert sq is not None and cq is not None, "No queue to send commands to!"
+
+        # Sanity checks
+        for command in commands:
+            assert self.outstanding_commands.get(sq.qid, command.CID) is not command, (
+                'Command already with the drive, impossible to identify completion')
+            assert command.posted is not True, 'Command already posted'
+            assert command.complete is not True, 'Command already completed'
+            command.sq, command.cq = sq, cq
+
+        # Post the commands on the next available sq slots
+        self.post_commands(commands)
+        for command in commands:
+            command.posted = True
+
+        # Return the qpair in which the commands were posted
+        return sqid, cq.qid
+
+    def enable_prp_pool(self, max_prps=256, max_bytes=64 * 1024 * 1024):
+        ''' Makes alloc reuse PRPs freed with free_prps, see PRPPool
+        '''
+        self.prp_pool = PRPPool(self.mem_mgr, self.mem_mgr.page_size, max_prps, max_bytes)
+
+    def enable_latency_stats(self, sub_bucket_bits=7):
+        ''' Starts recording the latency of every command that completes, see
+              NVMeLatencyStats. Returns the statistics object
+        '''
+        self.latency_stats = NVMeLatencyStats(sub_bucket_bits)
+        return self.latency_stats
+
+    def sgls_supported(self):
+        ''' True if identify controller data (once initialized) says the controller
+              supports SGLs for NVM commands
+        '''
+        controller = getattr(self.id_data, 'controller', None)
+        return controller is not None and (controller.SGLS & 0x3) != 0
+
     def alloc(self, command, bytes_per_block=None):
         set_buffer = False
         size = None
@@ -506,16 +729,25 @@ class NVMeDeviceCommon:
 
         assert size is not None, 'Could not figure out size for command'
 
-        # Allocate memory, set PRPs
-        prp = PRP(self.mem_mgr, size,
-                  self.mem_mgr.page_size,
-                  direction,
-                  ' '.join([hex(id(command)), command.__class__.__name__]))
+        # Allocate memory, set SGL or PRPs
+        client = ' '.join([hex(id(command)), command.__class__.__name__])
+        if self.use_sgls and not command.cmdset_admin and self.sgls_supported():
+            prp = SGL(self.mem_mgr, size, self.mem_mgr.page_size, direction, client)
+            command.PSDT = 1
+            command.DPTR.SGL.SGL1 = prp.sgl1
 
-        # Set PRP
+        else:
+            if self.prp_pool is not None:
+                prp = self.prp_pool.get(size, direction, client, self.contiguous_prps)
+            else:
+                prp = PRP(self.mem_mgr, size, self.mem_mgr.page_size, direction, client,
+                          contiguous=self.contiguous_prps)
+            command.PSDT = 0
+            command.DPTR.PRP.PRP1 = prp.prp1
+            command.DPTR.PRP.PRP2 = prp.prp2
+
+        # Set PRP (or SGL, both handle the data the same way)
         command.prp = prp
-        command.DPTR.PRP.PRP1 = prp.prp1
-        command.DPTR.PRP.PRP2 = prp.prp2
 
         if set_buffer:
             # Copy data out to it
@@ -541,8 +773,10 @@ class NVMeDevicePhysicalNotFoundError(Exception):
 class NVMeDevicePhysical(NVMeDeviceCommon):
     ''' Implementation that accesses a physical nvme device on the
           pcie bus via vfio
+        If premap is True, hugepage memory is mapped read/write into the IOMMU
+          once as it is allocated, instead of on every malloc/free
     '''
-    def __init__(self, pci_slot):
+    def __init__(self, pci_slot, premap=False):
         # Create a pci_userspace_device, then get pcie and nvme regs
         device_found = False
         try:
@@ -566,7 +800,8 @@ class NVMeDevicePhysical(NVMeDeviceCommon):
                                    self.pci_userspace_device.map_dma_region_read,
                                    self.pci_userspace_device.map_dma_region_write,
                                    self.pci_userspace_device.unmap_dma_region,
-                                   self.pci_userspace_device.iova_ranges)
+                                   self.pci_userspace_device.iova_ranges,
+                                   self.pci_userspace_device.map_dma_region_rw if premap else None)
 
         # Initialize NVMeDeviceCommon
         super().__init__(pci_slot,
@@ -582,3 +817,6 @@ class NVMeDevicePhysical(NVMeDeviceCommon):
 
     def get_msix_vector_pending_count(self, vector):
         return self.pci_userspace_device.get_msix_vector_pending_count(vector)
+
+    def wait_msix_vectors(self, timeout_s=None):
+        return self.pci_userspace_device.wait_msix_vectors(timeout_s)
@@ -0,0 +1,142 @@
+import os
+import asyncio
+
+from lone.nvme.device import NVMeDeviceIntType
+from lone.nvme.spec.commands.status_codes import status_codes
+
+import logging
+logger = logging.getLogger('nvme_device')
+
+
+class NVMeDeviceAsync:
+    ''' asyncio front end for a nvme_device. Commands are sent with
+          await submit(command), which returns once the command completes.
+        If the device uses MSI-X interrupts, their eventfds are added as readers to
+          the event loop, and the completion queues for a vector are reaped when
+          it fires. Otherwise a polling task reaps all completion queues while
+          there are commands outstanding, sleeping poll_interval_s between polls.
+        CSTS.CFS is checked when a poll or vector finds nothing, and when a command
+          times out, failing every outstanding command. A device that stops sending
+          interrupts is only noticed by the first timeout.
+        Create it after interrupts are setup, from a coroutine running in the loop
+          it will be used with.
+    '''
+    def __init__(self, nvme_device, poll_interval_s=0):
+        self.nvme_device = nvme_device
+        self.poll_interval_s = poll_interval_s
+        self.loop = asyncio.get_running_loop()
+
+        # Futures for outstanding commands, keyed by id(command)
+        self.futures = {}
+        self.poll_task = None
+
+        # Readers for the MSI-X eventfds, if we have them
+        self.eventfds = []
+        if nvme_device.int_type == NVMeDeviceIntType.MSIX:
+            eventfd_vectors = nvme_device.pci_userspace_device.eventfd_vectors
+            for eventfd, vector in eventfd_vectors.items():
+                self.loop.add_reader(eventfd, self.msix_ready, eventfd, vector)
+                self.eventfds.append(eventfd)
+
+    @property
+    def outstanding(self):
+        return len(self.futures)
+
+    async def submit(self, command, sqid=None, cqid=None, timeout_s=10, check=True):
+        ''' Sends command and waits for it to complete. Returns the command.
+            check works the same as in sync_cmd
+        '''
+        future = self.loop.create_future()
+        self.futures[id(command)] = future
+        command.callback = self.command_completed
+        try:
+            self.nvme_device.start_cmd(command, sqid, cqid)
+        except Exception:
+            del self.futures[id(command)]
+            command.callback = None
+            raise
+
+        # Make sure somebody is looking for the completion
+        if len(self.eventfds) == 0 and self.poll_task is None:
+            self.poll_task = self.loop.create_task(self.poll())
+
+        try:
+            await asyncio.wait_for(future, timeout_s)
+        except asyncio.TimeoutError:
+            # Stop waiting for it. It is still outstanding in the device, and is completed
+            #  without a callback if it ever shows up
+            self.futures.pop(id(command), None)
+            command.callback = None
+            logger.warning('Command CID {} on SQID {} timed out after {}s, still outstanding'
+                           .format(command.CID, command.sq.qid, timeout_s))
+
+            # With MSI-X nothing else notices a fatal controller status
+            self.check_cfs()
+            raise
+
+        if check:
+            status_codes.check(command)
+        return command
+
+    def command_completed(self, command):
+        # Called by the device as part of completing the command
+        command.callback = None
+        future = self.futures.pop(id(command), None)
+
+        # Nobody is waiting for it anymore if it timed out or failed already
+        if future is not None and not future.done():
+            future.set_result(command)
+
+    def fail_outstanding(self, exception):
+        for future in self.futures.values():
+            if not future.done():
+                future.set_exception(exception)
+        self.futures = {}
+
+    def check_cfs(self):
+        ''' Fails all outstanding commands if the controller reports a fatal status,
+              they are not going to complete. Returns True if it did.
+        '''
+        if self.nvme_device.nvme_regs.CSTS.CFS == 1:
+            logger.error('CFS = 1 while looking for completions!')
+            self.fail_outstanding(AssertionError('CFS = 1 while looking for completions!'))
+            return True
+        return False
+
+    def reap(self, cqs):
+        num_completions = 0
+        for cq in cqs:
+            num_completions += self.nvme_device.reap_completions(cq.qid)
+        return num_completions
+
+    def msix_ready(self, eventfd, vector):
+        # Called by the event loop when the eventfd for vector is readable
+        try:
+            os.read(eventfd, 8)
+        except BlockingIOError:
+            return
+
+        cqs = [cq for cq in self.nvme_device.queue_mgr.get_cqs() if cq.int_vector == vector]
+        if self.reap(cqs) == 0:
+            self.check_cfs()
+
+    async def poll(self):
+        ''' Reaps all completion queues until there are no commands outstanding
+        '''
+        try:
+            while len(self.futures):
+                if self.reap(self.nvme_device.queue_mgr.get_cqs()) == 0 and self.check_cfs():
+                    break
+                await asyncio.sleep(self.poll_interval_s)
+        finally:
+            self.poll_task = None
+
+    def close(self):
+        ''' Stops looking for completions
+        '''
+        for eventfd in self.eventfds:
+            self.loop.remove_reader(eventfd)
+        self.eventfds = []
+
+        if self.poll_task is not None:
+            self.poll_task.cancel()
@@ -0,0 +1,165 @@
+import time
+
+import logging
+logger = logging.getLogger('nvme_device')
+
+
+class NVMeDeviceIOEngine:
+    ''' Keeps up to queue_depth commands outstanding on each IO queue pair of a
+          nvme_device. Completions are reaped in bulk from every completion queue
+          the engine uses, and a per-command callback is called as each command
+          completes.
+    '''
+    def __init__(self, nvme_device, queue_depth=32, sqids=None):
+        self.nvme_device = nvme_device
+        self.queue_depth = queue_depth
+
+        # Default to every IO queue the device has created
+        if sqids is None:
+            sqids = nvme_device.queue_mgr.io_sqids
+        self.sqids = list(sqids)
+        assert len(self.sqids) > 0, 'No IO queues to send commands to!'
+
+        # Per queue pair information. A full queue can only hold entries - 1
+        #  commands, so limit the depth to that
+        self.sq_cqid = {}
+        self.sq_depth = {}
+        self.sq_outstanding = {}
+        for sqid in self.sqids:
+            sq, cq = nvme_device.queue_mgr.get(sqid, None)
+            assert sq is not None and cq is not None, 'SQID {} not found'.format(sqid)
+            self.sq_cqid[sqid] = cq.qid
+            self.sq_depth[sqid] = min(queue_depth, sq.entries - 1)
+            self.sq_outstanding[sqid] = 0
+
+        # Completion queues to reap from, each only once even if shared by sqs
+        self.cqids = list(dict.fromkeys(self.sq_cqid.values()))
+
+        # User callbacks for the commands submitted through the engine, keyed by id(command)
+        self.callbacks = {}
+        self.sqid_index = 0
+
+        # Statistics
+        self.num_submitted = 0
+        self.num_completed = 0
+
+    @property
+    def outstanding(self):
+        return len(self.callbacks)
+
+    def next_free_sqid(self):
+        ''' Returns the next sqid (round robin) with room for one more command, or
+              None if all queues are at queue_depth
+        '''
+        for i in range(len(self.sqids)):
+            sqid = self.sqids[self.sqid_index]
+
+            self.sqid_index += 1
+            if self.sqid_index == len(self.sqids):
+                self.sqid_index = 0
+
+            if self.sq_outstanding[sqid] < self.sq_depth[sqid]:
+                return sqid
+        return None
+
+    def wait_free_sqid(self, timeout_s=10):
+        ''' Returns the next sqid with room for one more command, reaping
+              completions until one has room if all queues are at queue_depth
+        '''
+        sqid = self.next_free_sqid()
+        if sqid is None:
+            max_time = time.time() + timeout_s
+            while sqid is None:
+                if self.reap() == 0:
+                    if time.time() > max_time:
+                        assert False, 'No free queue slot after {}s'.format(timeout_s)
+                    if self.nvme_device.nvme_regs.CSTS.CFS == 1:
+                        assert False, 'CFS = 1 while waiting for a free queue slot!'
+
+                    # Yield in case other threads are running
+                    time.sleep(0)
+                sqid = self.next_free_sqid()
+        return sqid
+
+    def submit(self, command, callback=None, timeout_s=10):
+        ''' Sends command on the next queue pair with room for it. If all queues are
+              at queue_depth, completions are reaped until one has room.
+            callback, if not None, is called with command as its argument once it
+              completes.
+        '''
+        sqid = self.wait_free_sqid(timeout_s)
+
+        # Track the command before starting it, the completion could come in at any time
+        self.callbacks[id(command)] = callback
+        command.callback = self.command_completed
+        try:
+            self.nvme_device.start_cmd(command, sqid, self.sq_cqid[sqid])
+        except Exception:
+            del self.callbacks[id(command)]
+            command.callback = None
+            raise
+
+        self.sq_outstanding[sqid] += 1
+        self.num_submitted += 1
+
+    def submit_batch(self, commands, callback=None, timeout_s=10):
+        ''' Sends a list of commands, filling as many free slots as possible on each
+              queue pair so the sq doorbell is written once per queue pair per batch
+              instead of once per command.
+            callback, if not None, is called with each command as it completes.
+        '''
+        index = 0
+        while index < len(commands):
+            sqid = self.wait_free_sqid(timeout_s)
+            num_free = self.sq_depth[sqid] - self.sq_outstanding[sqid]
+            batch = commands[index:index + num_free]
+
+            # Track the commands before starting them
+            for command in batch:
+                self.callbacks[id(command)] = callback
+                command.callback = self.command_completed
+            try:
+                self.nvme_device.start_cmds(batch, sqid, self.sq_cqid[sqid])
+            except Exception:
+                for command in batch:
+                    del self.callbacks[id(command)]
+                    command.callback = None
+                raise
+
+            self.sq_outstanding[sqid] += len(batch)
+            self.num_submitted += len(batch)
+            index += len(batch)
+
+    def command_completed(self, command):
+        # Called by the device as part of completing the command
+        command.callback = None
+        self.sq_outstanding[command.sq.qid] -= 1
+        self.num_completed += 1
+
+        callback = self.callbacks.pop(id(command))
+        if callback is not None:
+            callback(command)
+
+    def reap(self):
+        ''' Processes every completion available in the engine's completion queues
+              without waiting. Returns the number of completions processed.
+        '''
+        num_completions = 0
+        for cqid in self.cqids:
+            num_completions += self.nvme_device.reap_completions(cqid)
+        return num_completions
+
+    def drain(self, timeout_s=10):
+        ''' Waits for every command submitted through the engine to complete
+        '''
+        max_time = time.time() + timeout_s
+        while self.outstanding:
+            if self.reap() == 0:
+                if time.time() > max_time:
+                    assert False, '{} commands did not complete in {}s'.format(
+                        self.outstanding, timeout_s)
+                if self.nvme_device.nvme_regs.CSTS.CFS == 1:
+                    assert False, 'CFS = 1 while draining commands!'
+
+                # Yield in case other threads are running
+                time.sleep(0)
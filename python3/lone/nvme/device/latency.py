@@ -0,0 +1,82 @@
+import threading
+
+from lone.util.histogram import LatencyHistogram
+
+
+class NVMeLatencyStats:
+    ''' Command latency (end_time_ns - start_time_ns) histograms, one for each
+          (sqid, opcode) commands complete with. Enabled on a device with
+          enable_latency_stats, which makes complete_command record every command.
+        Each queue only records into its own histograms, so threads owning different
+          queues do not share any. Adding a histogram, and anything that goes through
+          all of them, takes a lock so they can be done from any thread. Snapshots
+          from other processes are combined with merge.
+    '''
+    def __init__(self, sub_bucket_bits=7):
+        self.sub_bucket_bits = sub_bucket_bits
+        self.lock = threading.Lock()
+
+        # Keys = (sqid, opcode), values = LatencyHistogram
+        self.histograms = {}
+
+    def __getstate__(self):
+        # Snapshots are sent to other processes, without the lock
+        state = self.__dict__.copy()
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def record(self, command):
+        key = (command.sq.qid, command.OPC)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            with self.lock:
+                histogram = self.histograms.setdefault(
+                    key, LatencyHistogram(self.sub_bucket_bits))
+        histogram.record(command.end_time_ns - command.start_time_ns)
+
+    def items(self):
+        # Copy of the histograms, to go through while other threads add to them
+        with self.lock:
+            return list(self.histograms.items())
+
+    def reset(self):
+        with self.lock:
+            self.histograms = {}
+
+    def snapshot(self):
+        ''' Returns a copy of the statistics, which keeps counting on its own
+        '''
+        stats = NVMeLatencyStats(self.sub_bucket_bits)
+        stats.merge(self)
+        return stats
+
+    def merge(self, other):
+        ''' Adds the latencies recorded in other to these statistics
+        '''
+        for key, histogram in other.items():
+            with self.lock:
+                own = self.histograms.setdefault(key, LatencyHistogram(self.sub_bucket_bits))
+            own.merge(histogram)
+
+    def histogram(self, sqid=None, opcode=None):
+        ''' Returns a histogram with every latency for sqid and opcode, None for either
+              means all of them
+        '''
+        histogram = LatencyHistogram(self.sub_bucket_bits)
+        for (key_sqid, key_opcode), key_histogram in self.items():
+            if sqid is not None and key_sqid != sqid:
+                continue
+            if opcode is not None and key_opcode != opcode:
+                continue
+            histogram.merge(key_histogram)
+        return histogram
+
+    def report(self):
+        ''' Returns a dictionary with keys = (sqid, opcode) and values = summary of the
+              latencies for them, see LatencyHistogram.summary
+        '''
+        return {key: histogram.summary() for key, histogram in sorted(self.items())}
@@ -0,0 +1,198 @@
+import time
+import traceback
+import multiprocessing
+import multiprocessing.connection
+
+from lone.system import DevMemMgr, MemoryLocation, DMADirection
+from lone.util.address_mgr import AddressRangeMgr
+
+import logging
+logger = logging.getLogger('nvme_device')
+
+
+class NVMeWorkerMemMgr(DevMemMgr):
+    ''' Memory manager for a worker process. Memory is allocated out of a region
+          (mem) the controller process allocated for the worker before starting it,
+          so it is shared with the controller and already has an iova.
+    '''
+    def __init__(self, mem, page_size):
+        self.page_size = page_size
+        self.mem = mem
+
+        # Allocates vaddrs in the region, the iova is at the same offset in the region
+        self.vaddr_mgr = AddressRangeMgr([(mem.vaddr, mem.vaddr + mem.size - 1)], page_size)
+        self.malloc_mem = []
+
+    def malloc(self, size, direction, client='NVMeWorkerMemMgr'):
+        vaddr = self.vaddr_mgr.get(size)
+
+        ret_mem = MemoryLocation(vaddr, self.mem.iova + (vaddr - self.mem.vaddr), size, client)
+        ret_mem.in_use = True
+        ret_mem.iova_mapped = self.mem.iova_mapped
+        ret_mem.iova_direction = direction
+        self.malloc_mem.append(ret_mem)
+        return ret_mem
+
+    def free(self, memory):
+        assert memory.in_use is True
+        memory.in_use = False
+        self.vaddr_mgr.free(memory.vaddr)
+        self.malloc_mem.remove(memory)
+
+    def free_all(self):
+        self.vaddr_mgr.reset()
+        self.malloc_mem = []
+        self.free_all_count += 1
+
+    def allocated_mem_list(self):
+        return self.malloc_mem
+
+
+class NVMeProcessWorker:
+    ''' What a worker process gets. nvme_device is the worker's copy of the controller's
+          device, with only the worker's IO queue pair (sqid/cqid) in it and mem_mgr
+          allocating from the worker's memory region.
+    '''
+    def __init__(self, index, nvme_device, sqid, cqid, mem):
+        self.index = index
+        self.nvme_device = nvme_device
+        self.sqid = sqid
+        self.cqid = cqid
+        self.mem = mem
+
+    def setup(self):
+        ''' Called in the worker process, before the worker's target
+        '''
+        nvme_device = self.nvme_device
+
+        # Only keep our queue pair, the rest (admin queues included) belong to
+        #  the controller or other workers
+        for sqid, cqid in list(nvme_device.queue_mgr.nvme_queues.keys()):
+            if sqid != self.sqid:
+                nvme_device.queue_mgr.remove_sq(sqid)
+                nvme_device.outstanding_commands.remove_queue(sqid)
+                nvme_device.queue_mgr.remove_cq(cqid)
+
+        # Memory comes from our region, including PRPs from a pool if the
+        #  controller had one enabled
+        nvme_device.mem_mgr = NVMeWorkerMemMgr(self.mem, nvme_device.mem_mgr.page_size)
+        if nvme_device.prp_pool is not None:
+            nvme_device.enable_prp_pool(nvme_device.prp_pool.max_prps,
+                                        nvme_device.prp_pool.max_bytes)
+
+
+class NVMeDeviceProcesses:
+    ''' Runs target(worker) in one process for each IO queue pair (sqids, all IO queues
+          by default) of nvme_device, worker being a NVMeProcessWorker. The calling
+          (controller) process owns the device and must have created its IO queues.
+        Processes are forked, so each one gets a copy of the device and accesses the
+          same registers and queue memory. Each worker also gets a mem_bytes region of
+          memory the controller allocates for it, where it builds its commands' data.
+        target returns a value, which must be picklable, for the controller. The
+          device is only used through the worker's queue pair in each worker process.
+        Only devices whose memory manager shares memory with forked processes (nvsim)
+          are supported. Hugepages memory for physical devices is a private mapping,
+          so the device would never see what workers write to it.
+    '''
+    def __init__(self, nvme_device, target, sqids=None, mem_bytes=16 * 1024 * 1024,
+                 poll_interval_s=0):
+        assert nvme_device.mem_mgr.fork_shared, (
+            'Device memory is not shared with forked processes, worker processes '
+            'are not supported on {}'.format(type(nvme_device).__name__))
+
+        self.nvme_device = nvme_device
+        self.target = target
+        self.poll_interval_s = poll_interval_s
+
+        # Default to every IO queue the device has created
+        if sqids is None:
+            sqids = nvme_device.queue_mgr.io_sqids
+        assert len(sqids) > 0, 'No IO queues to give to workers!'
+
+        self.workers = []
+        for index, sqid in enumerate(sqids):
+            sq, cq = nvme_device.queue_mgr.get(sqid, None)
+            assert sq is not None and cq is not None, 'SQID {} not found'.format(sqid)
+
+            mem = nvme_device.mem_mgr.malloc(mem_bytes, DMADirection.BIDIRECTIONAL,
+                                             client='worker_{}'.format(index))
+            self.workers.append(NVMeProcessWorker(index, nvme_device, sqid, cq.qid, mem))
+
+        self.context = multiprocessing.get_context('fork')
+        self.processes = []
+        self.conns = []
+
+    def run_worker(self, worker, conn):
+        ''' Runs in the worker process. Sends back (result, None) or (None, traceback)
+              if target raised
+        '''
+        try:
+            worker.setup()
+            conn.send((self.target(worker), None))
+        except Exception:
+            conn.send((None, traceback.format_exc()))
+        conn.close()
+
+    def start(self):
+        for worker in self.workers:
+            recv_conn, send_conn = self.context.Pipe(duplex=False)
+            process = self.context.Process(target=self.run_worker, args=(worker, send_conn),
+                                           daemon=True)
+            process.start()
+            send_conn.close()
+
+            self.processes.append(process)
+            self.conns.append(recv_conn)
+
+    def join(self, timeout_s=60):
+        ''' Waits for all workers to finish, returning the value each target returned,
+              in worker order. Devices that need to know about posted commands
+              (simulators) are told about them from here while waiting, since the
+              workers cannot reach them.
+        '''
+        results = [None] * len(self.workers)
+        pending = dict(zip(self.conns, range(len(self.workers))))
+
+        max_time = time.time() + timeout_s
+        try:
+            while len(pending):
+                self.nvme_device.posted_command()
+
+                for conn in multiprocessing.connection.wait(list(pending),
+                                                            self.poll_interval_s):
+                    index = pending.pop(conn)
+                    try:
+                        results[index] = conn.recv()
+                    except EOFError:
+                        results[index] = (None, 'Worker exited with code {}'.format(
+                            self.processes[index].exitcode))
+
+                if len(pending) and time.time() > max_time:
+                    assert False, '{} workers did not finish in {}s'.format(
+                        len(pending), timeout_s)
+        finally:
+            self.stop()
+
+        for worker, (result, error) in zip(self.workers, results):
+            assert error is None, 'Worker {} failed:\n{}'.format(worker.index, error)
+        return [result for result, error in results]
+
+    def stop(self):
+        ''' Stops any worker still running
+        '''
+        for process in self.processes:
+            if process.is_alive():
+                process.terminate()
+            process.join()
+
+        for conn in self.conns:
+            conn.close()
+        self.processes = []
+        self.conns = []
+
+    def free(self):
+        ''' Frees the memory regions allocated for the workers
+        '''
+        for worker in self.workers:
+            self.nvme_device.mem_mgr.free(worker.mem)
+        self.workers = []
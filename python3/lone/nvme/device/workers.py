@@ -0,0 +1,165 @@
+import time
+import itertools
+import threading
+from collections import deque
+
+import logging
+logger = logging.getLogger('nvme_device')
+
+
+class NVMeQueuePairWorker(threading.Thread):
+    ''' Thread that owns one IO queue pair of a nvme_device. Only this thread posts
+          to its SQ, writes its doorbells and reaps its CQ, so the CIDs and outstanding
+          commands table for the queue are only ever touched by it.
+        Other threads hand commands over with submit, which only appends to a deque
+          (append and popleft are atomic), so no locks are taken to submit.
+    '''
+    def __init__(self, nvme_device, sqid, queue_depth=32):
+        threading.Thread.__init__(self)
+        self.daemon = True
+
+        self.nvme_device = nvme_device
+        self.sqid = sqid
+
+        sq, cq = nvme_device.queue_mgr.get(sqid, None)
+        assert sq is not None and cq is not None, 'SQID {} not found'.format(sqid)
+        self.cqid = cq.qid
+
+        # A full queue can only hold entries - 1 commands, so limit the depth to that
+        self.queue_depth = min(queue_depth, sq.entries - 1)
+
+        # Commands handed to the worker, (command, callback) tuples
+        self.inbox = deque()
+
+        # Everything below is only modified by the worker thread
+        self.callbacks = {}
+        self.num_submitted = 0
+        self.num_completed = 0
+        self.exception = None
+
+        self.stop_event = threading.Event()
+
+    @property
+    def outstanding(self):
+        # Commands in the inbox and with the device. A command being moved from one to
+        #  the other can be counted twice, but never zero times
+        return len(self.inbox) + len(self.callbacks)
+
+    def submit(self, command, callback=None):
+        ''' Hands command to the worker, it is started on the worker's queue pair the
+              next time the worker has room for it. Safe to call from any thread.
+            callback, if not None, is called from the worker thread with command as
+              its argument once it completes.
+        '''
+        self.inbox.append((command, callback))
+
+    def command_completed(self, command):
+        # Called by the device as part of completing the command
+        command.callback = None
+        self.num_completed += 1
+
+        callback = self.callbacks.pop(id(command))
+        if callback is not None:
+            callback(command)
+
+    def service(self):
+        ''' One pass of the worker loop. Starts the commands waiting in the inbox (up
+              to queue_depth outstanding) with a single doorbell write, then reaps the
+              completion queue. Returns the number of commands started and completed.
+        '''
+        batch = []
+        while len(self.inbox) and len(self.callbacks) < self.queue_depth:
+            # Track the command before taking it out of the inbox
+            command, callback = self.inbox[0]
+            self.callbacks[id(command)] = callback
+            command.callback = self.command_completed
+            batch.append(command)
+            self.inbox.popleft()
+
+        if len(batch):
+            self.nvme_device.start_cmds(batch, self.sqid, self.cqid)
+            self.num_submitted += len(batch)
+
+        return len(batch) + self.nvme_device.reap_completions(self.cqid)
+
+    def run(self):
+        try:
+            while not self.stop_event.is_set():
+                if self.service() == 0:
+                    if self.nvme_device.nvme_regs.CSTS.CFS == 1:
+                        assert False, 'CFS = 1 in SQID {} worker!'.format(self.sqid)
+
+                    # Yield so other threads can run
+                    time.sleep(0)
+        except Exception as e:
+            # Saved so whoever is waiting on the worker can see it
+            logger.exception(e)
+            self.exception = e
+
+    def stop(self):
+        self.stop_event.set()
+        self.join()
+
+
+class NVMeDeviceWorkers:
+    ''' Starts one NVMeQueuePairWorker for each IO queue pair (sqids, all IO queues
+          by default) of a nvme_device. Each queue pair must have its own CQ.
+        Commands submitted are handed to the workers round robin.
+        Everything workers share on the device (latency_stats, prp_pool) and
+          CommandPools take locks, so they can be used with workers.
+    '''
+    def __init__(self, nvme_device, queue_depth=32, sqids=None):
+        self.nvme_device = nvme_device
+
+        # Default to every IO queue the device has created
+        if sqids is None:
+            sqids = nvme_device.queue_mgr.io_sqids
+        assert len(sqids) > 0, 'No IO queues to send commands to!'
+
+        self.workers = [NVMeQueuePairWorker(nvme_device, sqid, queue_depth) for sqid in sqids]
+        cqids = [worker.cqid for worker in self.workers]
+        assert len(set(cqids)) == len(cqids), 'Workers cannot share CQs'
+
+        # next() on an itertools.cycle is atomic, so any thread can pick a worker
+        self.next_worker = itertools.cycle(self.workers)
+
+    @property
+    def outstanding(self):
+        return sum(worker.outstanding for worker in self.workers)
+
+    @property
+    def num_completed(self):
+        return sum(worker.num_completed for worker in self.workers)
+
+    def start(self):
+        for worker in self.workers:
+            worker.start()
+
+    def stop(self):
+        for worker in self.workers:
+            worker.stop()
+
+    def submit(self, command, callback=None):
+        ''' Hands command to the next worker, see NVMeQueuePairWorker.submit.
+              Returns the worker it was handed to.
+        '''
+        worker = next(self.next_worker)
+        worker.submit(command, callback)
+        return worker
+
+    def drain(self, timeout_s=10):
+        ''' Waits for every command submitted to the workers to complete
+        '''
+        max_time = time.time() + timeout_s
+        while self.outstanding:
+            for worker in self.workers:
+                assert worker.exception is None, 'SQID {} worker failed: {}'.format(
+                    worker.sqid, worker.exception)
+                assert worker.is_alive(), 'SQID {} worker is not running'.format(worker.sqid)
+
+            if time.time() > max_time:
+                assert False, '{} commands did not complete in {}s'.format(
+                    self.outstanding, timeout_s)
+
+            # Yield so the workers can run
+            time.sleep(0)
@@ -1,5 +1,8 @@
 import ctypes
 import math
+import threading
+from array import array
+from collections import OrderedDict
 
 from lone.system import DMADirection, MemoryLocation
 
@@ -9,13 +12,19 @@ logger = logging.getLogger('prp')
 
 
 class PRP:
-
-    def __init__(self, mem_mgr, num_bytes, mps, direction, client, alloc=True):
+    ''' PRPs for num_bytes of data. Each page is allocated separately, unless
+          contiguous is True. Then all data pages are allocated as one buffer
+          (and all list pages as another), and PRP entries are calculated from
+          the buffer's iova.
+    '''
+    def __init__(self, mem_mgr, num_bytes, mps, direction, client, alloc=True,
+                 contiguous=False):
         self.mem_mgr = mem_mgr
         self.num_bytes = num_bytes
         self.mps = mps
         self.direction = direction
         self.client = client
+        self.contiguous = contiguous
 
         self.prp1 = 0
         self.prp1_mem = None
@@ -24,17 +33,26 @@ class PRP:
 
         self.mem_list = []
 
-        # How many PRPs fit in a mps sized page (-1 because the last address is
-        #  a pointer to the next list)
-        self.prps_per_page = (self.mps // 8) - 1
+        # List pages, in the order they are chained starting from PRP2
+        self.list_mems = []
+
+        # PRPPool the PRP belongs to, if any
+        self.pool = None
+
+        # How many PRP entries fit in a mps sized list page. When more entries are
+        #  needed than fit, the last entry in a list points to the next list instead
+        self.entries_per_list = self.mps // 8
+        self.prps_per_page = self.entries_per_list - 1
 
         # Calculate how many pages we need for num_bytes
         self.pages_needed = math.ceil(num_bytes / self.mps)
         assert self.pages_needed > 0, 'Pages needed cannot be 0'
+        self.data_pages = self.pages_needed
 
-        # How many list pages do we need? -1 because of PRP1
+        # How many list pages do we need? PRP1 points to the first data page, the
+        #  rest are in lists. Every list but the last one holds prps_per_page
         self.lists_needed = math.ceil(
-            (self.pages_needed - 1) / self.prps_per_page) if self.pages_needed > 2 else 0
+            (self.data_pages - 2) / self.prps_per_page) if self.data_pages > 2 else 0
 
         # If we need lists, then we need more pages
         self.pages_needed += self.lists_needed
@@ -49,6 +67,9 @@ class PRP:
         return mem
 
     def alloc(self):
+        if self.contiguous:
+            self.alloc_contiguous()
+            return
 
         # Less than MPS, only need PRP1, no offset
         # The memory list has to be one item large enough for mps
@@ -66,34 +87,86 @@ class PRP:
 
         # We will need one or more lists
         else:
-            rem_bytes = self.num_bytes
-
             self.prp1_mem = self.malloc_page(self.direction, client='prp_list_1')
             self.prp1 = self.prp1_mem.iova
-            rem_bytes -= self.mps
 
-            # Allocate the first list element, make sure the direction is correct
+            # Allocate the first list page, make sure the direction is correct
             self.prp2_mem = self.malloc_page(DMADirection.HOST_TO_DEVICE, client='prp_list_2')
             self.prp2 = self.prp2_mem.iova
+            list_mem = self.prp2_mem
 
-            # Make a pointer to the first list element so we can fill it in with pointers
-            prp_list_data = (ctypes.c_uint64 * (
-                self.mps // ctypes.sizeof(ctypes.c_uint64))).from_address(self.prp2_mem.vaddr)
-
-            # Allocate all PRPs in the list
-            for i in range(self.prps_per_page):
+            rem_pages = self.data_pages - 1
+            while True:
+                self.list_mems.append(list_mem)
 
-                # Allocate memory
-                self.prp_segment = self.malloc_page(self.direction,
-                                                    client='prp_list_seg_{}'.format(i))
+                # Make a pointer to the list page so we can fill it in with pointers
+                prp_list_data = (ctypes.c_uint64 * self.entries_per_list).from_address(
+                    list_mem.vaddr)
 
-                prp_list_data[i] = self.prp_segment.iova
-                rem_bytes -= self.mps
+                # Allocate the data pages for this list
+                num_entries = self.list_entries(rem_pages)
+                prp_list_data[:num_entries] = [
+                    self.malloc_page(self.direction,
+                                     client='prp_list_seg_{}'.format(i)).iova
+                    for i in range(num_entries)]
+                rem_pages -= num_entries
 
-                if rem_bytes <= 0:
+                if rem_pages == 0:
                     break
-            else:
-                assert False, 'Support for PRPs larger than 2M not implemented!'
+
+                # Chain the next list page from the last entry of this one
+                list_mem = self.malloc_page(DMADirection.HOST_TO_DEVICE,
+                                            client='prp_list_{}'.format(len(self.list_mems) + 2))
+                prp_list_data[self.prps_per_page] = list_mem.iova
+
+    def alloc_contiguous(self):
+        # All data pages in one buffer, PRP1 points to its start
+        self.prp1_mem = self.mem_mgr.malloc(
+            self.data_pages * self.mps, self.direction,
+            client=' '.join([self.client, 'prp_contiguous_data']))
+        self.mem_list.append(self.prp1_mem)
+        self.prp1 = self.prp1_mem.iova
+
+        # PRP2 points to the second page of data
+        if self.data_pages == 2:
+            self.prp2 = self.prp1 + self.mps
+            self.prp2_mem = MemoryLocation(self.prp1_mem.vaddr + self.mps, self.prp2, self.mps,
+                                           self.prp1_mem.client)
+
+        # PRP2 points to the first of the list pages, all in one buffer
+        elif self.data_pages > 2:
+            self.prp2_mem = self.mem_mgr.malloc(
+                self.lists_needed * self.mps, DMADirection.HOST_TO_DEVICE,
+                client=' '.join([self.client, 'prp_contiguous_lists']))
+            self.mem_list.append(self.prp2_mem)
+            self.prp2 = self.prp2_mem.iova
+
+            # Entries for all data pages but the first one, in order
+            entries = array('Q', range(self.prp1 + self.mps,
+                                       self.prp1 + (self.data_pages * self.mps), self.mps))
+
+            # Copy them to each list page, chaining to the next one if needed
+            index = 0
+            for i in range(self.lists_needed):
+                list_mem = MemoryLocation(self.prp2_mem.vaddr + (i * self.mps),
+                                          self.prp2 + (i * self.mps), self.mps,
+                                          self.prp2_mem.client)
+                self.list_mems.append(list_mem)
+
+                num_entries = self.list_entries(len(entries) - index)
+                ctypes.memmove(list_mem.vaddr, entries.buffer_info()[0] + (index * 8),
+                               num_entries * 8)
+                index += num_entries
+
+                if index < len(entries):
+                    ctypes.c_uint64.from_address(
+                        list_mem.vaddr + (self.prps_per_page * 8)).value = list_mem.iova + self.mps
+
+    def list_entries(self, rem_pages):
+        ''' Returns how many data pages a list page holds when rem_pages still
+              need a pointer. The last list can use all its entries for data.
+        '''
+        return rem_pages if rem_pages <= self.entries_per_list else self.prps_per_page
 
     def from_address(self, prp1_address, prp2_address=0):
         ''' Returns a PRP object that starts at address, and is big enough for num_bytes.
@@ -133,20 +206,33 @@ class PRP:
             self.prp2_mem = MemoryLocation(self.prp2, self.prp2, self.mps, 'prp.from_address')
             self.mem_list.append(self.prp2_mem)
 
-            # Make a pointer to the first list element so we can fill it in with pointers
-            prp_list_data = (ctypes.c_uint64 * (
-                self.mps // ctypes.sizeof(ctypes.c_uint64))).from_address(self.prp2_mem.vaddr)
+            # Follow the list chain to find all the segments
+            list_mem = self.prp2_mem
+            rem_pages = self.data_pages - 1
+            while True:
+                self.list_mems.append(list_mem)
+                prp_list_data = (ctypes.c_uint64 * self.entries_per_list).from_address(
+                    list_mem.vaddr)
+
+                num_entries = self.list_entries(rem_pages)
+                for prp_segment in prp_list_data[:num_entries]:
+                    prp_mem = MemoryLocation(prp_segment, prp_segment, self.mps,
+                                             'prp.from_address')
+                    self.mem_list.append(prp_mem)
+                rem_pages -= num_entries
+
+                if rem_pages == 0:
+                    break
 
-            # Find all the segments
-            for prp_segment in prp_list_data:
-                prp_mem = MemoryLocation(prp_segment, prp_segment, self.mps, 'prp.from_address')
-                self.mem_list.append(prp_mem)
+                next_list = prp_list_data[self.prps_per_page]
+                assert next_list != 0, 'PRP list chain ends before num_bytes {}'.format(
+                    self.num_bytes)
+                list_mem = MemoryLocation(next_list, next_list, self.mps, 'prp.from_address')
+                self.mem_list.append(list_mem)
 
         return self
 
     def __str__(self):
-        pages_printed = 0
-        pages_to_print = self.pages_needed + self.lists_needed
         string_ret = ''
 
         def print_page(page):
@@ -156,89 +242,238 @@ class PRP:
             string_ret += '  iova:  0x{:016x}\n'.format(page.iova)
             return string_ret
 
-        for page_index, page in enumerate(self.mem_list):
-
-            # Print prp1
-            if self.prp1 == page.iova:
-                string_ret += 'PRP1: 0x{:016x}\n'.format(self.prp1)
-                string_ret += print_page(page)
-                pages_printed += 1
-
-            # Print prp2
-            if self.prp2 == page.iova:
-                string_ret += 'PRP2: 0x{:016x}\n'.format(self.prp2)
-                string_ret += print_page(page)
-                pages_printed += 1
-                prp_list_data = (ctypes.c_uint64 * (
-                    self.mps // ctypes.sizeof(ctypes.c_uint64))).from_address(page.vaddr)
-
-                # If it is a list print it
-                for i, d in enumerate(prp_list_data):
-                    string_ret += '  list[{:03d}]: 0x{:016x} 0x{:016x}\n'.format(
-                        i, ctypes.addressof(prp_list_data) + (64 * i), d)
-                    pages_printed += 1
-
-                    # Are we done?
-                    if pages_printed >= pages_to_print:
-                        break
-
-            # Are we done?
-            if pages_printed >= pages_to_print:
-                break
+        # Print prp1
+        if self.prp1_mem is not None:
+            string_ret += 'PRP1: 0x{:016x}\n'.format(self.prp1)
+            string_ret += print_page(self.prp1_mem)
+
+        # Print prp2
+        if self.prp2_mem is not None:
+            string_ret += 'PRP2: 0x{:016x}\n'.format(self.prp2)
+            string_ret += print_page(self.prp2_mem)
+
+        # If there are lists print them
+        rem_pages = self.data_pages - 1
+        for list_index, list_mem in enumerate(self.list_mems):
+            prp_list_data = (ctypes.c_uint64 * self.entries_per_list).from_address(
+                list_mem.vaddr)
+
+            # Include the pointer to the next list, if there is one
+            num_entries = self.list_entries(rem_pages)
+            rem_pages -= num_entries
+            num_printed = num_entries + 1 if rem_pages else num_entries
+
+            for i, d in enumerate(prp_list_data[:num_printed]):
+                string_ret += '  list{}[{:03d}]: 0x{:016x} 0x{:016x}\n'.format(
+                    list_index, i, list_mem.vaddr + (8 * i), d)
 
         return string_ret[:-1]
 
     def free_all_memory(self):
         for mem in self.mem_list:
             self.mem_mgr.free(mem)
-            self.mem_list.remove(mem)
+        self.mem_list = []
+        self.list_mems = []
 
     def get_data_segments(self):
-        segments = []
-
-        for page_index, page in enumerate(self.mem_list):
+        ''' Returns the memory locations that hold data for this PRP, in order
+        '''
+        if self.prp1_mem is None:
+            return []
+
+        # One buffer for all data
+        if self.contiguous:
+            return [self.prp1_mem]
+
+        # Only PRP1, or PRP1 and PRP2 pointing to data
+        if self.data_pages == 1:
+            return [self.prp1_mem]
+        elif self.data_pages == 2:
+            return [self.prp1_mem, self.prp2_mem]
+
+        # PRP2 points to a chain of lists with the rest of the data pages
+        segments = [self.prp1_mem]
+        pages = {mem.iova: mem for mem in self.mem_list}
+        rem_pages = self.data_pages - 1
+        for list_mem in self.list_mems:
+            num_entries = self.list_entries(rem_pages)
+            prp_list_data = (ctypes.c_uint64 * num_entries).from_address(list_mem.vaddr)
+            for d in prp_list_data:
+                assert d in pages.keys(), 'Something went wrong with this PRP'
+                segments.append(pages[d])
+            rem_pages -= num_entries
 
-            # Get data from prp1
-            if self.prp1 == page.iova:
-                segments.append(page)
+        return segments
 
-            # Get data from prp2 and lists
-            if self.prp2 == page.iova:
-                prp_list_data = (ctypes.c_uint64 * (
-                    self.mps // ctypes.sizeof(ctypes.c_uint64))).from_address(page.vaddr)
+    def get_data_views(self):
+        ''' Returns a list of memoryviews over each data page, limited to num_bytes
+              in total. No data is copied.
+        '''
+        if self.contiguous:
+            view = self.get_data_view()
+            return [] if view is None else [view]
 
-                # If it is a list then get the data at that address
-                for i, d in enumerate(prp_list_data):
-                    if d != 0:
-                        p = [p for p in self.mem_list if p.iova == d]
-                        assert len(p) == 1, 'Something went wrong with this PRP'
-                        segments.append(p[0])
+        views = []
+        rem_bytes = self.num_bytes
+        for segment in self.get_data_segments():
+            size = min(self.mps, rem_bytes)
+            views.append(memoryview((ctypes.c_uint8 * size).from_address(segment.vaddr)).cast('B'))
+            rem_bytes -= size
+        return views
+
+    def get_data_view(self):
+        ''' Returns a single memoryview over num_bytes of data if all data pages are
+              contiguous in memory, None otherwise. No data is copied.
+        '''
+        segments = self.get_data_segments()
+        if len(segments) == 0:
+            return None
 
-            # TODO: This currently only handles one list segment
+        for prev_segment, segment in zip(segments, segments[1:]):
+            if segment.vaddr != prev_segment.vaddr + self.mps:
+                return None
 
-        return segments
+        return memoryview(
+            (ctypes.c_uint8 * self.num_bytes).from_address(segments[0].vaddr)).cast('B')
 
     def get_data_buffer(self):
-        data = bytearray()
+        ''' Returns a copy of num_bytes of data, gathered from all data pages
+        '''
+        if self.contiguous:
+            return bytearray(self.get_data_view())
+
+        data = bytearray(self.num_bytes)
         i = 0
 
-        for segment in self.get_data_segments():
-            b = (ctypes.c_uint8 * self.mps).from_address(segment.vaddr)
-            data[i:i + segment.size] = b[:i + segment.size]
-            i += segment.size
+        for view in self.get_data_views():
+            data[i:i + len(view)] = view
+            i += len(view)
         return data
 
     def set_data_buffer(self, data):
+        data = memoryview(data).cast('B')
         i = 0
 
-        for segment in self.get_data_segments():
-            b = (ctypes.c_uint8 * self.mps).from_address(segment.vaddr)
+        if self.contiguous:
+            data_len = min(self.num_bytes, len(data))
+            self.get_data_view()[:data_len] = data[:data_len]
+            return
 
+        for view in self.get_data_views():
             # Truncate if we were told to set less bytes than a segment
-            if (i + segment.size) > len(data):
-                data_len = len(data) - i
-            else:
-                data_len = i + segment.size
+            data_len = min(len(view), len(data) - i)
+            if data_len <= 0:
+                break
+
+            view[:data_len] = data[i:i + data_len]
+            i += data_len
 
-            b[:data_len] = data[i:data_len]
-            i += segment.size
+
+class PRPPool:
+    ''' Keeps PRPs that are not in use anymore, with their memory still allocated
+          and mapped, so they can be reused by other commands that need a PRP of
+          the same size and direction. Once more than max_prps PRPs or max_bytes
+          of memory are kept, the least recently returned sizes are freed first.
+        PRPs kept (or handed out) before mem_mgr.free_all are forgotten, their
+          memory is gone.
+        get, put and free_all can be called from multiple threads.
+    '''
+    def __init__(self, mem_mgr, mps, max_prps=256, max_bytes=64 * 1024 * 1024):
+        self.mem_mgr = mem_mgr
+        self.mps = mps
+        self.max_prps = max_prps
+        self.max_bytes = max_bytes
+
+        # Keys = (num_bytes, direction, contiguous), values = list of free PRPs. Kept in least
+        #  to most recently used order
+        self.free_prps = OrderedDict()
+        self.num_prps = 0
+        self.num_bytes = 0
+
+        # Statistics
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        # mem_mgr.free_all_count when our PRPs were allocated
+        self.free_all_count = mem_mgr.free_all_count
+
+        # Worker threads completing commands on a shared device get and put concurrently
+        self.lock = threading.Lock()
+
+    def prp_bytes(self, prp):
+        return sum(mem.size for mem in prp.mem_list)
+
+    def check_free_all(self):
+        # Forget our PRPs without freeing them if mem_mgr freed all memory since
+        if self.free_all_count != self.mem_mgr.free_all_count:
+            self.free_prps = OrderedDict()
+            self.num_prps = 0
+            self.num_bytes = 0
+            self.free_all_count = self.mem_mgr.free_all_count
+
+    def get(self, num_bytes, direction, client, contiguous=False):
+        ''' Returns a free PRP for num_bytes, direction and contiguous, or a new
+              one if there are none
+        '''
+        with self.lock:
+            self.check_free_all()
+
+            key = (num_bytes, direction, contiguous)
+            prps = self.free_prps.get(key)
+            if prps is None:
+                self.misses += 1
+                prp = PRP(self.mem_mgr, num_bytes, self.mps, direction, client,
+                          contiguous=contiguous)
+                prp.pool = self
+                prp.free_all_count = self.free_all_count
+                return prp
+
+            self.hits += 1
+            prp = prps.pop()
+            if len(prps) == 0:
+                del self.free_prps[key]
+            self.num_prps -= 1
+            self.num_bytes -= self.prp_bytes(prp)
+            prp.client = client
+            return prp
+
+    def put(self, prp):
+        ''' Returns prp to the pool
+        '''
+        with self.lock:
+            assert prp.pool is self, 'PRP does not belong to this pool'
+
+            # Handed out before a free_all, its memory is gone
+            self.check_free_all()
+            if prp.free_all_count != self.free_all_count:
+                prp.mem_list = []
+                prp.list_mems = []
+                return
+
+            key = (prp.num_bytes, prp.direction, prp.contiguous)
+            self.free_prps.setdefault(key, []).append(prp)
+            self.free_prps.move_to_end(key)
+            self.num_prps += 1
+            self.num_bytes += self.prp_bytes(prp)
+
+            # Free the least recently used PRPs until we are within limits
+            while self.num_prps > self.max_prps or self.num_bytes > self.max_bytes:
+                self.evict()
+
+    def evict(self):
+        key, prps = next(iter(self.free_prps.items()))
+        prp = prps.pop(0)
+        if len(prps) == 0:
+            del self.free_prps[key]
+        self.num_prps -= 1
+        self.num_bytes -= self.prp_bytes(prp)
+        self.evictions += 1
+        prp.free_all_memory()
+
+    def free_all(self):
+        ''' Frees the memory for every PRP in the pool
+        '''
+        with self.lock:
+            while self.num_prps:
+                self.evict()
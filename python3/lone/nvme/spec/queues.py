@@ -1,4 +1,5 @@
 import ctypes
+from collections import Counter
 
 from lone.nvme.spec.structures import CQE, Generic
 
@@ -77,6 +78,27 @@ class NVMeSubmissionQueue(NVMeQueue):
         # Increment tail, with wrapping
         self.tail.advance()
 
+    def post_commands(self, commands):
+        ''' Posts commands in consecutive slots, then writes the tail doorbell
+              only once for the whole batch
+        '''
+        assert self.num_entries() + len(commands) < self.entries, (
+               "Not enough room in SQ for {} commands {} {} {}".format(
+                   len(commands), self.tail.value, self.head.value, self.entries))
+
+        # Copy each command to its slot, wrapping a local copy of the tail
+        tail = self.tail.value
+        for command in commands:
+            next_slot_addr = self.base_address.vaddr + (tail * self.entry_size)
+            ctypes.memmove(next_slot_addr, ctypes.addressof(command), self.entry_size)
+
+            tail += 1
+            if tail == self.entries:
+                tail = 0
+
+        # Ring the doorbell once
+        self.tail.set(tail)
+
     def get_command(self):
 
         if self.num_entries() == 0:
@@ -96,6 +118,10 @@ class NVMeCompletionQueue(NVMeQueue):
         super().__init__(base_address, entries, entry_size, qid, dbh_addr, dbt_addr)
         self.phase = 1
 
+        # Number of passes of consume_completions that consumed a given number
+        #  of entries, keys = entries consumed, values = number of passes
+        self.reap_counts = Counter()
+
     def get_next_completion(self):
         next_slot_addr = self.base_address.vaddr + (self.head.value * self.entry_size)
         return CQE.from_address(next_slot_addr)
@@ -105,6 +131,40 @@ class NVMeCompletionQueue(NVMeQueue):
         if self.head.value == 0:
             self.phase = 0 if self.phase == 1 else 1
 
+    def get_completions(self, max_completions=None):
+        ''' Returns a list with every new completion in the queue, starting at head,
+              without consuming them. Stops at max_completions if not None
+        '''
+        cqes = []
+        head = self.head.value
+        phase = self.phase
+        while max_completions is None or len(cqes) < max_completions:
+            cqe = CQE.from_address(self.base_address.vaddr + (head * self.entry_size))
+            if cqe.SF.P != phase:
+                break
+            cqes.append(cqe)
+
+            # Move to the next slot, with wrapping
+            head += 1
+            if head == self.entries:
+                head = 0
+                phase = 0 if phase == 1 else 1
+
+            # A full queue can only hold entries - 1 completions
+            if len(cqes) == self.entries - 1:
+                break
+        return cqes
+
+    def consume_completions(self, num_completions):
+        ''' Consumes num_completions entries, writing the head doorbell only once
+        '''
+        head = self.head.value + num_completions
+        if head >= self.entries:
+            head -= self.entries
+            self.phase = 0 if self.phase == 1 else 1
+        self.head.set(head)
+        self.reap_counts[num_completions] += 1
+
     def post_completion(self, cqe):
         # TODO: Check if full
         assert self.is_full() is False, "CQ FULL"
@@ -128,6 +188,24 @@ class QueueMgr:
 
         self.io_cqids = []
 
+        # Lookup indexes, rebuilt every time queues are added or removed
+        self._update_indexes()
+
+    def _update_indexes(self):
+        # sqid/cqid -> (sq, cq) of the first pair that uses them
+        self.sq_index = {}
+        self.cq_index = {}
+        for (sqid, cqid), (sq, cq) in self.nvme_queues.items():
+            self.sq_index.setdefault(sqid, (sq, cq))
+            self.cq_index.setdefault(cqid, (sq, cq))
+
+        # Completion queues and their vectors, one per pair
+        self.cqs = [cq for sq, cq in self.nvme_queues.values()]
+        self.cq_vectors = [cq.int_vector for cq in self.cqs]
+
+        # First pair's ids
+        self.first_ids = next(iter(self.nvme_queues.keys()), (None, None))
+
     def add(self, sq, cq):
         self.nvme_queues[sq.qid, cq.qid] = (sq, cq)
 
@@ -140,6 +218,8 @@ class QueueMgr:
                 self.io_sqids.append(sqid)
                 self.io_cqids.append(cqid)
 
+        self._update_indexes()
+
     def remove_cq(self, rem_cqid):
         for (sqid, cqid), (sq, cq) in self.nvme_queues.items():
             if cqid == rem_cqid:
@@ -156,6 +236,8 @@ class QueueMgr:
         for (sqid, cqid) in remove_qs:
             self.nvme_queues.pop((sqid, cqid))
 
+        self._update_indexes()
+
     def remove_sq(self, rem_sqid):
         for (sqid, cqid), (sq, cq) in self.nvme_queues.items():
             if sqid == rem_sqid:
@@ -163,11 +245,12 @@ class QueueMgr:
                 if sqid != 0:
                     self.io_sqids.remove(sqid)
 
+        self._update_indexes()
+
     def get_cqs(self):
-        cqs = []
-        for k, v in self.nvme_queues.items():
-            cqs.append(v[1])
-        return cqs
+        ''' Returns the precomputed list of completion queues, do not modify it
+        '''
+        return self.cqs
 
     @property
     def all_cqids(self):
@@ -175,16 +258,9 @@ class QueueMgr:
 
     @property
     def all_cq_vectors(self):
-        vectors = []
-        for k, v in self.nvme_queues.items():
-            cq = v[1]
-            vectors.append(cq.int_vector)
-        return vectors
+        return self.cq_vectors
 
     def get(self, sqid=None, cqid=None):
-        sq = None
-        cq = None
-
         # If they are both not None
         if sqid is not None and cqid is not None:
             try:
@@ -194,32 +270,15 @@ class QueueMgr:
 
         # Find first cqid associated with sqid
         elif sqid is not None and cqid is None:
-            for k, v in self.nvme_queues.items():
-                curr_sqid, curr_cqid = k
-                sq, cq = v
-                if sqid == curr_sqid:
-                    break
-            else:
-                sq = None
-                cq = None
+            sq, cq = self.sq_index.get(sqid, (None, None))
 
         # Find first sqid associated with cqid
         elif sqid is None and cqid is not None:
-            for k, v in self.nvme_queues.items():
-                curr_sqid, curr_cqid = k
-                sq, cq = v
-                if cqid == curr_cqid:
-                    break
-            else:
-                sq, cq = None, None
+            sq, cq = self.cq_index.get(cqid, (None, None))
 
         # Both None, find the first one
         else:
-            for k, v in self.nvme_queues.items():
-                sq, cq = k
-                break
-            else:
-                sq, cq = None, None
+            sq, cq = self.first_ids
 
         # Finally return the queues we found
         return sq, cq
@@ -2,13 +2,70 @@ import ctypes
 from lone.util.struct_tools import ComparableStruct
 
 
+def init_field_tables(cls):
+    ''' Builds the field tables for every RegsStructAccess class nested in cls (and cls
+          itself), so register access does not have to on first use. Called by the
+          register struct factories once their classes are defined.
+    '''
+    if issubclass(cls, RegsStructAccess):
+        cls.init_field_table()
+
+    for value in vars(cls).values():
+        if isinstance(value, type) and issubclass(value, ctypes.Structure):
+            init_field_tables(value)
+
+
 class RegsStructAccess(ComparableStruct):
 
-    def read_data(self, get_func, offset, size_bytes):
-        read_data = bytearray()
-        for read_byte in range(size_bytes):
-            read_data += get_func(offset).to_bytes(1, 'little')
-            offset += 1
+    # Keys = field name, values = (shift, mask) to get the field out of the whole
+    #  register as an int, or None if the field is not an int (arrays, structures)
+    _field_table_ = None
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+
+        # Each class builds its own table, see init_field_table
+        cls._field_table_ = None
+
+    @classmethod
+    def init_field_table(cls):
+        ''' Builds and returns the field table for cls. Shifts and masks are found by
+              setting all bits of each field in a zeroed copy of the structure
+        '''
+        field_table = {}
+        for field in getattr(cls, '_fields_', []):
+            name = field[0]
+            probe = cls.from_buffer(bytearray(ctypes.sizeof(cls)))
+            try:
+                object.__setattr__(probe, name, (1 << 64) - 1)
+            except TypeError:
+                field_table[name] = None
+                continue
+
+            bits = int.from_bytes(bytes(probe), 'little')
+            shift = (bits & -bits).bit_length() - 1
+            field_table[name] = (shift, bits >> shift)
+
+        cls._field_table_ = field_table
+        return field_table
+
+    @classmethod
+    def field_table(cls):
+        ''' Returns the field table for cls, building it on first use. An empty table
+              (no _fields_) is built only once too
+        '''
+        if cls._field_table_ is None:
+            return cls.init_field_table()
+        return cls._field_table_
+
+    @staticmethod
+    def read_data(get_func, offset, size_bytes):
+        ''' Reads the whole register (size_bytes at offset) with one get_func call.
+              get_func(offset, size_bytes) returns the bytes read
+        '''
+        read_data = bytearray(get_func(offset, size_bytes))
+        assert len(read_data) == size_bytes, 'Read {} bytes at 0x{:x}, expected {}'.format(
+            len(read_data), offset, size_bytes)
         return read_data
 
     def __setattr__(self, name, value):
@@ -22,7 +79,7 @@ class RegsStructAccess(ComparableStruct):
         # If we are not accessing it directly, but the user requested
         #   something that is not in the _fields_ attribute, just
         #   use the regular __setattr__
-        elif name not in [f[0] for f in object.__getattribute__(self, '_fields_')]:
+        elif name not in type(self).field_table():
             object.__setattr__(self, name, value)
 
         # User requested a field that is in _fields_, and the structure
@@ -42,23 +99,28 @@ class RegsStructAccess(ComparableStruct):
                 raise Exception('Trying to set {} on {}, but offset is None!'.format(
                                 name, self.__class__.__name__))
 
-            # READ size_bytes from offset into a temporary bytearray, then make up an
-            #   object of the type we are modifying
+            # READ size_bytes from offset into a temporary bytearray
             read_data = self.read_data(self._access_.get_func, offset, size_bytes)
-            read_obj = self.__class__.from_buffer(read_data)
-
-            # MODIFY our read data with the new value at name
-            object.__setattr__(read_obj, name, value)
-
-            # WRITE the full structure back to the registers
-            offset = self._base_offset_
-            for write_byte in (ctypes.c_uint8 * size_bytes).from_address(
-                    ctypes.addressof(read_obj)):
-                self._access_.set_func(offset, write_byte)
-                offset += 1
 
+            # MODIFY our read data with the new value at name. Int fields are masked in,
+            #   anything else goes through an object of the type we are modifying
+            field = type(self)._field_table_[name]
+            if field is not None:
+                shift, mask = field
+                register = int.from_bytes(read_data, 'little') & ~(mask << shift)
+                register |= (value & mask) << shift
+                write_data = register.to_bytes(size_bytes, 'little')
+            else:
+                read_obj = self.__class__.from_buffer(read_data)
+                object.__setattr__(read_obj, name, value)
+                write_data = bytes(read_obj)
+
+            # WRITE the full structure back to the registers, in one set_func call
+            self._access_.set_func(offset, write_data)
+
+        # Tell whoever is watching which register (and field in it) was written
         if self._access_.set_notify is not None:
-            self._access_.set_notify()
+            self._access_.set_notify(self, name)
 
     def __getattribute__(self, name):
 
@@ -71,7 +133,8 @@ class RegsStructAccess(ComparableStruct):
         # If we are not accessing it directly, but the user requested
         #   something that is not in the _fields_ attribute, just
         #   use the regular __getattribute__
-        elif name not in [f[0] for f in object.__getattribute__(self, '_fields_')]:
+        field_table = type(self).field_table()
+        if name not in field_table:
             return object.__getattribute__(self, name)
 
         # User requested a field that is in _fields_, and the structure
@@ -90,7 +153,13 @@ class RegsStructAccess(ComparableStruct):
             # READ the latest value from registers
             read_data = self.read_data(self._access_.get_func, offset, size_bytes)
 
-            # Create an object with the read value
+            # Int fields are masked out of the register, anything else comes from an
+            #   object created with the read value
+            field = field_table[name]
+            if field is not None:
+                shift, mask = field
+                return (int.from_bytes(read_data, 'little') >> shift) & mask
+
             data = self.__class__.from_buffer(read_data)
             value = object.__getattribute__(data, name)
             return value
@@ -6,11 +6,14 @@ import logging
 from collections import namedtuple
 
 from lone.util.struct_tools import StructFieldsIterator
-from lone.nvme.spec.registers import RegsStructAccess
+from lone.nvme.spec.registers import RegsStructAccess, init_field_tables
+from lone.nvme.spec.registers.snapshot import RegsSnapshot
 
 NVMeAccessData = namedtuple('NVMeAccessData', 'get_func set_func get_notify set_notify')
 
 
+# Makes new classes on every call. They hold access_data (and whatever its functions are
+#   bound to), so callers that ask more than once keep their classes, see SysVfioIfc
 def nvme_reg_struct_factory(access_data):
 
     class Registers(RegsStructAccess):
@@ -489,6 +492,14 @@ def nvme_reg_struct_factory(access_data):
         _access_ = access_data
         _base_offset_ = 0x00
 
+        def snapshot(self):
+            ''' Returns a RegsSnapshot of all registers, copied in one access
+            '''
+            if not self._access_.get_func:
+                return RegsSnapshot.from_address(NVMeRegistersDirect, ctypes.addressof(self))
+            return RegsSnapshot(NVMeRegistersDirect, self.read_data(
+                self._access_.get_func, self._base_offset_, ctypes.sizeof(NVMeRegistersDirect)))
+
         def log(self):
             log = logging.getLogger('nvme_regs')
 
@@ -496,6 +507,8 @@ def nvme_reg_struct_factory(access_data):
                 if 'RSVD' not in field:
                     log.debug('{:50} 0x{:x}'.format(field, value))
 
+    # Field lookup tables are built here once, instead of on every register access
+    init_field_tables(Registers)
     return Registers
 
 
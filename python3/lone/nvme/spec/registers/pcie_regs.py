@@ -3,13 +3,18 @@ import logging
 from collections import namedtuple
 
 from lone.util.struct_tools import StructFieldsIterator
-from lone.nvme.spec.registers import RegsStructAccess
+from lone.nvme.spec.registers import RegsStructAccess, init_field_tables
+from lone.nvme.spec.registers.snapshot import RegsSnapshot
 
 
-#   pci registers in various implementations.
+#   pci registers in various implementations. get_func(offset, size) returns size bytes
+#   read at offset and set_func(offset, data) writes data at offset, each in one access.
+#   set_notify(register, name) is called after name is set in register
 PCIeAccessData = namedtuple('PCIeAccessData', 'get_func set_func, get_notify, set_notify')
 
 
+# Makes new classes on every call. They hold access_data (and whatever its functions are
+#   bound to), so callers that ask more than once keep their classes, see SysVfioIfc
 def pcie_reg_struct_factory(access_data):
 
     class NVMePCIeRegisters(ctypes.Structure):
@@ -856,6 +861,20 @@ def pcie_reg_struct_factory(access_data):
             _access_ = access_data
             _base_offset_ = None
 
+    # Capability types by CAP_ID, for init_capabilities. Ids not in them are unsupported
+    NVMePCIeRegisters._cap_types_ = {cap_type._cap_id_: cap_type for cap_type in [
+        NVMePCIeRegisters.PCICapPowerManagementInterface,
+        NVMePCIeRegisters.PCICapMSI,
+        NVMePCIeRegisters.PCICapExpress,
+        NVMePCIeRegisters.PCICapMSIX,
+    ]}
+    NVMePCIeRegisters._ext_cap_types_ = {cap_type._cap_id_: cap_type for cap_type in [
+        NVMePCIeRegisters.PCICapExtendedAer,
+        NVMePCIeRegisters.PCICapExtendeDeviceSerialNumber,
+    ]}
+
+    # Field lookup tables are built here once, instead of on every register access
+    init_field_tables(NVMePCIeRegisters)
     return NVMePCIeRegisters
 
 
@@ -863,31 +882,17 @@ class PCIeRegisters:
 
     def init_capabilities(self):
 
-        PCIeCapabilityIdTable = [
-            self.PCICapabilityGen,
-            self.PCICapPowerManagementInterface,
-            *([self.PCICapabilityGen] * 3),
-            self.PCICapMSI,
-            *([self.PCICapabilityGen] * 10),
-            self.PCICapExpress,
-            self.PCICapMSIX,
-            *([self.PCICapabilityGen] * 238),
-        ]
-
-        PCIeCapabilityExtIdTable = [
-            self.PCICapabilityGen,
-            self.PCICapExtendedAer,
-            *([self.PCICapabilityGen] * 1),
-            self.PCICapExtendeDeviceSerialNumber,
-            *([self.PCICapabilityGenExtended] * 251),
-        ]
-
-        # Collect capabilities into a list
+        # Collect capabilities into a list, and index them by (extended, CAP_ID)
         self.capabilities = []
+        self.capability_index = {}
+
+        # Walk the list in memory. Indirect registers are read in bulk first, instead
+        #  of one access for each field looked at
+        walk_regs = self if type(self).direct is True else self.read_config()
 
         # Get the pointer to the first capability and walk the list saving each in
         #  the self.capabilities list
-        for next_cap_ptr in [self.CAP.CP, 0x100]:
+        for next_cap_ptr in [walk_regs.CAP.CP, 0x100]:
 
             while next_cap_ptr:
 
@@ -895,32 +900,20 @@ class PCIeRegisters:
                 if next_cap_ptr < 0x100:
 
                     # Make a generic capability first so we can find out what type it is
-                    cap_gen = self.PCICapabilityGen()
-
-                    # Different handling for direct vs indirect registers
-                    if type(self).direct is True:
-                        cap_gen = self.PCICapabilityGen.from_address(
-                            ctypes.addressof(self) + next_cap_ptr)
-                    else:
-                        cap_gen._access_ = self._access_data_
-                        cap_gen._base_offset_ = next_cap_ptr
+                    cap_gen = walk_regs.PCICapabilityGen.from_address(
+                        ctypes.addressof(walk_regs) + next_cap_ptr)
 
                     # Now we can pull the real type from the table
-                    cap_obj = PCIeCapabilityIdTable[cap_gen.CAP_ID]
+                    cap_obj = self._cap_types_.get(cap_gen.CAP_ID, self.PCICapabilityGen)
 
                 else:
                     # Make a generic capability first so we can find out what type it is
-                    cap_gen_e = self.PCICapabilityGenExtended()
-
-                    if type(self).direct is True:
-                        cap_gen_e = self.PCICapabilityGenExtended.from_address(
-                            ctypes.addressof(self) + next_cap_ptr)
-                    else:
-                        cap_gen_e._access_ = self._access_data_
-                        cap_gen_e._base_offset_ = next_cap_ptr
+                    cap_gen = walk_regs.PCICapabilityGenExtended.from_address(
+                        ctypes.addressof(walk_regs) + next_cap_ptr)
 
                     # Now we can pull the real type from the table
-                    cap_obj = PCIeCapabilityExtIdTable[cap_gen_e.CAP_ID]
+                    cap_obj = self._ext_cap_types_.get(cap_gen.CAP_ID,
+                                                       self.PCICapabilityGenExtended)
 
                 # Only add known types to the capabilities list
                 if type(self).direct is True:
@@ -934,16 +927,48 @@ class PCIeRegisters:
                 # Only add if cap id is known
                 if type(capability) in [self.PCICapabilityGen, self.PCICapabilityGenExtended]:
                     logging.info('Found unsupported Capability {}: 0x{:x}'.format(
-                        'gen' if next_cap_ptr < 0x100 else 'ext', capability.CAP_ID))
+                        'gen' if next_cap_ptr < 0x100 else 'ext', cap_gen.CAP_ID))
                 else:
                     self.capabilities.append(capability)
+                    self.capability_index.setdefault((next_cap_ptr >= 0x100, cap_gen.CAP_ID),
+                                                     capability)
 
                 # Advance to the next pointer
-                next_cap_ptr = capability.NEXT_PTR
+                next_cap_ptr = cap_gen.NEXT_PTR
+
+    def get_capability(self, cap_id, extended=False):
+        ''' Returns the first capability with cap_id found by init_capabilities, or None
+              if there is not one. extended looks in extended capabilities instead.
+        '''
+        return self.capability_index.get((extended, cap_id))
+
+    def read_config(self, offset=0, size=None):
+        ''' Reads size bytes (all registers by default) of config space at offset in
+              one access. Returns the bytes read, or a PCIeRegistersDirect copy of
+              all registers if reading all of them.
+        '''
+        read_all = size is None
+        if read_all:
+            size = ctypes.sizeof(PCIeRegistersDirect)
+
+        if type(self).direct is True:
+            data = bytes((ctypes.c_uint8 * size).from_address(ctypes.addressof(self) + offset))
+        else:
+            data = RegsStructAccess.read_data(self._access_data_.get_func, offset, size)
+
+        return PCIeRegistersDirect.from_buffer_copy(data) if read_all else bytes(data)
+
+    def snapshot(self):
+        ''' Returns a RegsSnapshot of all registers, copied in one access
+        '''
+        return RegsSnapshot(PCIeRegistersDirect, self.read_config(0, ctypes.sizeof(self)))
 
     def log(self):
         log = logging.getLogger('pcie_regs')
-        for field, value in StructFieldsIterator(self):
+
+        # Indirect registers are read all at once, instead of one access per field
+        regs = self if type(self).direct is True else self.read_config()
+        for field, value in StructFieldsIterator(regs):
             if 'RSVD' not in field:
                 log.debug('{:50} 0x{:x}'.format(field, value))
                 print('{:50} 0x{:x}'.format(field, value))
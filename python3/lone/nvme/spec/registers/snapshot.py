@@ -0,0 +1,114 @@
+''' Register snapshots and diffs
+'''
+import re
+import time
+import ctypes
+import bisect
+import functools
+from collections import namedtuple
+
+from lone.nvme.spec.registers import RegsStructAccess
+
+
+# A register (or array element) that changed between two snapshots. fields has
+#   field name: (old, new) for every field in it that changed, empty if the register
+#   has no int fields to break the change down into
+RegsChange = namedtuple('RegsChange', 'name offset old new fields')
+
+
+@functools.lru_cache(maxsize=None)
+def regs_layout(regs_type):
+    ''' Returns (offsets, registers) for regs_type. registers is a list of (name, offset,
+          size, field_table) tuples, one for each register in regs_type, sorted by
+          offset. offsets holds their offsets, to bisect into.
+        Registers are the structures with only int fields and the scalars in regs_type.
+          Anything else (arrays, structures with array fields) is split into them.
+    '''
+    registers = []
+
+    def add(reg_type, name, offset):
+        if issubclass(reg_type, ctypes.Array):
+            for i in range(reg_type._length_):
+                add(reg_type._type_, '{}[{}]'.format(name, i),
+                    offset + i * ctypes.sizeof(reg_type._type_))
+
+        elif issubclass(reg_type, ctypes.Structure):
+            field_table = None
+            if issubclass(reg_type, RegsStructAccess):
+                field_table = reg_type.field_table()
+
+            if field_table is not None and None not in field_table.values():
+                registers.append((name, offset, ctypes.sizeof(reg_type), field_table))
+            else:
+                for field in reg_type._fields_:
+                    add(field[1], '{}.{}'.format(name, field[0]) if name else field[0],
+                        offset + getattr(reg_type, field[0]).offset)
+
+        else:
+            registers.append((name, offset, ctypes.sizeof(reg_type), None))
+
+    add(regs_type, '', 0)
+    return [register[1] for register in registers], registers
+
+
+class RegsSnapshot:
+    ''' Copy of all the registers in a register structure, taken in one access (a
+          memcpy for direct registers, or one get_func call for indirect ones).
+          regs_type is the direct registers type the data is laid out as.
+        Snapshots are compared with diff, and regs() gives the registers in one
+          as a regs_type object, to look at them as usual.
+    '''
+    def __init__(self, regs_type, data):
+        assert len(data) == ctypes.sizeof(regs_type), 'Got {} bytes for {}, expected {}'.format(
+            len(data), regs_type.__name__, ctypes.sizeof(regs_type))
+
+        self.regs_type = regs_type
+        self.data = bytes(data)
+        self.time_ns = time.perf_counter_ns()
+
+    @classmethod
+    def from_address(cls, regs_type, address):
+        return cls(regs_type, ctypes.string_at(address, ctypes.sizeof(regs_type)))
+
+    def regs(self):
+        return self.regs_type.from_buffer_copy(self.data)
+
+    def diff(self, other):
+        ''' Returns a list of RegsChange for every register that is different in other,
+              a later snapshot of the same registers, sorted by offset.
+        '''
+        assert other.regs_type is self.regs_type, 'Cannot diff {} and {} snapshots'.format(
+            self.regs_type.__name__, other.regs_type.__name__)
+
+        # Same bytes, nothing to look at. This is a memcmp
+        if self.data == other.data:
+            return []
+
+        # XOR all the bytes at once, then let re find the runs of changed (non-zero)
+        #  bytes, instead of comparing them one by one
+        size = len(self.data)
+        changed_bytes = (int.from_bytes(self.data, 'little') ^
+                         int.from_bytes(other.data, 'little')).to_bytes(size, 'little')
+
+        # Registers each run of changed bytes falls in
+        offsets, registers = regs_layout(self.regs_type)
+        changed = set()
+        for run in re.finditer(b'[^\x00]+', changed_bytes):
+            first = bisect.bisect_right(offsets, run.start()) - 1
+            last = bisect.bisect_right(offsets, run.end() - 1) - 1
+            changed.update(range(first, last + 1))
+
+        changes = []
+        for index in sorted(changed):
+            name, offset, reg_size, field_table = registers[index]
+            old = int.from_bytes(self.data[offset:offset + reg_size], 'little')
+            new = int.from_bytes(other.data[offset:offset + reg_size], 'little')
+
+            # Fields that changed, from the same tables register access uses
+            fields = {}
+            for field, (shift, mask) in (field_table or {}).items():
+                if ((old ^ new) >> shift) & mask:
+                    fields[field] = ((old >> shift) & mask, (new >> shift) & mask)
+
+            changes.append(RegsChange(name, offset, old, new, fields))
+        return changes
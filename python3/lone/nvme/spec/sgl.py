@@ -0,0 +1,218 @@
+import ctypes
+import math
+
+from lone.system import DMADirection, MemoryLocation
+from lone.nvme.spec.structures import SGLDescriptor
+
+
+import logging
+logger = logging.getLogger('sgl')
+
+
+class SGL:
+    ''' Scatter gather list for a command's data. Data is allocated in contiguous
+          blocks of up to max_block_bytes (one block for all data if None), each
+          described by a single data block descriptor. If there is more than one
+          block, sgl1 points to a chain of segments holding the data block
+          descriptors, each one ending with a descriptor pointing to the next.
+        Same interface as PRP for the data, so it can be used as a command's prp.
+    '''
+    def __init__(self, mem_mgr, num_bytes, mps, direction, client, alloc=True,
+                 max_block_bytes=None):
+        self.mem_mgr = mem_mgr
+        self.num_bytes = num_bytes
+        self.mps = mps
+        self.direction = direction
+        self.client = client
+
+        assert num_bytes > 0, 'num_bytes cannot be 0'
+
+        # Descriptor in the command (SGL1)
+        self.sgl1 = SGLDescriptor()
+
+        # Data blocks and segments, in order
+        self.mem_list = []
+        self.data_mems = []
+        self.segment_mems = []
+
+        # PRPPool the SGL belongs to, if any (always None, kept for PRP compatibility)
+        self.pool = None
+
+        # How many descriptors fit in a mps sized segment
+        self.descs_per_segment = self.mps // ctypes.sizeof(SGLDescriptor)
+
+        # Calculate how many data blocks we need
+        self.block_bytes = num_bytes if max_block_bytes is None else max_block_bytes
+        self.blocks_needed = math.ceil(num_bytes / self.block_bytes)
+
+        # Allocate memory
+        if alloc is True:
+            self.alloc()
+
+    def segment_descs(self, rem_blocks):
+        ''' Returns how many data block descriptors a segment holds when rem_blocks
+              still need a descriptor. The last segment can use all its entries.
+        '''
+        return rem_blocks if rem_blocks <= self.descs_per_segment else self.descs_per_segment - 1
+
+    @staticmethod
+    def set_descriptor(desc, desc_type, addr, length):
+        desc.TYPE = desc_type
+        desc.SUBTYPE = 0
+        desc.ADDR = addr
+        desc.LEN = length
+
+    def alloc(self):
+        # Allocate all data blocks
+        rem_bytes = self.num_bytes
+        for i in range(self.blocks_needed):
+            size = min(self.block_bytes, rem_bytes)
+            mem = self.mem_mgr.malloc(size, self.direction,
+                                      client=' '.join([self.client, 'sgl_data_{}'.format(i)]))
+            self.mem_list.append(mem)
+            self.data_mems.append(mem)
+            rem_bytes -= size
+
+        # Only one block, sgl1 describes it
+        if self.blocks_needed == 1:
+            self.set_descriptor(self.sgl1, SGLDescriptor.DATA_BLOCK,
+                                self.data_mems[0].iova, self.num_bytes)
+            return
+
+        # Segments with the data block descriptors, chained from sgl1
+        pointer = self.sgl1
+        rem_blocks = self.blocks_needed
+        data_index = 0
+        while rem_blocks:
+            num_descs = self.segment_descs(rem_blocks)
+            last = num_descs == rem_blocks
+
+            segment = self.mem_mgr.malloc(
+                self.mps, DMADirection.HOST_TO_DEVICE,
+                client=' '.join([self.client, 'sgl_segment_{}'.format(len(self.segment_mems))]))
+            self.mem_list.append(segment)
+            self.segment_mems.append(segment)
+
+            # Point the previous segment (or sgl1) to this one
+            seg_len = (num_descs if last else num_descs + 1) * ctypes.sizeof(SGLDescriptor)
+            self.set_descriptor(pointer,
+                                SGLDescriptor.LAST_SEGMENT if last else SGLDescriptor.SEGMENT,
+                                segment.iova, seg_len)
+
+            descs = (SGLDescriptor * self.descs_per_segment).from_address(segment.vaddr)
+            for desc, mem in zip(descs, self.data_mems[data_index:data_index + num_descs]):
+                self.set_descriptor(desc, SGLDescriptor.DATA_BLOCK, mem.iova, mem.size)
+
+            pointer = None if last else descs[num_descs]
+            data_index += num_descs
+            rem_blocks -= num_descs
+
+    def from_address(self, sgl1):
+        ''' Returns a SGL object with the data blocks described by the sgl1 descriptor,
+              following any segments. This assumes the SGL is properly formatted.
+        '''
+        ctypes.memmove(ctypes.addressof(self.sgl1), ctypes.addressof(sgl1),
+                       ctypes.sizeof(SGLDescriptor))
+
+        descs = [self.sgl1]
+        while len(descs):
+            desc = descs.pop(0)
+
+            if desc.TYPE == SGLDescriptor.DATA_BLOCK:
+                mem = MemoryLocation(desc.ADDR, desc.ADDR, desc.LEN, 'sgl.from_address')
+                self.mem_list.append(mem)
+                self.data_mems.append(mem)
+
+            elif desc.TYPE in [SGLDescriptor.SEGMENT, SGLDescriptor.LAST_SEGMENT]:
+                # Only the last descriptor in a segment can point to another one
+                assert len(descs) == 0, 'Segment descriptor not last in segment'
+                assert desc.LEN % ctypes.sizeof(SGLDescriptor) == 0, 'Invalid segment length'
+
+                segment = MemoryLocation(desc.ADDR, desc.ADDR, desc.LEN, 'sgl.from_address')
+                self.mem_list.append(segment)
+                self.segment_mems.append(segment)
+                descs = list((SGLDescriptor * (desc.LEN // ctypes.sizeof(SGLDescriptor))
+                              ).from_address(desc.ADDR))
+
+                if desc.TYPE == SGLDescriptor.LAST_SEGMENT:
+                    assert all(d.TYPE == SGLDescriptor.DATA_BLOCK for d in descs), (
+                        'Last segment can only have data block descriptors')
+
+            else:
+                assert False, 'SGL descriptor type {} not supported'.format(desc.TYPE)
+
+        assert sum(m.size for m in self.data_mems) >= self.num_bytes, (
+            'SGL too small for num_bytes {}'.format(self.num_bytes))
+        return self
+
+    def __str__(self):
+        string_ret = 'SGL1: type {} addr 0x{:016x} len {}\n'.format(
+            self.sgl1.TYPE, self.sgl1.ADDR, self.sgl1.LEN)
+
+        for mem in self.data_mems:
+            string_ret += '  data: vaddr 0x{:016x} iova 0x{:016x} size {}\n'.format(
+                mem.vaddr, mem.iova, mem.size)
+
+        return string_ret[:-1]
+
+    def free_all_memory(self):
+        for mem in self.mem_list:
+            self.mem_mgr.free(mem)
+        self.mem_list = []
+        self.data_mems = []
+        self.segment_mems = []
+
+    def get_data_segments(self):
+        ''' Returns the memory locations that hold data for this SGL, in order
+        '''
+        return self.data_mems
+
+    def get_data_views(self):
+        ''' Returns a list of memoryviews over each data block, limited to num_bytes
+              in total. No data is copied.
+        '''
+        views = []
+        rem_bytes = self.num_bytes
+        for mem in self.data_mems:
+            size = min(mem.size, rem_bytes)
+            views.append(memoryview((ctypes.c_uint8 * size).from_address(mem.vaddr)).cast('B'))
+            rem_bytes -= size
+        return views
+
+    def get_data_view(self):
+        ''' Returns a single memoryview over num_bytes of data if all data blocks are
+              contiguous in memory, None otherwise. No data is copied.
+        '''
+        if len(self.data_mems) == 0:
+            return None
+
+        for prev_mem, mem in zip(self.data_mems, self.data_mems[1:]):
+            if mem.vaddr != prev_mem.vaddr + prev_mem.size:
+                return None
+
+        return memoryview(
+            (ctypes.c_uint8 * self.num_bytes).from_address(self.data_mems[0].vaddr)).cast('B')
+
+    def get_data_buffer(self):
+        ''' Returns a copy of num_bytes of data, gathered from all data blocks
+        '''
+        data = bytearray(self.num_bytes)
+        i = 0
+
+        for view in self.get_data_views():
+            data[i:i + len(view)] = view
+            i += len(view)
+        return data
+
+    def set_data_buffer(self, data):
+        data = memoryview(data).cast('B')
+        i = 0
+
+        for view in self.get_data_views():
+            # Truncate if we were told to set less bytes than a block
+            data_len = min(len(view), len(data) - i)
+            if data_len <= 0:
+                break
+
+            view[:data_len] = data[i:i + data_len]
+            i += data_len
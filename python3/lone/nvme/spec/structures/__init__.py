@@ -1,5 +1,6 @@
 import ctypes
 import inspect
+import threading
 
 from lone.util.struct_tools import StructFieldsIterator
 from lone.util.hexdump import hexdump
@@ -69,10 +70,27 @@ class DptrPrp(ctypes.Structure):
     ]
 
 
+class SGLDescriptor(ctypes.Structure):
+    _pack_ = 1
+    _fields_ = [
+        ('ADDR', ctypes.c_uint64),
+        ('LEN', ctypes.c_uint32),
+        ('RSVD_0', ctypes.c_uint8 * 3),
+        ('SUBTYPE', ctypes.c_uint8, 4),
+        ('TYPE', ctypes.c_uint8, 4),
+    ]
+
+    # Descriptor types
+    DATA_BLOCK = 0x0
+    BIT_BUCKET = 0x1
+    SEGMENT = 0x2
+    LAST_SEGMENT = 0x3
+
+
 class DptrSgl(ctypes.Structure):
     _pack_ = 1
     _fields_ = [
-        ('SGL1', ctypes.c_uint64 * 2),
+        ('SGL1', SGLDescriptor),
     ]
 
 
@@ -150,6 +168,14 @@ class SQECommon(ctypes.Structure, DataDumper):
         # Context variable so users can keep track of non-standard things
         self.context = None
 
+        # Optional callable, called with the command as its only argument when
+        #  the command completes
+        self.callback = None
+
+        # CommandPool the command belongs to, if any
+        self.pool = None
+        self.in_pool = False
+
         # Mark as initialized. After this point no more variables can be added
         self.initialized = True
         self.internal_mem = False
@@ -175,7 +201,87 @@ class SQECommon(ctypes.Structure, DataDumper):
 
     def free_prps(self):
         if self.prp is not None:
-            self.prp.free_all_memory()
+            # PRPs from a pool go back to it instead of being freed
+            if self.prp.pool is not None:
+                self.prp.pool.put(self.prp)
+            else:
+                self.prp.free_all_memory()
+            self.prp = None
+
+
+class CommandPool:
+    ''' Pool of pre-initialized commands of a single type, to avoid creating a new
+          command object for every IO. kwargs are applied once to a template
+          command, and get() resets a pooled command to it with a single memmove
+          plus the tracking variables that change while a command is in use.
+        Commands are given back with put() by whoever got them, once done with
+          the results. put() frees their PRPs (and the data read into them), so
+          they should not be used after that.
+        get and put can be called from multiple threads (like NVMeQueuePairWorker
+          callbacks).
+    '''
+    def __init__(self, command_type, size, **kwargs):
+        self.command_type = command_type
+        self.template = command_type(**kwargs)
+        self.data_in_type = getattr(command_type, 'data_in_type', None)
+        self.data_out_type = getattr(command_type, 'data_out_type', None)
+        self.size = ctypes.sizeof(command_type)
+        self.num_created = 0
+        self.free_commands = [self._new_command() for i in range(size)]
+        self.lock = threading.Lock()
+
+    def _new_command(self):
+        command = self.command_type()
+        command.pool = self
+        command.in_pool = True
+        self.num_created += 1
+        return command
+
+    def get(self, **kwargs):
+        # Use a free command if we have one, grow the pool otherwise. Only taking it
+        #  out needs the lock, nobody else has the command after that
+        with self.lock:
+            if len(self.free_commands):
+                command = self.free_commands.pop()
+            else:
+                command = self._new_command()
+
+        # Reset command fields to the template, then apply the ones passed in
+        ctypes.memmove(ctypes.addressof(command), ctypes.addressof(self.template), self.size)
+        for k, v in kwargs.items():
+            setattr(command, k, v)
+
+        # Reset tracking variables and data. PRPs were freed when it was put back
+        command.in_pool = False
+        command.data_in = self.data_in_type() if self.data_in_type is not None else None
+        command.data_out = self.data_out_type() if self.data_out_type is not None else None
+        ctypes.memset(ctypes.addressof(command.cqe), 0, ctypes.sizeof(command.cqe))
+        command.start_time_ns = 0
+        command.end_time_ns = 0
+        command.sq = None
+        command.cq = None
+        command.complete = False
+        command.posted = False
+        command.context = None
+        command.callback = None
+
+        return command
+
+    def put(self, command):
+        assert command.pool is self, 'Command does not belong to this pool'
+        assert command.posted is False, 'Returning a posted command to the pool'
+
+        with self.lock:
+            assert command.in_pool is False, 'Command is already in the pool'
+            command.in_pool = True
+
+        # Nobody can use the command after this, so its PRPs are freed here
+        command.free_prps()
+        with self.lock:
+            self.free_commands.append(command)
+
+    def num_free(self):
+        return len(self.free_commands)
 
 
 class DataOutCommon(ctypes.Structure, DataDumper):
@@ -157,6 +157,14 @@ class MemoryLocation:
 class DevMemMgr(metaclass=abc.ABCMeta):
     ''' Base DevMemMgr interface object
     '''
+    # True if memory allocated is shared with (not copied into) processes forked
+    #   after it is allocated
+    fork_shared = False
+
+    # Number of times free_all ran. Whoever keeps memory from us around for later (like
+    #   PRPPool) checks it to know that memory is gone
+    free_all_count = 0
+
     def __init__(self, page_size):
         ''' Initializes a DevMemMgr manager
         '''
@@ -176,7 +184,8 @@ class DevMemMgr(metaclass=abc.ABCMeta):
 
     @abc.abstractmethod
     def free_all(self):
-        ''' Free all memory we previously allocated
+        ''' Free all memory we previously allocated. Implementations increment
+              free_all_count
         '''
         raise NotImplementedError
 
@@ -6,63 +6,22 @@ import math
 import ctypes
 
 from lone.system import DevMemMgr, MemoryLocation, DMADirection
+from lone.util.address_mgr import AddressRangeMgr
 
 
-class HugePagesIovaMgr:
-    ''' This class manages how IOVAs are assigned to memory
-        NOTE: Limits it to 2M requests
+class HugePagesIovaMgr(AddressRangeMgr):
+    ''' Assigns IOVAs to hugepages memory, out of the iova_ranges the IOMMU allows
     '''
-    def __init__(self, iova_ranges):
-        # iova ranges is a list of (start, stop) tuples for addresses
-        self.iova_ranges = iova_ranges
-        self.max_iovas = 1000
-
-        # To avoid a lot of processing allocating and deallocating iovas
-        #  of specific sizes, fix them all to 2Mb. May need to change if
-        #  the user wants more than that for a legitimate reason.
-        self.increment = (2 * 1024 * 1024)
-
-        # Reset ourselves at init
-        self.reset()
-
-    def reset(self):
-        self.free_iovas = []
-
-        # Start from the first available value in the first range
-        range_index = 0
-        next_available_iova = self.iova_ranges[range_index][0]
-        max_range_iova = self.iova_ranges[range_index][1] - self.increment
-
-        # 0 is not really that great for an iova when debugging
-        if next_available_iova == 0:
-            next_available_iova = 0x0001000
-            assert next_available_iova <= max_range_iova, 'Invalid IOVA range'
-
-        for i in range(self.max_iovas):
-            self.free_iovas.append(next_available_iova)
-            next_available_iova += self.increment
-
-            # Make sure we don't go over the max for the range
-            if next_available_iova > max_range_iova:
-                range_index += 1
-                assert range_index < len(self.iova_ranges), 'Ran out of ranges!'
-                next_available_iova = self.iova_ranges[range_index][0]
-                max_range_iova = self.iova_ranges[range_index][1] - self.increment
-
     def num_allocated_iovas(self):
-        return self.max_iovas - len(self.free_iovas)
-
-    def get(self, size):
-        assert size <= self.increment, f'IOVA max size is {self.increment}, requested {size}'
-        return self.free_iovas.pop(0)
-
-    def free(self, iova):
-        self.free_iovas.append(iova)
+        return self.num_allocated()
 
 
 class HugePagesMemoryMgr(DevMemMgr):
     ''' Uses hugepage backed memory but allocates and frees it in chunks of
-        a certain page size.
+        a certain page size. Hugepage memory is split up with a buddy allocator:
+        blocks of 2 ** order pages are kept in one free list per order, split in
+        halves to satisfy smaller allocations and merged back with their buddy
+        when freed.
     '''
 
     def __init__(self,
@@ -70,21 +29,35 @@ class HugePagesMemoryMgr(DevMemMgr):
                  map_read_func,
                  map_write_func,
                  unmap_func,
-                 iova_ranges):
+                 iova_ranges,
+                 premap_func=None):
         self.page_size = page_size
         self.map_read_func = map_read_func
         self.map_write_func = map_write_func
         self.unmap_func = unmap_func
 
+        # If premap_func is passed in, each hugepage area is mapped read/write with
+        #  it once when allocated, and malloc/free do not map/unmap memory
+        self.premap_func = premap_func
+
         # Initialize parent
         super().__init__(page_size)
 
         # Create HugePagesMemory object
         self.hugepages_memory = HugePagesMemory(self.page_size)
+        self.pages_per_hp = self.hugepages_memory.hugepages_size // self.page_size
 
-        # Allocate one huge page initially
-        self.pages = []
-        self._malloc_hps(1)
+        # Hugepage memory areas we split up, keys = vaddr, values = order of the area
+        self.arenas = {}
+
+        # One dictionary of free blocks per order, keys = block vaddr, values = arena vaddr
+        self.free_blocks = []
+
+        # Blocks given out, keys = block vaddr, values = (arena vaddr, order)
+        self.allocated_blocks = {}
+
+        # IOVA of each premapped arena, keys = arena vaddr, values = iova
+        self.arena_iovas = {}
 
         # Keep track of memory given out on malloc calls
         self.malloc_mem = []
@@ -92,86 +65,98 @@ class HugePagesMemoryMgr(DevMemMgr):
         # The IOVA manager manages giving out IOVA for addresses
         self.iova_mgr = HugePagesIovaMgr(iova_ranges)
 
-    def free_pages(self):
-        return [p for p in self.pages if p.in_use is False]
+        # Allocate one huge page initially
+        self._malloc_hps(1)
+
+    def num_free_pages(self):
+        return sum(len(blocks) << order for order, blocks in enumerate(self.free_blocks))
 
     def allocated_mem_list(self):
         return self.malloc_mem
 
     def _malloc_hps(self, num_hps):
-        ''' Allocates a certain number of hugepages and splits them up into
-            pages (MemoryLocation).
+        ''' Allocates a contiguous area of at least num_hps hugepages (rounded up to
+            a power of 2) and adds it to the free blocks as one block.
+        '''
+        num_hps = 1 << (num_hps - 1).bit_length()
+        vaddr, size = self.hugepages_memory._malloc(
+            num_hps * self.hugepages_memory.hugepages_size)
+
+        order = ((size // self.page_size) - 1).bit_length()
+        while len(self.free_blocks) <= order:
+            self.free_blocks.append({})
+
+        self.arenas[vaddr] = order
+        self.free_blocks[order][vaddr] = vaddr
+
+        # Map the whole area at once, blocks in it use iovas relative to it
+        if self.premap_func is not None:
+            iova = self.iova_mgr.get(size, align=self.hugepages_memory.hugepages_size)
+            self.premap_func(vaddr, iova, size)
+            self.arena_iovas[vaddr] = iova
+
+    def _alloc_block(self, order):
+        ''' Returns the vaddr of a free block of 2 ** order pages, None if there
+              is not one
         '''
-        for hp_idx in range(num_hps):
+        # Find the smallest free block that fits
+        for block_order in range(order, len(self.free_blocks)):
+            if len(self.free_blocks[block_order]):
+                break
+        else:
+            return None
+
+        vaddr, arena = self.free_blocks[block_order].popitem()
 
-            # Malloc hugepage
-            vaddr, size = self.hugepages_memory._malloc(self.hugepages_memory.hugepages_size)
+        # Split it in halves until it is the size we want, freeing the upper halves
+        while block_order > order:
+            block_order -= 1
+            self.free_blocks[block_order][vaddr + (self.page_size << block_order)] = arena
 
-            # Split it up into pages, add to the self.pages list
-            for pg_idx in range(size // self.page_size):
-                self.pages.append(MemoryLocation(vaddr + (pg_idx * self.page_size),
-                                                 0,
-                                                 self.page_size,
-                                                 __class__.__name__))
+        self.allocated_blocks[vaddr] = (arena, order)
+        return vaddr
+
+    def _free_block(self, vaddr):
+        ''' Frees a block, merging it with its buddy for as long as the buddy is free
+        '''
+        arena, order = self.allocated_blocks.pop(vaddr)
+
+        while order < self.arenas[arena]:
+            buddy = arena + ((vaddr - arena) ^ (self.page_size << order))
+            if buddy not in self.free_blocks[order]:
+                break
+            del self.free_blocks[order][buddy]
+            vaddr = min(vaddr, buddy)
+            order += 1
+
+        self.free_blocks[order][vaddr] = arena
 
     def malloc(self, size, direction, client='HugePagesMemoryMgr'):
-        ''' Allocates whatever number of pages needed to satisfy a
-            contiguous memory area of size
+        ''' Allocates a contiguous memory area of size
             Will allocate more hugepages if needed
         '''
+        # Premapped memory can be used in any direction, but check it is a valid one
+        if self.premap_func is not None:
+            assert isinstance(direction, DMADirection), 'Invalid direction {}'.format(direction)
+
         # Allocations have to be at least one sc_page_size
         if size < self.hugepages_memory.sc_page_size:
             size = self.hugepages_memory.sc_page_size
 
-        # Caclulate the consecutive number of pages needed
-        pages_needed = max(1, size // self.page_size)
+        # Caclulate the consecutive number of pages needed, and the block order for it
+        pages_needed = max(1, math.ceil(size / self.page_size))
+        order = (pages_needed - 1).bit_length()
 
         # Allocate more hps if needed
-        pages_per_hp = self.hugepages_memory.hugepages_size // self.page_size
-        if pages_needed > len(self.free_pages()):
-            num_alloc = max(1, math.ceil((pages_needed - len(self.free_pages())) // pages_per_hp))
-            self._malloc_hps(num_alloc)
+        vaddr = self._alloc_block(order)
+        if vaddr is None:
+            self._malloc_hps(math.ceil((1 << order) / self.pages_per_hp))
+            vaddr = self._alloc_block(order)
+            if vaddr is None:
+                raise MemoryError('Not able to find memory to malloc')
 
-        # Generator to group pages in sets of n
-        def grouper(in_list, n):
-            for i in range(len(in_list) - (n - 1)):
-                yield in_list[i:i + n]
-
-        # Go through all groups of consecutive pages until we find on that is all free
-        ret_mem = None
-        for group in grouper(self.free_pages(), pages_needed):
-
-            # First check if all the pages in group are free
-            if any([p.in_use is True for p in group]):
-                continue
-
-            # Then make sure the pages_needed in group are contiguous. If not, we need
-            #   to move on to the next set of pages
-            if all([p0.vaddr + p0.size == p1.vaddr for p0, p1 in grouper(group, 2)]):
-
-                # Found it!
-                ret_mem = group[0]
-
-                # Link the memory pages together to be able to free it later
-                for m in group[1:]:
-                    m.in_use = True
-                    ret_mem.linked_mem.append(m)
-
-                # Done!
-                break
-
-        else:
-            raise MemoryError('Not able to find memory to malloc')
-
-        # Update size so the MemoryLocation object we return can be used as if it was
-        #  of that size
-        ret_mem.size = size
-
-        # Update the client that allocated this segment for debugging purposes
-        ret_mem.client = client
-
-        # Add iova
-        ret_mem.iova = self.iova_mgr.get(ret_mem.size)
+        # Create the MemoryLocation object for the block, with the size requested
+        ret_mem = MemoryLocation(vaddr, 0, size, client)
 
         # Mark in use
         ret_mem.in_use = True
@@ -179,8 +164,16 @@ class HugePagesMemoryMgr(DevMemMgr):
         # Add to our tracking list
         self.malloc_mem.append(ret_mem)
 
-        # Map it
-        self.map_iova(ret_mem, direction)
+        if self.premap_func is not None:
+            # Already mapped read/write, only keep track of the direction it is used for
+            arena = self.allocated_blocks[vaddr][0]
+            ret_mem.iova = self.arena_iovas[arena] + (vaddr - arena)
+            ret_mem.iova_direction = direction
+            ret_mem.iova_mapped = True
+        else:
+            # Add iova and map it
+            ret_mem.iova = self.iova_mgr.get(ret_mem.size)
+            self.map_iova(ret_mem, direction)
 
         # Return it!
         return ret_mem
@@ -201,48 +194,38 @@ class HugePagesMemoryMgr(DevMemMgr):
         ''' Allocates a number of free pages. Not guaranteed to be contiguous!
         '''
         # Allocate more hugepages if needed
-        pages_per_hp = self.hugepages_memory.hugepages_size // self.page_size
-        if num_pages > len(self.free_pages()):
-            num_alloc = max(1, math.ceil((num_pages - len(self.free_pages())) / pages_per_hp))
-            self._malloc_hps(num_alloc)
+        if num_pages > self.num_free_pages():
+            self._malloc_hps(math.ceil((num_pages - self.num_free_pages()) / self.pages_per_hp))
 
-        # Mark the ones we are returning as used
-        pages = self.free_pages()[:num_pages]
-        for p in pages:
-            p.in_use = True
+        # Allocate one page at a time
+        pages = []
+        for i in range(num_pages):
+            page = MemoryLocation(self._alloc_block(0), 0, self.page_size, client)
+            page.in_use = True
+            pages.append(page)
 
         # Return allocated pages as a list
-        assert len(pages) == num_pages, 'Did not allocate enough pages!'
         return pages
 
     def free(self, memory):
-        ''' Free previously allocated pages
+        ''' Free previously allocated memory
         '''
-        # First free the links
-        for m in memory.linked_mem:
-            assert m.in_use is True
-            m.in_use = False
-            m.size = self.page_size
-
-        # Clear linked memory
-        memory.linked_mem = []
-
-        # If no links, just the first one
         assert memory.in_use is True
         memory.in_use = False
-        memory.size = self.page_size
 
-        # Unmap the iova
+        # Unmap the iova and free it, unless it is part of a premapped arena
         assert memory.iova_mapped is True
-        self.unmap_func(memory.iova, memory.size)
+        if self.premap_func is None:
+            self.unmap_func(memory.iova, memory.size)
+            self.iova_mgr.free(memory.iova)
         memory.iova_mapped = False
 
-        # Free the iova used for this memory
-        self.iova_mgr.free(memory.iova)
-
         # Clear free'd memory
         ctypes.memset(memory.vaddr, 0, memory.size)
 
+        # Give the block back to the allocator
+        self._free_block(memory.vaddr)
+
         # Remove from tracking list
         self.malloc_mem.remove(memory)
 
@@ -253,14 +236,42 @@ class HugePagesMemoryMgr(DevMemMgr):
         for m in malloc:
             self.free(m)
 
-        # Remove all pages from our tracking list
-        self.pages = []
+        # Unmap premapped arenas
+        for arena, iova in self.arena_iovas.items():
+            self.unmap_func(iova, self.page_size << self.arenas[arena])
+            self.iova_mgr.free(iova)
+        self.arena_iovas = {}
+
+        # Forget about all blocks
+        self.arenas = {}
+        self.free_blocks = []
+        self.allocated_blocks = {}
 
         # Free all backing hugepages
         self.hugepages_memory._free_all()
 
         # Make sure it is all gone!
         assert len(self.malloc_mem) == 0, 'Memory not free after free_all'
+        self.free_all_count += 1
+
+    def stats(self):
+        ''' Returns a dictionary with allocator statistics. fragmentation is the
+              fraction of free memory that is not in the largest free block
+        '''
+        total_pages = sum(1 << order for order in self.arenas.values())
+        free_pages = self.num_free_pages()
+        free_orders = [order for order, blocks in enumerate(self.free_blocks) if len(blocks)]
+        largest_free_pages = (1 << max(free_orders)) if len(free_orders) else 0
+
+        return {
+            'total_pages': total_pages,
+            'free_pages': free_pages,
+            'used_pages': total_pages - free_pages,
+            'requested_bytes': sum(m.size for m in self.malloc_mem),
+            'largest_free_pages': largest_free_pages,
+            'free_blocks_per_order': [len(blocks) for blocks in self.free_blocks],
+            'fragmentation': (1 - (largest_free_pages / free_pages)) if free_pages else 0,
+        }
 
 
 class HugePagesMemory():
@@ -279,7 +290,8 @@ class HugePagesMemory():
 
     def _malloc(self, size, align=os.sysconf('SC_PAGE_SIZE')):
         # Checks for size
-        assert (self.hugepages_size % size) == 0, 'Must be a multiple of hugepages_size'
+        assert (self.hugepages_size % size) == 0 or (size % self.hugepages_size) == 0, (
+            'Must be a multiple or a divisor of hugepages_size')
         assert (size % self.sc_page_size) == 0, 'Must be a multiple of SC_PAGE_SIZE'
 
         # Call our C extension to allocate memory
@@ -296,4 +308,4 @@ class HugePagesMemory():
         # Free all memory
         for vaddr, size in self.allocated_memory:
             hugepages.free(vaddr)
-            self.allocated_memory.remove((vaddr, size))
+        self.allocated_memory = []
@@ -7,6 +7,7 @@ import subprocess
 import pathlib
 import pyudev
 import mmap
+import select
 
 from lone.system import SysPciUserspace, SysPciUserspaceDevice
 from lone.nvme.spec.registers.pcie_regs import (PCIeRegisters,
@@ -235,6 +236,14 @@ class SysVfioIfc(SysPciUserspaceDevice):
         self.device_path = device_path
         self.eventfds = []
 
+        # epoll instance with all MSI-X eventfds registered, and the vector for
+        #  each eventfd, keys = eventfd, values = vector
+        self.epoll = None
+        self.eventfd_vectors = {}
+
+        # Config space register classes, made on the first pci_regs call
+        self.pci_regs_type = None
+
         if init:
             self.initialize()
 
@@ -356,13 +365,34 @@ class SysVfioIfc(SysPciUserspaceDevice):
         req.index = VfioIoctl.VFIO_PCI_MSIX_IRQ_INDEX
         req.start = start_vector
 
+        if self.epoll is None:
+            self.epoll = select.epoll()
+
         for i in range(num_vectors):
             eventfd = os.eventfd(0, flags=os.EFD_NONBLOCK)
             req.data[i] = eventfd
             self.eventfds.append(eventfd)
+            self.eventfd_vectors[eventfd] = start_vector + i
+            self.epoll.register(eventfd, select.EPOLLIN)
 
         req.ioctl(self.device_fd)
 
+    def wait_msix_vectors(self, timeout_s=None):
+        ''' Blocks until at least one MSI-X vector fires, or timeout_s passes (forever
+              if None). Returns a list of the vectors that fired, clearing them.
+        '''
+        assert self.epoll is not None, 'MSI-X not enabled on {}, no vectors to wait for'.format(
+            self.pci_slot)
+
+        vectors = []
+        for eventfd, events in self.epoll.poll(-1 if timeout_s is None else timeout_s):
+            try:
+                os.read(eventfd, 8)
+            except BlockingIOError:
+                continue
+            vectors.append(self.eventfd_vectors[eventfd])
+        return vectors
+
     def get_msix_vector_pending_count(self, vector):
         try:
             count = int.from_bytes(os.read(self.eventfds[vector], 8), 'little')
@@ -370,25 +400,33 @@ class SysVfioIfc(SysPciUserspaceDevice):
             count = 0
         return count
 
-    def pcie_get(self, offset):
-        data = os.pread(self.device_fd, 1, self.pci_region['offset'] + offset)
-        return int.from_bytes(data, 'little')
+    def pcie_get(self, offset, size):
+        ''' Reads size bytes of config space at offset with a single pread, so
+              registers are accessed at their natural width
+        '''
+        return os.pread(self.device_fd, size, self.pci_region['offset'] + offset)
 
-    def pcie_set(self, offset, value):
+    def pcie_set(self, offset, data):
+        ''' Writes data to config space at offset with a single pwrite
+        '''
         assert os.pwrite(self.device_fd,
-                         value.to_bytes(1, 'little'),
-                         self.pci_region['offset'] + offset)
+                         data,
+                         self.pci_region['offset'] + offset) == len(data)
 
     def pci_regs(self):
 
-        class PCIeRegistersVFIO(pcie_reg_struct_factory(PCIeAccessData(self.pcie_get,
-                                                                       self.pcie_set,
-                                                                       None,
-                                                                       None)),
-                                PCIeRegisters):
-            direct = False
-
-        return PCIeRegistersVFIO()
+        # The classes are kept with this object, not in a module level cache, so they
+        #  (and the device fd their access functions use) go away with it
+        if self.pci_regs_type is None:
+            class PCIeRegistersVFIO(pcie_reg_struct_factory(PCIeAccessData(self.pcie_get,
+                                                                           self.pcie_set,
+                                                                           None,
+                                                                           None)),
+                                    PCIeRegisters):
+                direct = False
+            self.pci_regs_type = PCIeRegistersVFIO
+
+        return self.pci_regs_type()
 
     def nvme_regs(self):
         self.nvme_mmap = mmap.mmap(self.device_fd,
@@ -0,0 +1,103 @@
+''' Address space allocator
+'''
+import bisect
+
+
+class AddressRangeMgr:
+    ''' Assigns addresses (IOVAs, or vaddrs in a region) out of a set of ranges.
+        Free space is kept as non-overlapping [start, end) intervals, indexed
+        both by start address (to coalesce on free) and by size (to find the
+        smallest interval that fits on get).
+        Both indexes are sorted lists: finding an interval is a bisect, O(log n), but
+        adding or removing one shifts the lists, O(n) in the number of free intervals
+        (a memmove, which stays cheap for the few intervals we usually have).
+    '''
+    def __init__(self, ranges, align=4096):
+        # ranges is a list of (start, stop) tuples for addresses, stop included
+        self.ranges = ranges
+        self.align = align
+
+        # Reset ourselves at init
+        self.reset()
+
+    def reset(self):
+        # Free intervals, sorted by start, with keys = start, values = end
+        self.free_starts = []
+        self.free_ends = {}
+
+        # Free intervals sorted by (size, start)
+        self.free_sizes = []
+
+        # Allocated addresses, keys = address, values = size
+        self.allocated = {}
+
+        for start, stop in self.ranges:
+            # 0 is not really that great for an address when debugging
+            if start == 0:
+                start = 0x0001000
+            start = self.align_up(start, self.align)
+            if start <= stop:
+                self._add_free(start, stop + 1)
+        assert len(self.free_starts) != 0, 'Invalid address range'
+
+    @staticmethod
+    def align_up(value, align):
+        return (value + align - 1) & ~(align - 1)
+
+    def _add_free(self, start, end):
+        bisect.insort(self.free_starts, start)
+        self.free_ends[start] = end
+        bisect.insort(self.free_sizes, (end - start, start))
+
+    def _remove_free(self, start):
+        end = self.free_ends.pop(start)
+        del self.free_starts[bisect.bisect_left(self.free_starts, start)]
+        del self.free_sizes[bisect.bisect_left(self.free_sizes, (end - start, start))]
+        return end
+
+    def num_allocated(self):
+        return len(self.allocated)
+
+    def get(self, size, align=None):
+        ''' Returns an address for size bytes aligned to align (defaults to the
+              manager's alignment). size is rounded up to the alignment.
+        '''
+        align = self.align if align is None else align
+        size = self.align_up(size, self.align)
+
+        # Smallest free interval that can hold size, then the next ones if the
+        #  alignment does not fit in it
+        index = bisect.bisect_left(self.free_sizes, (size, 0))
+        for index in range(index, len(self.free_sizes)):
+            free_size, start = self.free_sizes[index]
+            address = self.align_up(start, align)
+            if address + size <= start + free_size:
+                break
+        else:
+            raise MemoryError('Not able to find an address for size {}'.format(size))
+
+        # Take it out, and give back what is left before and after it
+        end = self._remove_free(start)
+        if address > start:
+            self._add_free(start, address)
+        if address + size < end:
+            self._add_free(address + size, end)
+
+        self.allocated[address] = size
+        return address
+
+    def free(self, address):
+        size = self.allocated.pop(address)
+        start, end = address, address + size
+
+        # Coalesce with the free intervals right before and after it
+        index = bisect.bisect_left(self.free_starts, start)
+        if index > 0:
+            prev_start = self.free_starts[index - 1]
+            if self.free_ends[prev_start] == start:
+                self._remove_free(prev_start)
+                start = prev_start
+        if end in self.free_ends:
+            end = self._remove_free(end)
+
+        self._add_free(start, end)
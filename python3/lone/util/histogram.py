@@ -0,0 +1,115 @@
+import math
+import bisect
+import itertools
+
+
+class LatencyHistogram:
+    ''' HDR style log-linear histogram for integer values (for example latencies in ns).
+          Values are grouped by their power of 2, and each group is split linearly in
+          2 ** sub_bucket_bits buckets, so values are kept with a relative error below
+          1 / 2 ** sub_bucket_bits no matter how large they are.
+        Counts are kept in a flat list indexed by bucket, so histograms with the same
+          sub_bucket_bits are merged by adding their counts. Histograms only hold ints
+          and lists, so they can be pickled to merge them across processes.
+    '''
+    def __init__(self, sub_bucket_bits=7):
+        self.sub_bucket_bits = sub_bucket_bits
+        self.sub_bucket_count = 1 << sub_bucket_bits
+        self.reset()
+
+    def reset(self):
+        # Counts for each bucket, grown as larger values are recorded
+        self.counts = [0] * (2 * self.sub_bucket_count)
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def bucket_index(self, value):
+        ''' Returns the index of the bucket value is counted in
+        '''
+        shift = value.bit_length() - self.sub_bucket_bits - 1
+        if shift <= 0:
+            return value
+        return (shift * self.sub_bucket_count) + (value >> shift)
+
+    def bucket_range(self, index):
+        ''' Returns the (lowest, highest) values counted in the bucket at index
+        '''
+        shift = max(0, (index // self.sub_bucket_count) - 1)
+        low = (index - (shift * self.sub_bucket_count)) << shift
+        return low, low + (1 << shift) - 1
+
+    def record(self, value, count=1):
+        assert value >= 0, 'Invalid value {}'.format(value)
+
+        index = self.bucket_index(value)
+        if index >= len(self.counts):
+            self.counts.extend([0] * (index + 1 - len(self.counts)))
+        self.counts[index] += count
+
+        self.count += count
+        self.total += value * count
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        ''' Adds the values recorded in other to this histogram
+        '''
+        assert other.sub_bucket_bits == self.sub_bucket_bits, (
+            'Cannot merge histograms with different sub_bucket_bits')
+
+        if len(other.counts) > len(self.counts):
+            self.counts.extend([0] * (len(other.counts) - len(self.counts)))
+        for index, count in enumerate(other.counts):
+            if count:
+                self.counts[index] += count
+
+        self.count += other.count
+        self.total += other.total
+        if other.min is not None and (self.min is None or other.min < self.min):
+            self.min = other.min
+        if other.max is not None and (self.max is None or other.max > self.max):
+            self.max = other.max
+
+    def snapshot(self):
+        ''' Returns a copy of the histogram
+        '''
+        histogram = LatencyHistogram(self.sub_bucket_bits)
+        histogram.merge(self)
+        return histogram
+
+    def percentile(self, percent):
+        ''' Returns the value at percent (0 to 100) of the recorded values. This is the
+              highest value in the bucket that holds it, limited to the max recorded
+        '''
+        if self.count == 0:
+            return None
+
+        # First bucket where the running count gets to the value we want
+        target = max(1, math.ceil(self.count * percent / 100))
+        index = bisect.bisect_left(list(itertools.accumulate(self.counts)), target)
+        return min(self.bucket_range(index)[1], self.max)
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else None
+
+    def summary(self):
+        ''' Returns a dictionary with count, min, max, mean and tail percentiles
+        '''
+        return {
+            'count': self.count,
+            'min': self.min,
+            'max': self.max,
+            'mean': self.mean,
+            'p50': self.percentile(50),
+            'p99': self.percentile(99),
+            'p99.9': self.percentile(99.9),
+            'p99.99': self.percentile(99.99),
+        }
+
+    def __str__(self):
+        return ' '.join('{}: {}'.format(k, v) for k, v in self.summary().items())
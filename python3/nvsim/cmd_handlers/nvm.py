@@ -1,5 +1,6 @@
 from lone.nvme.spec.commands.status_codes import status_codes
 from lone.nvme.spec.prp import PRP
+from lone.nvme.spec.sgl import SGL
 from lone.nvme.spec.commands.nvm.read import Read
 from lone.nvme.spec.commands.nvm.write import Write
 from lone.nvme.spec.commands.nvm.flush import Flush
@@ -25,10 +26,14 @@ class NVSimWrite(NVSimCmdHandlerInterface):
             status_code = status_codes['LBA Out of Range']
 
         else:
-            # Make a PRP object from the command's information
-            prp = PRP(None, (wr_cmd.NLB + 1) * ns.block_size, nvsim.config.mps, None,
-                      'NVSimWrite', alloc=False).from_address(wr_cmd.DPTR.PRP.PRP1,
-                                                              wr_cmd.DPTR.PRP.PRP2)
+            # Make a PRP or SGL object from the command's information
+            if wr_cmd.PSDT == 0:
+                prp = PRP(None, (wr_cmd.NLB + 1) * ns.block_size, nvsim.config.mps, None,
+                          'NVSimWrite', alloc=False).from_address(wr_cmd.DPTR.PRP.PRP1,
+                                                                  wr_cmd.DPTR.PRP.PRP2)
+            else:
+                prp = SGL(None, (wr_cmd.NLB + 1) * ns.block_size, nvsim.config.mps, None,
+                          'NVSimWrite', alloc=False).from_address(wr_cmd.DPTR.SGL.SGL1)
 
             # Write data to nvsim's storage
             ns.write(wr_cmd.SLBA, wr_cmd.NLB + 1, prp)
@@ -56,10 +61,14 @@ class NVSimRead(NVSimCmdHandlerInterface):
 
         else:
 
-            # Make a PRP object from the command's information
-            prp = PRP(None, (rd_cmd.NLB + 1) * ns.block_size, nvsim.config.mps, None,
-                      'NVSimRead', alloc=False).from_address(rd_cmd.DPTR.PRP.PRP1,
-                                                             rd_cmd.DPTR.PRP.PRP2)
+            # Make a PRP or SGL object from the command's information
+            if rd_cmd.PSDT == 0:
+                prp = PRP(None, (rd_cmd.NLB + 1) * ns.block_size, nvsim.config.mps, None,
+                          'NVSimRead', alloc=False).from_address(rd_cmd.DPTR.PRP.PRP1,
+                                                                 rd_cmd.DPTR.PRP.PRP2)
+            else:
+                prp = SGL(None, (rd_cmd.NLB + 1) * ns.block_size, nvsim.config.mps, None,
+                          'NVSimRead', alloc=False).from_address(rd_cmd.DPTR.SGL.SGL1)
 
             # Read data from nvsim's storage
             ns.read(rd_cmd.SLBA, rd_cmd.NLB + 1, prp)
@@ -1,28 +1,59 @@
 import ctypes
+import mmap
 
 from lone.system import DevMemMgr, MemoryLocation
+from lone.util.address_mgr import AddressRangeMgr
 
 
 class SimMemMgr(DevMemMgr):
-    ''' Simulated memory implemenation
+    ''' Simulated memory implemenation. Memory is carved out of arenas of shared
+          anonymous mmaps, so processes forked after the allocation (see
+          lone.nvme.device.multiproc) access the same memory, at the same address
     '''
-    def __init__(self, page_size):
+    fork_shared = True
+
+    def __init__(self, page_size, arena_size=64 * 1024 * 1024):
         ''' Initializes a memory manager
         '''
         self.page_size = page_size
+        self.arena_size = arena_size
         self._allocated_mem_list = []
 
-    def malloc(self, size, direction, client=None):
-        memory_obj = (ctypes.c_uint8 * size)()
+        # (ctypes array over the mmap, manager giving out vaddrs in it) for each arena
+        self.arenas = []
+
+    def _add_arena(self, size):
+        size = max(self.arena_size, AddressRangeMgr.align_up(size, self.page_size))
+        arena = (ctypes.c_uint8 * size).from_buffer(mmap.mmap(-1, size))
+        vaddr = ctypes.addressof(arena)
+        self.arenas.append((arena, AddressRangeMgr([(vaddr, vaddr + size - 1)],
+                                                   self.page_size)))
+        return self.arenas[-1]
+
+    def _find_arena(self, vaddr):
+        for arena, vaddr_mgr in self.arenas:
+            if ctypes.addressof(arena) <= vaddr < ctypes.addressof(arena) + len(arena):
+                return arena, vaddr_mgr
 
-        # Append to our list so it stays allocated until we choose to free it
-        vaddr = ctypes.addressof(memory_obj)
+    def malloc(self, size, direction, client=None):
+        # Look for room in the arenas we have, adding one if there is not
+        for arena, vaddr_mgr in self.arenas:
+            try:
+                vaddr = vaddr_mgr.get(size)
+                break
+            except MemoryError:
+                pass
+        else:
+            arena, vaddr_mgr = self._add_arena(size)
+            vaddr = vaddr_mgr.get(size)
 
         # Create the memory location object from the allocated memory above
         #   Since both the simulator and test software are using memory as a
         #   user space application, vaddr == iova
         mem = MemoryLocation(vaddr, vaddr, size, client)
-        mem.mem_obj = memory_obj
+
+        # Keeps the arena allocated for as long as the memory is around
+        mem.mem_obj = arena
         self._allocated_mem_list.append(mem)
 
         return mem
@@ -30,16 +61,22 @@ class SimMemMgr(DevMemMgr):
     def malloc_pages(self, num_pages, client=None):
         pages = []
         for page_idx in range(num_pages):
-            pages.append(self.malloc(self.page_size))
+            pages.append(self.malloc(self.page_size, None, client))
         return pages
 
     def free(self, memory):
-        for m in self._allocated_mem_list:
-            if m == memory:
-                self._allocated_mem_list.remove(m)
+        if memory not in self._allocated_mem_list:
+            return
+        self._allocated_mem_list.remove(memory)
+
+        # Memory is zeroed when freed, so it is always zeroed when allocated
+        ctypes.memset(memory.vaddr, 0, memory.size)
+        self._find_arena(memory.vaddr)[1].free(memory.vaddr)
 
     def free_all(self):
-        self._allocated_mem_list = []
+        for memory in self._allocated_mem_list.copy():
+            self.free(memory)
+        self.free_all_count += 1
 
     def allocated_mem_list(self):
         return self._allocated_mem_list
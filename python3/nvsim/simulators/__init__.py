@@ -10,9 +10,9 @@ class NVSimInterface(metaclass=abc.ABCMeta):
         raise NotImplementedError('not implemented')
 
     @abc.abstractmethod
-    def nvsim_pcie_regs_changed(self, old_pcie_regs, new_pcie_regs):
+    def nvsim_pcie_regs_changed(self):
         raise NotImplementedError('not implemented')
 
     @abc.abstractmethod
-    def nvsim_nvme_regs_changed(self, old_nvme_regs, new_nvme_regs):
+    def nvsim_nvme_regs_changed(self):
         raise NotImplementedError('not implemented')
@@ -1,6 +1,8 @@
+import os
 import ctypes
 import mmap
-import copy
+import threading
+from collections import deque
 
 from lone.system import MemoryLocation
 from lone.nvme.device import NVMeDeviceCommon
@@ -202,6 +204,9 @@ class GenericNVMeNVSimConfig:
         self.id_ctrl_data.SN = b'EDDAE771'
         self.id_ctrl_data.FR = b'0.001'
 
+        # SGLs supported for NVM commands, no alignment requirements
+        self.id_ctrl_data.SGLS = 0x1
+
         # Current power state, start with 0
         self.power_state = 0
 
@@ -320,31 +325,57 @@ class GenericNVMeNVSim(NVSimInterface):
         # Create our thread, but dont start it until requested
         self.thread = NVSimThread(self)
 
+        # Commands are checked by the simulator thread and by threads posting commands,
+        #  the controller only handles them from one of those at a time
+        self.cmd_lock = threading.Lock()
+
         # Create the object to access PCIe registers
         class PCIeRegistersSimDirect(pcie_reg_struct_factory(
                                      PCIeAccessData(None,
                                                     None,
                                                     None,
-                                                    self.thread.pcie_changed)), PCIeRegisters):
+                                                    self.pcie_reg_written)), PCIeRegisters):
             direct = True
         self.pcie_regs = PCIeRegistersSimDirect()
+        self.pcie_regs_address = ctypes.addressof(self.pcie_regs)
+
+        # Offset of the PCI Express capability's PXDC, found once the config has
+        #   initialized our capabilities
+        self.pxdc_offset = None
 
         # Create the object to access NVMe registers
         class NVMeRegistersSimDirect(nvme_reg_struct_factory(
                                      NVMeAccessData(None,
                                                     None,
                                                     None,
-                                                    self.thread.nvme_changed))):
+                                                    self.nvme_reg_written))):
             pass
-        self.nvme_regs = NVMeRegistersSimDirect()
+        # Registers (and doorbells in them) are in shared memory, so processes forked
+        #  after the simulator starts can ring doorbells too
+        self.nvme_regs_mem = mmap.mmap(-1, ctypes.sizeof(NVMeRegistersSimDirect))
+        self.nvme_regs = NVMeRegistersSimDirect.from_buffer(self.nvme_regs_mem)
+        self.nvme_regs_address = ctypes.addressof(self.nvme_regs)
+
+        # NVMe registers we act on when written, by the offset of each of their bytes.
+        #   Any offset from the first doorbell on is a doorbell
+        self.nvme_reg_offsets = {}
+        for name in ['CC', 'AQA', 'ASQ', 'ACQ']:
+            field = getattr(NVMeRegistersSimDirect, name)
+            self.nvme_reg_offsets.update(dict.fromkeys(
+                range(field.offset, field.offset + field.size), name))
+        self.doorbells_offset = NVMeRegistersSimDirect.SQNDBS.offset
+
+        # (name, CC.EN) for the registers written since the simulator thread last looked
+        self.nvme_regs_written = deque()
 
         # Initialize config (and internal states) for the simulated device
         self.config = self.config_type(self.pcie_regs, self.nvme_regs)
 
-        # After the config which initializes the registers make sure to
-        #  save a copy of them before we get called with changes
-        self.old_pcie_regs = copy.deepcopy(self.pcie_regs)
-        self.old_nvme_regs = copy.deepcopy(self.nvme_regs)
+        express = self.pcie_regs.get_capability(self.pcie_regs.PCICapExpress._cap_id_)
+        self.pxdc_offset = ctypes.addressof(express.PXDC) - self.pcie_regs_address
+
+        # CC.EN as of the last CC write we handled, to find enable/disable transitions
+        self.cc_en = self.nvme_regs.CC.EN
 
         # Clear reset flag
         self.reset = False
@@ -368,44 +399,83 @@ class GenericNVMeNVSim(NVSimInterface):
         # Set CFS on simulator exceptions so calling code can stop early
         self.nvme_regs.CSTS.CFS = 1
 
-    def nvsim_pcie_regs_changed(self):
-        # PCIe register changes handled here
+    @staticmethod
+    def reg_offset(regs_address, register, name):
+        ''' Returns the offset, in registers at regs_address, of field name in register
+        '''
+        offset = ctypes.addressof(register) - regs_address
+
+        # Registers written as a whole are a field of their parent
+        if name in type(register).field_table():
+            offset += getattr(type(register), name).offset
+        return offset
+
+    def pcie_reg_written(self, register, name):
+        # set_notify for our PCIe registers. FLR is the only change we act on, so only
+        #   PXDC writes wake up the simulator thread
+        if self.reg_offset(self.pcie_regs_address, register, name) == self.pxdc_offset:
+            self.thread.pcie_changed()
+
+    def nvme_reg_written(self, register, name):
+        # set_notify for our NVMe registers. Only writes to registers we act on (see
+        #   nvsim_nvme_regs_changed) wake up the simulator thread
+        offset = self.reg_offset(self.nvme_regs_address, register, name)
+        if offset >= self.doorbells_offset:
+            self.nvme_regs_written.append(('DB', None))
+        elif offset in self.nvme_reg_offsets:
+            # CC.EN is saved as written, the thread may only get to it after later writes
+            reg_name = self.nvme_reg_offsets[offset]
+            self.nvme_regs_written.append(
+                (reg_name, self.nvme_regs.CC.EN if reg_name == 'CC' else None))
+        else:
+            return
+        self.thread.nvme_changed()
 
-        # First check capabilitiers changed
-        for old_cap, new_cap in zip(self.old_pcie_regs.capabilities, self.pcie_regs.capabilities):
-            if old_cap != new_cap:
-                if type(new_cap) is self.pcie_regs.PCICapExpress:
-                    if old_cap.PXDC.IFLR == 0 and new_cap.PXDC.IFLR == 1:
-                        logger.debug('Initiate FLR requested!')
-                        self.config = self.config_type(self.pcie_regs, self.nvme_regs)
-                        break
+    def nvsim_pcie_regs_changed(self):
+        # PCIe register changes handled here, we only get called for PXDC writes
 
-        self.old_pcie_regs = copy.deepcopy(self.pcie_regs)
+        express = self.pcie_regs.get_capability(self.pcie_regs.PCICapExpress._cap_id_)
+        if express.PXDC.IFLR == 1:
+            logger.debug('Initiate FLR requested!')
+            self.config = self.config_type(self.pcie_regs, self.nvme_regs)
 
-        # Then check all other registers
-        #  Nothing here yet!
+            # Registers were reset along with the config, CC.EN included
+            self.cc_en = self.nvme_regs.CC.EN
 
     def nvsim_nvme_regs_changed(self):
         # Nvme register changes handled here
 
-        # Did we just transition from not enabled to enabled?
-        if (self.old_nvme_regs.CC.EN == 0 and self.nvme_regs.CC.EN == 1):
-            # Call nvsim_enable simulator interface
-            self.enable()
+        # Registers written since we last looked, in the order they were written
+        doorbell_written = False
+        while len(self.nvme_regs_written):
+            name, cc_en = self.nvme_regs_written.popleft()
+
+            if name == 'DB':
+                doorbell_written = True
+
+            elif name == 'CC':
+                # Did we just transition from not enabled to enabled?
+                if self.cc_en == 0 and cc_en == 1:
+                    # Call nvsim_enable simulator interface
+                    self.enable()
+
+                # Did we just transition from enabled to not enabled?
+                elif self.cc_en == 1 and cc_en == 0:
+                    # Call nvsim_disable simulator interface
+                    self.disable()
 
-        # Did we just transition from enabled to not enabled?
-        if (self.old_nvme_regs.CC.EN == 1 and
-                self.nvme_regs.CC.EN == 0):
-            # Call nvsim_disable simulator interface
-            self.disable()
+                self.cc_en = cc_en
 
-        # If we are ready go check for commands
-        if self.nvme_regs.CSTS.RDY == 1:
+            # Admin queue registers are only used when enabling
+            elif self.cc_en == 1:
+                logger.warning('{} written while enabled, ignored until the next enable'.format(
+                    name))
+
+        # If we are ready and a doorbell was written go check for commands
+        if doorbell_written and self.nvme_regs.CSTS.RDY == 1:
             # Check for commands
             self.check_commands()
 
-        self.old_nvme_regs = copy.deepcopy(self.nvme_regs)
-
     @staticmethod
     def check_mem_access(mem):
         ''' Tries to access mem. If this is not successful, then you will see a segfault
@@ -463,6 +533,10 @@ class GenericNVMeNVSim(NVSimInterface):
         logger.debug('GenericNVMeNVSimDevice ready (CSTS.RDY = 1)!')
 
     def check_commands(self):
+        with self.cmd_lock:
+            self._check_commands()
+
+    def _check_commands(self):
 
         # First get all admin commands and handle them (ASQ has highest priority)
         asq, acq = self.config.queue_mgr.get(0, 0)
@@ -493,6 +567,7 @@ class GenericNVMeNVSimDevice(NVMeDeviceCommon):
     def __init__(self):
         self.sim_thread = GenericNVMeNVSim()
         self.sim_thread.start()
+        self.sim_pid = os.getpid()
 
         # Get our registers from the simulator thread
         pcie_regs = self.sim_thread.pcie_regs
@@ -508,7 +583,10 @@ class GenericNVMeNVSimDevice(NVMeDeviceCommon):
         super().__init__('nvsim', pcie_regs, nvme_regs, mem_mgr)
 
     def posted_command(self):
-        self.sim_thread.check_commands()
+        # Only the process running the simulator can handle commands. Processes forked
+        #  from it rely on it calling this while they post commands
+        if os.getpid() == self.sim_pid:
+            self.sim_thread.check_commands()
 
     def __del__(self):
         # Wait until the sim device is gc'd to stop the thread
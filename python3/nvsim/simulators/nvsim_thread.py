@@ -42,13 +42,15 @@ class NVSimThread(threading.Thread):
         while True:
             try:
                 # Call interfaces, checking for exceptions
+                # Events are cleared first, so changes made while the interfaces run
+                #  are not missed
                 if self.pcie_regs_event.is_set():
-                    self.ifc_pcie_changed()
                     self.pcie_regs_event.clear()
+                    self.ifc_pcie_changed()
 
                 if self.nvme_regs_event.is_set():
-                    self.ifc_nvme_changed()
                     self.nvme_regs_event.clear()
+                    self.ifc_nvme_changed()
 
             except Exception as e:
                 # If the simulator code sees an exception while handling changes we
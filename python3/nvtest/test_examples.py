@@ -190,3 +190,218 @@ def test_nvme_device(nvme_device, lone_config):
 
     # Make sure the device disabled correctly
     assert nvme_device.nvme_regs.CSTS.RDY == 0
+
+
+def test_nvme_device_sgl(nvme_device, lone_config):
+    # Commands can also describe their data with a SGL instead of PRPs, if the device
+    #  supports it. A SGL can describe each contiguous block of data with a single
+    #  descriptor, no matter how large it is
+    from lone.nvme.spec.commands.nvm.write import Write
+    from lone.nvme.spec.commands.nvm.read import Read
+    from lone.nvme.spec.commands.admin.identify import IdentifyController
+    from lone.nvme.spec.sgl import SGL
+    from lone.system import DMADirection
+
+    nvme_device.id_data.initialize()
+    if not nvme_device.sgls_supported():
+        pytest.skip('Device does not support SGLs')
+
+    nsid = lone_config['dut']['namespaces'][0]['nsid']
+    ns = nvme_device.id_data.namespaces[nsid]
+    xfer_len = 1024 * 1024
+    nlb = (xfer_len // ns.lba_ds_bytes) - 1
+
+    # Split the data in 64KiB blocks so the SGL needs a segment with their descriptors
+    write_sgl = SGL(nvme_device.mem_mgr, xfer_len, nvme_device.mps,
+                    DMADirection.HOST_TO_DEVICE, 'test_example sgl write',
+                    max_block_bytes=64 * 1024)
+    write_sgl.set_data_buffer(bytes(range(256)) * (xfer_len // 256))
+
+    # PSDT = 1 tells the device DPTR is a SGL
+    write_cmd = Write(SLBA=0, NLB=nlb, NSID=nsid, PSDT=1)
+    write_cmd.DPTR.SGL.SGL1 = write_sgl.sgl1
+    nvme_device.sync_cmd(write_cmd)
+
+    # nvme_device.use_sgls makes alloc create SGLs for commands
+    nvme_device.use_sgls = True
+    read_cmd = Read(SLBA=0, NLB=nlb, NSID=nsid)
+    nvme_device.alloc(read_cmd, bytes_per_block=ns.lba_ds_bytes)
+    assert read_cmd.PSDT == 1
+    nvme_device.sync_cmd(read_cmd)
+    assert read_cmd.prp.get_data_buffer() == write_sgl.get_data_buffer()
+
+    # Admin commands still use PRPs
+    id_ctrl_cmd = IdentifyController()
+    nvme_device.alloc(id_ctrl_cmd)
+    assert id_ctrl_cmd.PSDT == 0
+    nvme_device.sync_cmd(id_ctrl_cmd)
+
+    nvme_device.cc_disable()
+    nvme_device.mem_mgr.free_all()
+
+
+def test_nvme_device_command_pool(nvme_device, lone_config):
+    # A CommandPool hands out pre-initialized commands of one type, instead of creating
+    #  a new one for every command. Commands are put back once their results were read
+    from lone.nvme.spec.commands.admin.identify import IdentifyController
+    from lone.nvme.spec.structures import CommandPool
+
+    unpooled = IdentifyController()
+    nvme_device.alloc(unpooled)
+    nvme_device.sync_cmd(unpooled)
+
+    pool = CommandPool(IdentifyController, 2)
+    for i in range(4):
+        id_ctrl_cmd = pool.get()
+        nvme_device.alloc(id_ctrl_cmd)
+        nvme_device.sync_cmd(id_ctrl_cmd)
+        assert bytes(id_ctrl_cmd.data_in.MN) == bytes(unpooled.data_in.MN)
+        pool.put(id_ctrl_cmd)
+    assert pool.num_created == 2
+
+    nvme_device.cc_disable()
+    nvme_device.mem_mgr.free_all()
+
+
+def test_nvme_device_async(nvme_device, lone_config):
+    # NVMeDeviceAsync lets coroutines send commands with await submit(command). With
+    #  nvsim (or a polling device) a task polls for completions, with MSI-X interrupts
+    #  completions are reaped when the event loop sees the interrupt
+    import asyncio
+    from lone.nvme.device.aio import NVMeDeviceAsync
+    from lone.nvme.spec.commands.nvm.write import Write
+    from lone.nvme.spec.commands.nvm.read import Read
+    from lone.nvme.spec.commands.admin.identify import IdentifyController
+
+    nvme_device.id_data.initialize()
+    nsid = lone_config['dut']['namespaces'][0]['nsid']
+    ns = nvme_device.id_data.namespaces[nsid]
+    block_size = ns.lba_ds_bytes
+
+    async def write_read(aio, slba):
+        write_cmd = Write(SLBA=slba, NLB=0, NSID=nsid)
+        nvme_device.alloc(write_cmd, bytes_per_block=block_size)
+        write_cmd.prp.set_data_buffer(bytes([slba & 0xFF] * block_size))
+        await aio.submit(write_cmd)
+
+        read_cmd = Read(SLBA=slba, NLB=0, NSID=nsid)
+        nvme_device.alloc(read_cmd, bytes_per_block=block_size)
+        await aio.submit(read_cmd)
+        assert read_cmd.prp.get_data_buffer() == write_cmd.prp.get_data_buffer()
+
+    async def main():
+        aio = NVMeDeviceAsync(nvme_device)
+
+        # IO on many LBAs concurrently, mixed with an admin command
+        id_ctrl_cmd = IdentifyController()
+        nvme_device.alloc(id_ctrl_cmd)
+        await asyncio.gather(aio.submit(id_ctrl_cmd),
+                             *[write_read(aio, slba) for slba in range(32)])
+        assert id_ctrl_cmd.data_in.MN == nvme_device.id_data.controller.MN
+        aio.close()
+
+    asyncio.run(main())
+
+    nvme_device.cc_disable()
+    nvme_device.mem_mgr.free_all()
+
+
+def test_nvme_device_workers(nvme_device, lone_config):
+    # NVMeDeviceWorkers starts a thread for each IO queue pair. Each thread is the only
+    #  one using its queue pair, and commands are handed to them from any thread
+    import threading
+    from lone.nvme.device.workers import NVMeDeviceWorkers
+    from lone.nvme.spec.commands.nvm.write import Write
+    from lone.nvme.spec.commands.nvm.read import Read
+
+    nvme_device.id_data.initialize()
+    nsid = lone_config['dut']['namespaces'][0]['nsid']
+    ns = nvme_device.id_data.namespaces[nsid]
+    block_size = ns.lba_ds_bytes
+
+    # Allocate all commands up front, memory is not handed between threads
+    writes = []
+    for slba in range(64):
+        write_cmd = Write(SLBA=slba, NLB=0, NSID=nsid)
+        nvme_device.alloc(write_cmd, bytes_per_block=block_size)
+        write_cmd.prp.set_data_buffer(bytes([slba & 0xFF] * block_size))
+        writes.append(write_cmd)
+    reads = []
+    for slba in range(64):
+        read_cmd = Read(SLBA=slba, NLB=0, NSID=nsid)
+        nvme_device.alloc(read_cmd, bytes_per_block=block_size)
+        reads.append(read_cmd)
+
+    workers = NVMeDeviceWorkers(nvme_device, queue_depth=8)
+    workers.start()
+
+    # Submit from a few threads at the same time
+    def submitter(commands):
+        for command in commands:
+            workers.submit(command)
+
+    for commands in [writes, reads]:
+        threads = [threading.Thread(target=submitter, args=(commands[i::4],)) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        workers.drain()
+
+    workers.stop()
+    assert workers.num_completed == 128
+    for write_cmd, read_cmd in zip(writes, reads):
+        assert write_cmd.cqe.SF.SC == 0 and read_cmd.cqe.SF.SC == 0
+        assert read_cmd.prp.get_data_buffer() == write_cmd.prp.get_data_buffer()
+
+    nvme_device.cc_disable()
+    nvme_device.mem_mgr.free_all()
+
+
+def test_nvme_device_processes(nvme_device, lone_config):
+    # NVMeDeviceProcesses runs a function in one process per IO queue pair, so
+    #  submission work is spread across cores. The controller (this process) owns the
+    #  device, each worker process only uses its queue pair and memory region
+    from lone.nvme.device.multiproc import NVMeDeviceProcesses
+    from lone.nvme.device.io_engine import NVMeDeviceIOEngine
+    from lone.nvme.spec.commands.nvm.write import Write
+    from lone.nvme.spec.commands.nvm.read import Read
+
+    nvme_device.id_data.initialize()
+    nsid = lone_config['dut']['namespaces'][0]['nsid']
+    ns = nvme_device.id_data.namespaces[nsid]
+    block_size = ns.lba_ds_bytes
+
+    def worker_target(worker):
+        # Each worker writes and reads back its own LBAs
+        device = worker.nvme_device
+        engine = NVMeDeviceIOEngine(device, queue_depth=8, sqids=[worker.sqid])
+
+        writes = []
+        for i in range(32):
+            write_cmd = Write(SLBA=(worker.index * 32) + i, NLB=0, NSID=nsid)
+            device.alloc(write_cmd, bytes_per_block=block_size)
+            write_cmd.prp.set_data_buffer(bytes([worker.index + 1] * block_size))
+            writes.append(write_cmd)
+        engine.submit_batch(writes)
+        engine.drain()
+
+        reads = []
+        for i in range(32):
+            read_cmd = Read(SLBA=(worker.index * 32) + i, NLB=0, NSID=nsid)
+            device.alloc(read_cmd, bytes_per_block=block_size)
+            reads.append(read_cmd)
+        engine.submit_batch(reads)
+        engine.drain()
+
+        return sum(read_cmd.cqe.SF.SC == 0 and
+                   read_cmd.prp.get_data_buffer() == bytes([worker.index + 1] * block_size)
+                   for read_cmd in reads)
+
+    procs = NVMeDeviceProcesses(nvme_device, worker_target, mem_bytes=1024 * 1024)
+    procs.start()
+    assert procs.join() == [32] * len(procs.workers)
+    procs.free()
+
+    nvme_device.cc_disable()
+    nvme_device.mem_mgr.free_all()
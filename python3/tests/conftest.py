@@ -16,6 +16,7 @@ from lone.nvme.device import NVMeDeviceCommon
 def mocked_nvme_device(mocker):
     pcie_regs = PCIeRegistersDirect()
     pcie_regs.capabilities = [PCIeRegistersDirect.PCICapExpress()]
+    pcie_regs.capability_index = {(False, 0x10): pcie_regs.capabilities[0]}
 
     nvme_regs = NVMeRegistersDirect()
 
@@ -39,7 +40,7 @@ def mocked_nvme_device(mocker):
             pass
 
         def free_all(self):
-            pass
+            self.free_all_count += 1
 
         def allocated_mem_list(self):
             return self._allocated_mem_list
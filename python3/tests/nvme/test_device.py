@@ -1,14 +1,29 @@
+import os
+import mmap
 import pytest
+import ctypes
+import time
+import pickle
+import asyncio
+import threading
 from types import SimpleNamespace
 
-from lone.system import System
+from lone.system import System, DMADirection, MemoryLocation
 from lone.nvme.spec.queues import NVMeSubmissionQueue, NVMeCompletionQueue
-from lone.nvme.device import CidMgr
+from lone.nvme.device import CidMgr, OutstandingCommands
 from lone.nvme.device import NVMeDevice, NVMeDeviceCommon, NVMeDeviceIntType, NVMeDevicePhysical
 from lone.nvme.device.identify import NVMeDeviceIdentifyData
+from lone.nvme.device.io_engine import NVMeDeviceIOEngine
+from lone.nvme.device.aio import NVMeDeviceAsync
+from lone.nvme.device.workers import NVMeQueuePairWorker, NVMeDeviceWorkers
+from lone.nvme.device.latency import NVMeLatencyStats
+from lone.nvme.device.multiproc import NVMeWorkerMemMgr, NVMeProcessWorker, NVMeDeviceProcesses
 from lone.nvme.spec.commands.admin.identify import (IdentifyNamespaceListData,
-                                                    IdentifyNamespaceData)
+                                                    IdentifyNamespaceData,
+                                                    IdentifyControllerData)
 from lone.nvme.spec.commands.status_codes import NVMeStatusCodeException
+from lone.nvme.spec.structures import ADMINCommand, NVMCommand, CQE, CommandPool, SGLDescriptor
+from lone.nvme.spec.sgl import SGL
 
 from nvsim.simulators.generic import GenericNVMeNVSimDevice
 
@@ -17,15 +32,76 @@ from nvsim.simulators.generic import GenericNVMeNVSimDevice
 # CidMgr tests
 ####################################################################################################
 def test_nvme_device_cid_mgr():
-    cid_mgr = CidMgr(init_value=0, max_value=1000)
-    assert cid_mgr.value == 0
+    cid_mgr = CidMgr(16)
+    assert cid_mgr.num_free() == 16
 
-    for i in range(1000):
+    for i in range(16):
         new_cid = cid_mgr.alloc()
         assert new_cid == i
+    assert cid_mgr.num_free() == 0
 
-    new_cid = cid_mgr.alloc()
-    assert new_cid == 0
+    # All CIDs are outstanding
+    with pytest.raises(AssertionError):
+        cid_mgr.alloc()
+
+    # Freed CIDs are reused, never one that is outstanding
+    cid_mgr.free(5)
+    cid_mgr.free(2)
+    assert cid_mgr.alloc() == 5
+    assert cid_mgr.alloc() == 2
+
+    # Double free
+    cid_mgr.free(3)
+    with pytest.raises(AssertionError):
+        cid_mgr.free(3)
+
+
+####################################################################################################
+# OutstandingCommands tests
+####################################################################################################
+def test_outstanding_commands():
+    ''' class OutstandingCommands:
+    '''
+    outstanding = OutstandingCommands()
+    outstanding.add_queue(0, 4)
+    outstanding.add_queue(1, 4)
+    assert len(outstanding) == 0
+    assert list(outstanding) == []
+
+    # CIDs are allocated per queue and index the table
+    commands = [SimpleNamespace() for i in range(4)]
+    for command in commands:
+        command.CID = outstanding.add(1, command)
+    assert [command.CID for command in commands] == [0, 1, 2, 3]
+    assert outstanding.tables[1] == commands
+    assert len(outstanding) == 4
+    assert list(outstanding) == commands
+
+    # No more CIDs in the queue
+    with pytest.raises(AssertionError):
+        outstanding.add(1, SimpleNamespace())
+
+    # Lookups
+    for command in commands:
+        assert outstanding.get(1, command.CID) is command
+    assert outstanding.get(0, 0) is None
+    assert outstanding.get(1, 9) is None
+    assert outstanding.get(2, 0) is None
+
+    # Removing frees the CID
+    assert outstanding.pop(1, 2) is commands[2]
+    assert len(outstanding) == 3
+    assert outstanding.get(1, 2) is None
+    with pytest.raises(AssertionError):
+        outstanding.pop(1, 2)
+    assert outstanding.add(1, commands[2]) == 2
+
+    # Removing a queue drops its commands
+    outstanding.add(0, commands[0])
+    outstanding.remove_queue(1)
+    assert len(outstanding) == 1
+    assert list(outstanding) == [commands[0]]
+    assert 1 not in outstanding.cid_mgrs
 
 
 ####################################################################################################
@@ -50,9 +126,8 @@ def test_nvme_device_common_init():
                                    None)
 
     # Check init values
-    assert nvme_device.cid_mgr is not None
     assert nvme_device.queue_mgr is not None
-    assert type(nvme_device.outstanding_commands) is dict
+    assert type(nvme_device.outstanding_commands) is OutstandingCommands
     assert len(nvme_device.outstanding_commands) == 0
     assert nvme_device.injectors is not None
     assert nvme_device.int_type == NVMeDeviceIntType.POLLING
@@ -63,6 +138,12 @@ def test_initate_flr(mocker, mocked_nvme_device):
     ''' def initiate_flr(self):
     '''
     mocked_nvme_device.initiate_flr()
+    assert mocked_nvme_device.pcie_regs.capabilities[0].PXDC.IFLR == 1
+
+    # Devices without a PCI Express capability cannot FLR
+    mocked_nvme_device.pcie_regs.capability_index = {}
+    with pytest.raises(AssertionError):
+        mocked_nvme_device.initiate_flr()
 
 
 def test_cc_disable(mocker, mocked_nvme_device):
@@ -271,10 +352,60 @@ def test_delete_io_queues(mocked_nvme_device):
 def test_post_command(mocked_nvme_device, mocked_admin_cmd):
     ''' def post_command(self, command):
     '''
+    mocked_nvme_device.outstanding_commands.add_queue(0, 16)
     mocked_nvme_device.post_command(mocked_admin_cmd)
     assert len(mocked_nvme_device.outstanding_commands) == 1
     assert mocked_admin_cmd.start_time_ns != 0
 
+    # Posting fails, the CID is released
+    def post_command(command):
+        assert False, 'SQ FULL!!'
+    mocked_admin_cmd.sq.post_command = post_command
+    with pytest.raises(AssertionError):
+        mocked_nvme_device.post_command(mocked_admin_cmd)
+    assert len(mocked_nvme_device.outstanding_commands) == 1
+    assert mocked_nvme_device.outstanding_commands.cid_mgrs[0].num_free() == 15
+
+
+def test_post_commands(mocked_nvme_device):
+    ''' def post_commands(self, commands):
+    '''
+    mocked_nvme_device.init_admin_queues(16, 16)
+    mocked_nvme_device.create_io_queues(1, 16)
+    sq, cq = mocked_nvme_device.queue_mgr.get(1, 1)
+
+    commands = [NVMCommand() for i in range(3)]
+    for command in commands:
+        command.sq, command.cq = sq, cq
+    mocked_nvme_device.post_commands(commands)
+
+    assert sq.tail.value == 3
+    assert len(mocked_nvme_device.outstanding_commands) == 3
+    assert len(set(command.CID for command in commands)) == 3
+    assert all(command.start_time_ns != 0 for command in commands)
+
+    # Not enough room in the SQ, the CIDs are released
+    commands = [NVMCommand() for i in range(13)]
+    for command in commands:
+        command.sq, command.cq = sq, cq
+    with pytest.raises(AssertionError):
+        mocked_nvme_device.post_commands(commands)
+    assert len(mocked_nvme_device.outstanding_commands) == 3
+    assert mocked_nvme_device.outstanding_commands.cid_mgrs[1].num_free() == 13
+
+    # More commands than free CIDs, the ones taken before running out are released
+    commands = [NVMCommand() for i in range(14)]
+    for command in commands:
+        command.sq, command.cq = sq, cq
+    with pytest.raises(AssertionError, match='No free CIDs'):
+        mocked_nvme_device.post_commands(commands)
+    assert len(mocked_nvme_device.outstanding_commands) == 3
+    assert mocked_nvme_device.outstanding_commands.cid_mgrs[1].num_free() == 13
+
+    # Nothing to post, nothing happens
+    mocked_nvme_device.post_commands([])
+    assert sq.tail.value == 3
+
 
 def test_poll_cq_completions(mocker, mocked_nvme_device):
     ''' def poll_cq_completions(self, cqids=None, max_completions=1, max_time_s=0):
@@ -327,12 +458,11 @@ def test_get_completion(mocker, mocked_nvme_device, mocked_admin_cmd):
     mocker.patch.object(cq, 'get_next_completion', lambda: SimpleNamespace(SF=SimpleNamespace(P=1),
                                                                            CID=1,
                                                                            SQID=0))
-    mocked_nvme_device.outstanding_commands = {}
     mocked_admin_cmd.posted = True
-    mocked_admin_cmd.CID = 1
     mocked_admin_cmd.SQID = 0
     mocked_nvme_device.complete_command = lambda cmd, cqe: None
-    mocked_nvme_device.outstanding_commands[(1, 0)] = mocked_admin_cmd
+    mocked_nvme_device.outstanding_commands.add(0, SimpleNamespace())
+    mocked_admin_cmd.CID = mocked_nvme_device.outstanding_commands.add(0, mocked_admin_cmd)
     assert mocked_nvme_device.get_completion(0) is True
 
     # Now with IO queues
@@ -340,17 +470,74 @@ def test_get_completion(mocker, mocked_nvme_device, mocked_admin_cmd):
     mocker.patch.object(cq, 'get_next_completion', lambda: SimpleNamespace(SF=SimpleNamespace(P=0),
                                                                            CID=1,
                                                                            SQID=1))
-    mocked_nvme_device.outstanding_commands = {}
-    mocked_nvme_device.outstanding_commands[(1, 1)] = None
     mocked_nvme_device.get_completion(1)
     assert mocked_nvme_device.get_completion(0) is False
 
 
+def test_reap_completions(mocker, mocked_nvme_device):
+    ''' def reap_completions(self, cqid, max_completions=None):
+    '''
+    mocked_nvme_device.init_admin_queues(16, 16)
+    mocked_nvme_device.create_io_queues(1, 16)
+    completed = []
+    mocked_nvme_device.complete_command = lambda cmd, cqe, consume: completed.append(cmd)
+
+    for cqid in [0, 1]:
+        sq, cq = mocked_nvme_device.queue_mgr.get(None, cqid)
+
+        # Nothing there
+        assert mocked_nvme_device.reap_completions(cqid) == 0
+
+        # Post 3 completions, and set their commands as outstanding
+        commands = []
+        for cid in range(3):
+            cqe = CQE()
+            cqe.CID, cqe.SQID = cid, sq.qid
+            cq.post_completion(cqe)
+            commands.append(SimpleNamespace(CID=cid))
+            mocked_nvme_device.outstanding_commands.add(sq.qid, commands[-1])
+
+        # Reap only 2, then the rest
+        completed.clear()
+        assert mocked_nvme_device.reap_completions(cqid, max_completions=2) == 2
+        assert cq.head.value == 2
+        assert mocked_nvme_device.reap_completions(cqid) == 1
+        assert cq.head.value == 3
+        assert completed == commands
+        assert cq.reap_counts == {2: 1, 1: 1}
+
+    # The head moves before anything is completed, so completing (callbacks) can look
+    #  for completions in the same queue without seeing these again
+    sq, cq = mocked_nvme_device.queue_mgr.get(None, 1)
+    head = cq.head.value
+    heads = []
+
+    def complete_command(cmd, cqe, consume):
+        heads.append(cq.head.value)
+        completed.append(cmd)
+        assert cmd.CID == 0, 'Callback failed for CID {}'.format(cmd.CID)
+    mocked_nvme_device.complete_command = complete_command
+
+    for cid in range(3):
+        cqe = CQE()
+        cqe.CID, cqe.SQID = cid, sq.qid
+        cq.post_completion(cqe)
+        mocked_nvme_device.outstanding_commands.add(sq.qid, SimpleNamespace(CID=cid))
+
+    # Completing some raises, the rest are still completed before raising the first
+    completed.clear()
+    with pytest.raises(AssertionError, match='Callback failed for CID 1'):
+        mocked_nvme_device.reap_completions(1)
+    assert [cmd.CID for cmd in completed] == [0, 1, 2]
+    assert heads == [head + 3] * 3
+    assert mocked_nvme_device.reap_completions(1) == 0
+
+
 def test_get_msix_completions(mocker, mocked_nvme_device):
     ''' def get_msix_completions(self, cqids=None, max_completions=1, max_time_s=0):
     '''
     mocked_nvme_device.init_admin_queues(10, 10)
-    mocked_nvme_device.get_msix_vector_pending_count = lambda x: 0
+    mocked_nvme_device.wait_msix_vectors = lambda timeout_s: []
     mocked_nvme_device.get_completion = lambda x: 0
 
     assert mocked_nvme_device.get_msix_completions() == 0
@@ -368,30 +555,103 @@ def test_get_msix_completions(mocker, mocked_nvme_device):
     assert mocked_nvme_device.get_msix_completions(0, max_time_s=0.0001) == 0
 
     # Test actually receiving completions path!
-    mocker.patch.object(mocked_nvme_device, 'get_msix_vector_pending_count', return_value=1)
-    mocker.patch.object(mocked_nvme_device, 'get_completion', side_effect=[True, True, True, False])
+    mocker.patch.object(mocked_nvme_device, 'wait_msix_vectors', return_value=[0])
+    mocker.patch.object(mocked_nvme_device, 'reap_completions', return_value=3)
     assert mocked_nvme_device.get_msix_completions(0, max_completions=3, max_time_s=1) == 3
+    assert mocked_nvme_device.msix_pending_vectors == set()
+
+    # Vectors for other queues stay pending, and do not stop us from waiting
+    mocked_nvme_device.nvme_regs.CSTS.CFS = 0
+    waits = []
+    mocked_nvme_device.wait_msix_vectors = lambda timeout_s: waits.append(timeout_s) or [5]
+    assert mocked_nvme_device.get_msix_completions(0, max_time_s=0.01) == 0
+    assert mocked_nvme_device.msix_pending_vectors == {5}
+    assert len(waits) > 1
+    assert all(0 <= t <= 0.01 for t in waits)
 
+    # Pending vectors from a previous wait are processed without waiting again
+    mocked_nvme_device.msix_pending_vectors.add(0)
+    mocked_nvme_device.wait_msix_vectors = lambda timeout_s: pytest.fail('waited')
+    assert mocked_nvme_device.get_msix_completions(0) == 3
+    assert mocked_nvme_device.msix_pending_vectors == {5}
 
-def test_complete_command(mocked_nvme_device, mocked_admin_cmd):
+
+def test_complete_command(mocked_nvme_device, mocked_admin_cmd, mocked_nvm_cmd):
     ''' def complete_command(self, command, cqe):
     '''
     mocked_admin_cmd.prp = SimpleNamespace(
         get_data_buffer=lambda: bytearray(len(mocked_admin_cmd.data_in)))
-    mocked_nvme_device.outstanding_commands[(0, 0)] = mocked_admin_cmd
+    mocked_nvme_device.outstanding_commands.add_queue(0, 16)
+    mocked_admin_cmd.CID = mocked_nvme_device.outstanding_commands.add(0, mocked_admin_cmd)
+    mocked_admin_cmd.cqe.CID = mocked_admin_cmd.CID
     mocked_admin_cmd.posted = True
     mocked_nvme_device.complete_command(mocked_admin_cmd, mocked_admin_cmd.cqe)
     assert mocked_admin_cmd.posted is False
     assert len(mocked_nvme_device.outstanding_commands) == 0
 
+    # Zero copy data in, with contiguous and not contiguous memory
+    memory = (ctypes.c_uint8 * len(mocked_admin_cmd.data_in))()
+    mocked_nvme_device.data_in_zero_copy = True
+    for data_view in [memoryview(memory).cast('B'), None]:
+        mocked_admin_cmd.prp.get_data_view = lambda: data_view
+        mocked_admin_cmd.CID = mocked_nvme_device.outstanding_commands.add(0, mocked_admin_cmd)
+        mocked_admin_cmd.cqe.CID = mocked_admin_cmd.CID
+        mocked_admin_cmd.posted = True
+        mocked_nvme_device.complete_command(mocked_admin_cmd, mocked_admin_cmd.cqe)
+        memory[0] = 0x5A
+        assert (mocked_admin_cmd.data_in.data[0] == 0x5A) is (data_view is not None)
+    mocked_nvme_device.data_in_zero_copy = False
+
     # Pretend it didnt have data in
-    mocked_nvme_device.outstanding_commands[(0, 0)] = mocked_admin_cmd
+    mocked_admin_cmd.CID = mocked_nvme_device.outstanding_commands.add(0, mocked_admin_cmd)
+    mocked_admin_cmd.cqe.CID = mocked_admin_cmd.CID
     mocked_admin_cmd.posted = True
     mocked_admin_cmd.data_in = None
     mocked_nvme_device.complete_command(mocked_admin_cmd, mocked_admin_cmd.cqe)
     assert mocked_admin_cmd.posted is False
     assert len(mocked_nvme_device.outstanding_commands) == 0
 
+    # With a callback
+    completed = []
+    mocked_admin_cmd.CID = mocked_nvme_device.outstanding_commands.add(0, mocked_admin_cmd)
+    mocked_admin_cmd.cqe.CID = mocked_admin_cmd.CID
+    mocked_admin_cmd.posted = True
+    mocked_admin_cmd.callback = completed.append
+    mocked_nvme_device.complete_command(mocked_admin_cmd, mocked_admin_cmd.cqe)
+    assert completed == [mocked_admin_cmd]
+
+    # Without consuming the completion
+    mocked_admin_cmd.CID = mocked_nvme_device.outstanding_commands.add(0, mocked_admin_cmd)
+    mocked_admin_cmd.cqe.CID = mocked_admin_cmd.CID
+    mocked_admin_cmd.posted = True
+    mocked_admin_cmd.cq = None
+    mocked_nvme_device.complete_command(mocked_admin_cmd, mocked_admin_cmd.cqe, consume=False)
+    assert mocked_admin_cmd.posted is False
+
+    # Pooled commands are left for the caller to put back, after reading the results
+    pool = CommandPool(NVMCommand, 0)
+    mocked_nvm_cmd.pool = pool
+    mocked_nvm_cmd.data_in = None
+    mocked_nvm_cmd.posted = True
+    mocked_nvme_device.outstanding_commands.add_queue(0, 16)
+    mocked_nvm_cmd.CID = mocked_nvme_device.outstanding_commands.add(0, mocked_nvm_cmd)
+    mocked_nvm_cmd.cqe.CID = mocked_nvm_cmd.CID
+    mocked_nvme_device.complete_command(mocked_nvm_cmd, mocked_nvm_cmd.cqe)
+    assert pool.free_commands == []
+    assert mocked_nvm_cmd.in_pool is False
+
+    # Latency is recorded when enabled
+    stats = mocked_nvme_device.enable_latency_stats()
+    assert mocked_nvme_device.latency_stats is stats
+    mocked_admin_cmd.CID = mocked_nvme_device.outstanding_commands.add(0, mocked_admin_cmd)
+    mocked_admin_cmd.cqe.CID = mocked_admin_cmd.CID
+    mocked_admin_cmd.posted = True
+    mocked_admin_cmd.start_time_ns = time.perf_counter_ns()
+    mocked_nvme_device.complete_command(mocked_admin_cmd, mocked_admin_cmd.cqe, consume=False)
+    histogram = stats.histograms[(0, mocked_admin_cmd.OPC)]
+    assert histogram.count == 1
+    assert histogram.max == mocked_admin_cmd.end_time_ns - mocked_admin_cmd.start_time_ns
+
 
 def test_process_completions(mocked_nvme_device):
     ''' def process_completions(self, cqids=None, max_completions=1, max_time_s=0):
@@ -445,6 +705,51 @@ def test_start_cmd(mocked_nvme_device, mocked_admin_cmd):
     assert mocked_nvme_device.start_cmd(mocked_admin_cmd) == (1, 1)
 
 
+def test_start_cmds(mocked_nvme_device):
+    ''' def start_cmds(self, commands, sqid=None, cqid=None):
+    '''
+    mocked_nvme_device.init_admin_queues(16, 16)
+    mocked_nvme_device.create_io_queues(2, 16)
+
+    # Admin commands go to the admin queue
+    commands = [ADMINCommand() for i in range(2)]
+    assert mocked_nvme_device.start_cmds(commands) == (0, 0)
+    assert all(command.posted for command in commands)
+
+    # NVM commands go to the next IO queue
+    commands = [NVMCommand() for i in range(4)]
+    sqid, cqid = mocked_nvme_device.start_cmds(commands)
+    assert sqid == cqid
+    assert all(command.sq.qid == sqid for command in commands)
+    assert mocked_nvme_device.queue_mgr.get(sqid, cqid)[0].tail.value == 4
+
+    # Specific queue
+    commands = [NVMCommand() for i in range(4)]
+    assert mocked_nvme_device.start_cmds(commands, 2, 2) == (2, 2)
+
+    # Invalid queue
+    with pytest.raises(AssertionError):
+        mocked_nvme_device.start_cmds([NVMCommand()], 3)
+
+    # Already posted or completed
+    with pytest.raises(AssertionError):
+        mocked_nvme_device.start_cmds(commands, 2, 2)
+    command = NVMCommand()
+    command.complete = True
+    with pytest.raises(AssertionError):
+        mocked_nvme_device.start_cmds([command], 2, 2)
+
+    # Still outstanding in the same queue, even if not marked as posted
+    commands[0].posted = False
+    with pytest.raises(AssertionError):
+        mocked_nvme_device.start_cmds(commands[:1], 2, 2)
+
+    # Nothing to start
+    assert mocked_nvme_device.start_cmds([]) == (None, None)
+    assert mocked_nvme_device.start_cmds([], 2, 2) == (2, 2)
+    assert mocked_nvme_device.queue_mgr.get(2, 2)[0].tail.value == 4
+
+
 def test_alloc(mocked_nvme_device, mocked_admin_cmd, mocked_nvm_cmd):
     ''' def alloc(self, command, bytes_per_block=None):
     '''
@@ -466,6 +771,38 @@ def test_alloc(mocked_nvme_device, mocked_admin_cmd, mocked_nvm_cmd):
     mocked_nvm_cmd.NLB = 0
     mocked_nvme_device.alloc(mocked_nvm_cmd, bytes_per_block=4096)
     assert mocked_nvm_cmd.prp.num_bytes == 4096
+    assert mocked_nvm_cmd.PSDT == 0
+
+    # Using SGLs, only once the controller says it supports them
+    mocked_nvme_device.use_sgls = True
+    mocked_nvm_cmd.NLB = 7
+    mocked_nvme_device.alloc(mocked_nvm_cmd, bytes_per_block=4096)
+    assert mocked_nvm_cmd.PSDT == 0
+    mocked_nvme_device.id_data.controller = IdentifyControllerData()
+    mocked_nvme_device.alloc(mocked_nvm_cmd, bytes_per_block=4096)
+    assert mocked_nvm_cmd.PSDT == 0
+    mocked_nvme_device.id_data.controller.SGLS = 0x1
+
+    # Admin commands always use PRPs
+    mocked_nvme_device.alloc(mocked_admin_cmd)
+    assert mocked_admin_cmd.PSDT == 0
+    assert type(mocked_admin_cmd.prp) is not SGL
+
+    mocked_nvme_device.alloc(mocked_nvm_cmd, bytes_per_block=4096)
+    assert type(mocked_nvm_cmd.prp) is SGL
+    assert mocked_nvm_cmd.PSDT == 1
+    assert mocked_nvm_cmd.DPTR.SGL.SGL1.TYPE == SGLDescriptor.DATA_BLOCK
+    assert mocked_nvm_cmd.DPTR.SGL.SGL1.ADDR == mocked_nvm_cmd.prp.data_mems[0].iova
+    assert mocked_nvm_cmd.DPTR.SGL.SGL1.LEN == 8 * 4096
+    mocked_nvme_device.use_sgls = False
+
+    # Contiguous PRPs
+    mocked_nvme_device.contiguous_prps = True
+    mocked_nvme_device.alloc(mocked_nvm_cmd, bytes_per_block=4096)
+    assert mocked_nvm_cmd.prp.contiguous is True
+    assert mocked_nvm_cmd.PSDT == 0
+    assert mocked_nvm_cmd.DPTR.PRP.PRP1 == mocked_nvm_cmd.prp.prp1
+    mocked_nvme_device.contiguous_prps = False
 
     mocked_nvm_cmd.__class__.__name__ = 'NotReadWrite'
     mocked_nvm_cmd.data_in_type = None
@@ -490,11 +827,11 @@ def test_nvme_device(mocker):
 # NVMeDevicePhysical tests
 ####################################################################################################
 def test_nvme_device_physical(mocker):
-    ''' def __init__(self, pci_slot):
+    ''' def __init__(self, pci_slot, premap=False):
     '''
     class MockedDevMemMgr:
-        def __init__(self, a, b, c, d, e):
-            pass
+        def __init__(self, a, b, c, d, e, f):
+            self.premap_func = f
     System.DevMemMgr = MockedDevMemMgr
 
     class MockedUserspaceDevice:
@@ -514,6 +851,9 @@ def test_nvme_device_physical(mocker):
         def map_dma_region_write(self):
             pass
 
+        def map_dma_region_rw(self):
+            pass
+
         def unmap_dma_region(self):
             pass
 
@@ -523,12 +863,20 @@ def test_nvme_device_physical(mocker):
         def get_msix_vector_pending_count(self, vector):
             return 0
 
+        def wait_msix_vectors(self, timeout_s):
+            return [timeout_s]
+
         iova_ranges = []
     System.PciUserspaceDevice = MockedUserspaceDevice
 
     # Test mocked physical device
     nvme_dev = NVMeDevicePhysical('slot')
     assert nvme_dev.mps == 4096
+    assert nvme_dev.mem_mgr.premap_func is None
+
+    # Memory premapped read/write
+    nvme_dev = NVMeDevicePhysical('slot', premap=True)
+    assert nvme_dev.mem_mgr.premap_func is not None
 
     # init_msix_interrupts(self, num_vectors, start=0)
     nvme_dev.init_msix_interrupts(10, 0)
@@ -536,6 +884,9 @@ def test_nvme_device_physical(mocker):
     # get_msix_vector_pending_count(self, vector)
     assert nvme_dev.get_msix_vector_pending_count(0) == 0
 
+    # wait_msix_vectors(self, timeout_s=None)
+    assert nvme_dev.wait_msix_vectors(1) == [1]
+
     def init_except(self, pcie_slot):
         raise Exception('testing exception')
 
@@ -653,3 +1004,683 @@ def test_identify_controller(mocked_nvme_device):
     '''
     id_data = NVMeDeviceIdentifyData(mocked_nvme_device, initialize=False)
     id_data.identify_controller()
+
+
+####################################################################################################
+# NVMeDeviceIOEngine tests
+####################################################################################################
+class MockedCompletions:
+    ''' Replaces start_cmd/start_cmds/reap_completions on a mocked device. Started
+          commands are completed (calling their callback) by reap_completions
+    '''
+    def __init__(self, nvme_device):
+        self.started = []
+        nvme_device.start_cmd = self.start_cmd
+        nvme_device.start_cmds = self.start_cmds
+        nvme_device.reap_completions = self.reap_completions
+
+    def start_cmd(self, command, sqid=None, cqid=None):
+        command.sq, command.cq = SimpleNamespace(qid=sqid), SimpleNamespace(qid=cqid)
+        self.started.append(command)
+
+    def start_cmds(self, commands, sqid=None, cqid=None):
+        for command in commands:
+            self.start_cmd(command, sqid, cqid)
+
+    def reap_completions(self, cqid, max_completions=None):
+        completed = [command for command in self.started if command.cq.qid == cqid]
+        for command in completed:
+            self.started.remove(command)
+            command.callback(command)
+        return len(completed)
+
+
+def test_io_engine_init(mocked_nvme_device):
+    ''' def __init__(self, nvme_device, queue_depth=32, sqids=None):
+    '''
+    mocked_nvme_device.init_admin_queues(2, 2)
+
+    # No IO queues
+    with pytest.raises(AssertionError):
+        NVMeDeviceIOEngine(mocked_nvme_device)
+
+    # Depth is limited by the queue size
+    mocked_nvme_device.create_io_queues(2, 4)
+    engine = NVMeDeviceIOEngine(mocked_nvme_device)
+    assert engine.sqids == [1, 2]
+    assert engine.cqids == [1, 2]
+    assert engine.sq_depth == {1: 3, 2: 3}
+    assert engine.outstanding == 0
+
+    engine = NVMeDeviceIOEngine(mocked_nvme_device, queue_depth=2, sqids=[2])
+    assert engine.sqids == [2]
+    assert engine.sq_depth == {2: 2}
+
+    # Invalid queue
+    with pytest.raises(AssertionError):
+        NVMeDeviceIOEngine(mocked_nvme_device, sqids=[3])
+
+
+def test_io_engine_next_free_sqid(mocked_nvme_device):
+    ''' def next_free_sqid(self):
+    '''
+    mocked_nvme_device.init_admin_queues(2, 2)
+    mocked_nvme_device.create_io_queues(2, 4)
+    engine = NVMeDeviceIOEngine(mocked_nvme_device, queue_depth=1)
+
+    assert engine.next_free_sqid() == 1
+    assert engine.next_free_sqid() == 2
+    assert engine.next_free_sqid() == 1
+
+    engine.sq_outstanding[2] = 1
+    assert engine.next_free_sqid() == 1
+    assert engine.next_free_sqid() == 1
+
+    engine.sq_outstanding[1] = 1
+    assert engine.next_free_sqid() is None
+
+
+def test_io_engine_submit(mocker, mocked_nvme_device, mocked_nvm_cmd):
+    ''' def submit(self, command, callback=None, timeout_s=10):
+    '''
+    mocker.patch('time.sleep', lambda x: None)
+    mocked_nvme_device.init_admin_queues(2, 2)
+    mocked_nvme_device.create_io_queues(2, 4)
+    engine = NVMeDeviceIOEngine(mocked_nvme_device, queue_depth=1)
+    MockedCompletions(mocked_nvme_device)
+
+    # Fill both queues
+    commands = [NVMCommand() for i in range(3)]
+    completed = []
+    engine.submit(commands[0], completed.append)
+    engine.submit(commands[1])
+    assert engine.outstanding == 2
+    assert engine.num_submitted == 2
+    assert engine.sq_outstanding == {1: 1, 2: 1}
+    assert commands[0].sq.qid == 1
+    assert commands[1].sq.qid == 2
+
+    # Queues are full, the next submit reaps to make room
+    engine.submit(commands[2])
+    assert completed == [commands[0]]
+    assert commands[0].callback is None
+    assert engine.num_completed == 2
+    assert engine.outstanding == 1
+
+    # Nothing completes, time out
+    engine.submit(NVMCommand())
+    mocked_nvme_device.reap_completions = lambda cqid: 0
+    with pytest.raises(AssertionError):
+        engine.submit(NVMCommand(), timeout_s=0.001)
+
+    # Nothing completes, CFS
+    mocked_nvme_device.nvme_regs.CSTS.CFS = 1
+    with pytest.raises(AssertionError):
+        engine.submit(NVMCommand())
+    mocked_nvme_device.nvme_regs.CSTS.CFS = 0
+
+    # start_cmd raises, command is not tracked
+    engine = NVMeDeviceIOEngine(mocked_nvme_device, queue_depth=1)
+    mocker.patch.object(mocked_nvme_device, 'start_cmd', side_effect=AssertionError)
+    with pytest.raises(AssertionError):
+        engine.submit(mocked_nvm_cmd)
+    assert engine.outstanding == 0
+    assert mocked_nvm_cmd.callback is None
+
+
+def test_io_engine_submit_batch(mocker, mocked_nvme_device):
+    ''' def submit_batch(self, commands, callback=None, timeout_s=10):
+    '''
+    mocked_nvme_device.init_admin_queues(2, 2)
+    mocked_nvme_device.create_io_queues(2, 4)
+    engine = NVMeDeviceIOEngine(mocked_nvme_device, queue_depth=2)
+    MockedCompletions(mocked_nvme_device)
+    start_cmds = mocker.spy(mocked_nvme_device, 'start_cmds')
+
+    # Fills each queue up in one call per queue
+    completed = []
+    commands = [NVMCommand() for i in range(4)]
+    engine.submit_batch(commands, completed.append)
+    assert start_cmds.call_count == 2
+    assert engine.sq_outstanding == {1: 2, 2: 2}
+    assert engine.num_submitted == 4
+
+    # More commands than free slots reaps in between
+    engine.submit_batch([NVMCommand() for i in range(3)])
+    assert start_cmds.call_count == 4
+    assert completed == commands
+    engine.drain()
+    assert engine.num_completed == 7
+
+    # start_cmds raises, commands are not tracked
+    mocker.patch.object(mocked_nvme_device, 'start_cmds', side_effect=AssertionError)
+    commands = [NVMCommand() for i in range(2)]
+    with pytest.raises(AssertionError):
+        engine.submit_batch(commands)
+    assert engine.outstanding == 0
+    assert all(command.callback is None for command in commands)
+
+
+def test_io_engine_reap(mocked_nvme_device):
+    ''' def reap(self):
+    '''
+    mocked_nvme_device.init_admin_queues(2, 2)
+    mocked_nvme_device.create_io_queues(2, 4)
+    engine = NVMeDeviceIOEngine(mocked_nvme_device)
+    MockedCompletions(mocked_nvme_device)
+
+    assert engine.reap() == 0
+    for i in range(5):
+        engine.submit(NVMCommand())
+    assert engine.reap() == 5
+    assert engine.outstanding == 0
+
+
+def test_io_engine_drain(mocker, mocked_nvme_device):
+    ''' def drain(self, timeout_s=10):
+    '''
+    mocker.patch('time.sleep', lambda x: None)
+    mocked_nvme_device.init_admin_queues(2, 2)
+    mocked_nvme_device.create_io_queues(2, 4)
+    engine = NVMeDeviceIOEngine(mocked_nvme_device)
+    MockedCompletions(mocked_nvme_device)
+
+    # Nothing outstanding
+    engine.drain()
+
+    for i in range(5):
+        engine.submit(NVMCommand())
+    engine.drain()
+    assert engine.outstanding == 0
+
+    # Commands never complete
+    engine.submit(NVMCommand())
+    mocked_nvme_device.reap_completions = lambda cqid: 0
+    with pytest.raises(AssertionError):
+        engine.drain(timeout_s=0.001)
+
+    mocked_nvme_device.nvme_regs.CSTS.CFS = 1
+    with pytest.raises(AssertionError):
+        engine.drain()
+
+
+####################################################################################################
+# NVMeDeviceAsync tests
+####################################################################################################
+def test_async_submit(mocked_nvme_device):
+    ''' async def submit(self, command, sqid=None, cqid=None, timeout_s=10, check=True):
+    '''
+    mocked_nvme_device.init_admin_queues(2, 2)
+    mocked_nvme_device.create_io_queues(2, 4)
+    completions = MockedCompletions(mocked_nvme_device)
+
+    async def main():
+        aio = NVMeDeviceAsync(mocked_nvme_device)
+        assert aio.eventfds == []
+
+        # Commands complete through the polling task
+        commands = [NVMCommand() for i in range(4)]
+        done = await asyncio.gather(*[aio.submit(c, 1 + (i % 2), 1 + (i % 2))
+                                      for i, c in enumerate(commands)])
+        assert done == commands
+        assert all(c.callback is None for c in commands)
+        assert aio.outstanding == 0
+        await asyncio.sleep(0)
+        assert aio.poll_task is None
+
+        # Failed status is checked, unless asked not to
+        command = NVMCommand()
+        command.cqe.SF.SC = 1
+        with pytest.raises(NVMeStatusCodeException):
+            await aio.submit(command, 1, 1)
+        command = NVMCommand()
+        command.cqe.SF.SC = 1
+        assert await aio.submit(command, 1, 1, check=False) is command
+
+        # start_cmd raises, command is not tracked
+        mocked_nvme_device.start_cmd = lambda command, sqid, cqid: 1 / 0
+        with pytest.raises(ZeroDivisionError):
+            await aio.submit(NVMCommand())
+        assert aio.outstanding == 0
+        mocked_nvme_device.start_cmd = completions.start_cmd
+
+        # Nothing completes, time out. The command is detached, a late completion is ignored
+        mocked_nvme_device.reap_completions = lambda cqid: 0
+        command = NVMCommand()
+        with pytest.raises(asyncio.TimeoutError):
+            await aio.submit(command, 1, 1, timeout_s=0.01)
+        assert aio.outstanding == 0
+        assert command.callback is None
+        aio.command_completed(command)
+        assert command.callback is None
+
+        # CFS fails outstanding commands, skipping any that were cancelled
+        mocked_nvme_device.nvme_regs.CSTS.CFS = 1
+        cancelled = aio.loop.create_future()
+        cancelled.cancel()
+        aio.futures[0] = cancelled
+        with pytest.raises(AssertionError):
+            await aio.submit(NVMCommand(), 1, 1)
+        assert aio.outstanding == 0
+        mocked_nvme_device.nvme_regs.CSTS.CFS = 0
+
+        # close stops polling
+        task = asyncio.ensure_future(aio.submit(NVMCommand(), 1, 1, timeout_s=0.01))
+        await asyncio.sleep(0)
+        assert aio.poll_task is not None
+        aio.close()
+        with pytest.raises(asyncio.TimeoutError):
+            await task
+        aio.close()
+
+    asyncio.run(main())
+
+
+def test_async_msix(mocked_nvme_device):
+    ''' def msix_ready(self, eventfd, vector):
+    '''
+    mocked_nvme_device.init_admin_queues(2, 2)
+    mocked_nvme_device.create_io_queues(2, 4)
+    MockedCompletions(mocked_nvme_device)
+
+    eventfds = [os.eventfd(0, flags=os.EFD_NONBLOCK) for i in range(2)]
+    mocked_nvme_device.int_type = NVMeDeviceIntType.MSIX
+    mocked_nvme_device.pci_userspace_device = SimpleNamespace(
+        eventfd_vectors={eventfds[0]: 0, eventfds[1]: 1})
+    for qid in [1, 2]:
+        mocked_nvme_device.queue_mgr.get(None, qid)[1].int_vector = qid - 1
+
+    async def main():
+        aio = NVMeDeviceAsync(mocked_nvme_device)
+        assert aio.eventfds == eventfds
+
+        # Completion is reaped when the vector for its queue fires
+        command = NVMCommand()
+        task = asyncio.ensure_future(aio.submit(command, 2, 2))
+        await asyncio.sleep(0)
+        assert aio.poll_task is None
+
+        os.eventfd_write(eventfds[0], 1)
+        await asyncio.sleep(0.01)
+        assert not task.done()
+
+        os.eventfd_write(eventfds[1], 1)
+        assert await task is command
+
+        # Readable, but already cleared
+        aio.msix_ready(eventfds[0], 0)
+
+        # A vector with nothing to reap checks CFS, failing outstanding commands
+        task = asyncio.ensure_future(aio.submit(NVMCommand(), 2, 2))
+        await asyncio.sleep(0)
+        os.eventfd_write(eventfds[0], 1)
+        await asyncio.sleep(0.01)
+        assert not task.done()
+
+        mocked_nvme_device.nvme_regs.CSTS.CFS = 1
+        os.eventfd_write(eventfds[0], 1)
+        with pytest.raises(AssertionError):
+            await task
+        assert aio.outstanding == 0
+
+        # A timeout checks CFS too, failing the other outstanding commands
+        mocked_nvme_device.nvme_regs.CSTS.CFS = 0
+        other = asyncio.ensure_future(aio.submit(NVMCommand(), 2, 2))
+        await asyncio.sleep(0)
+        mocked_nvme_device.nvme_regs.CSTS.CFS = 1
+        with pytest.raises(asyncio.TimeoutError):
+            await aio.submit(NVMCommand(), 1, 1, timeout_s=0.01)
+        with pytest.raises(AssertionError):
+            await other
+        assert aio.outstanding == 0
+        mocked_nvme_device.nvme_regs.CSTS.CFS = 0
+
+        aio.close()
+        assert aio.eventfds == []
+
+    asyncio.run(main())
+    for eventfd in eventfds:
+        os.close(eventfd)
+
+
+####################################################################################################
+# NVMeDeviceWorkers tests
+####################################################################################################
+def test_queue_pair_worker(mocked_nvme_device):
+    ''' def __init__(self, nvme_device, sqid, queue_depth=32):
+    '''
+    mocked_nvme_device.init_admin_queues(2, 2)
+    mocked_nvme_device.create_io_queues(2, 4)
+    completions = MockedCompletions(mocked_nvme_device)
+
+    # Unknown queue
+    with pytest.raises(AssertionError):
+        NVMeQueuePairWorker(mocked_nvme_device, 3)
+
+    # Depth is limited by the queue size
+    worker = NVMeQueuePairWorker(mocked_nvme_device, 2)
+    assert worker.cqid == 2
+    assert worker.queue_depth == 3
+
+    # Commands wait in the inbox until the worker services them
+    done = []
+    commands = [NVMCommand() for i in range(5)]
+    for command in commands:
+        worker.submit(command, done.append)
+    assert worker.outstanding == 5
+    assert completions.started == []
+
+    # Only queue_depth commands are started at a time
+    started = []
+    mocked_nvme_device.start_cmds = lambda commands, sqid, cqid: started.append(list(commands))
+    assert worker.service() == 3
+    assert started == [commands[:3]]
+    assert worker.num_submitted == 3
+    assert worker.outstanding == 5
+
+    # The rest go out once they complete
+    for command in commands[:3]:
+        command.callback(command)
+    mocked_nvme_device.start_cmds = completions.start_cmds
+    assert worker.service() == 4
+    assert done == commands
+    assert worker.num_completed == 5
+    assert worker.outstanding == 0
+    assert worker.service() == 0
+
+    # No callback
+    worker.submit(NVMCommand())
+    assert worker.service() == 2
+
+
+def test_queue_pair_worker_run(mocked_nvme_device):
+    ''' def run(self):
+    '''
+    mocked_nvme_device.init_admin_queues(2, 2)
+    mocked_nvme_device.create_io_queues(1, 4)
+    MockedCompletions(mocked_nvme_device)
+
+    worker = NVMeQueuePairWorker(mocked_nvme_device, 1)
+    worker.start()
+    done = []
+    worker.submit(NVMCommand(), done.append)
+    while len(done) == 0:
+        time.sleep(0.001)
+    worker.stop()
+    assert worker.exception is None
+
+    # CFS stops the worker with an exception
+    mocked_nvme_device.nvme_regs.CSTS.CFS = 1
+    worker = NVMeQueuePairWorker(mocked_nvme_device, 1)
+    worker.start()
+    worker.join()
+    assert type(worker.exception) is AssertionError
+
+
+def test_device_workers(mocked_nvme_device):
+    ''' def __init__(self, nvme_device, queue_depth=32, sqids=None):
+    '''
+    mocked_nvme_device.init_admin_queues(2, 2)
+
+    # No IO queues
+    with pytest.raises(AssertionError):
+        NVMeDeviceWorkers(mocked_nvme_device)
+
+    mocked_nvme_device.create_io_queues(2, 4)
+    MockedCompletions(mocked_nvme_device)
+
+    # Queue pairs cannot share a CQ
+    cq = mocked_nvme_device.queue_mgr.get(2, None)[1]
+    cq.qid = 1
+    with pytest.raises(AssertionError):
+        NVMeDeviceWorkers(mocked_nvme_device, sqids=[1, 2])
+    cq.qid = 2
+
+    # Commands from many threads are handed to the workers round robin
+    workers = NVMeDeviceWorkers(mocked_nvme_device, queue_depth=2)
+    assert [w.sqid for w in workers.workers] == [1, 2]
+    workers.start()
+
+    done = []
+
+    def submitter():
+        for i in range(50):
+            workers.submit(NVMCommand(), done.append)
+
+    threads = [threading.Thread(target=submitter) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    workers.drain()
+    assert len(done) == 200
+    assert workers.num_completed == 200
+    assert [w.num_submitted for w in workers.workers] == [100, 100]
+    assert workers.outstanding == 0
+    workers.stop()
+
+    # Stopped workers never finish their commands
+    assert workers.submit(NVMCommand()) is workers.workers[0]
+    with pytest.raises(AssertionError):
+        workers.drain()
+
+    # Failed workers
+    workers.workers[0].exception = ZeroDivisionError()
+    with pytest.raises(AssertionError):
+        workers.drain()
+
+    # Running workers, but nothing completes
+    mocked_nvme_device.reap_completions = lambda cqid: 0
+    workers = NVMeDeviceWorkers(mocked_nvme_device)
+    workers.start()
+    workers.submit(NVMCommand())
+    with pytest.raises(AssertionError):
+        workers.drain(timeout_s=0.01)
+    workers.stop()
+
+
+####################################################################################################
+# NVMeDeviceProcesses tests
+####################################################################################################
+def test_worker_mem_mgr(mocked_nvme_device):
+    ''' class NVMeWorkerMemMgr(DevMemMgr):
+    '''
+    # Page aligned region
+    region_buffer = (ctypes.c_uint8 * (4 * 4096)).from_buffer(mmap.mmap(-1, 4 * 4096))
+    region = MemoryLocation(ctypes.addressof(region_buffer), 0x100000, 4 * 4096, 'region')
+    region.iova_mapped = True
+    mem_mgr = NVMeWorkerMemMgr(region, 4096)
+
+    # Allocations are page aligned, with iovas at the same offset in the region
+    mem_a = mem_mgr.malloc(100, DMADirection.HOST_TO_DEVICE)
+    mem_b = mem_mgr.malloc(8192, DMADirection.DEVICE_TO_HOST, client='b')
+    assert mem_a.vaddr % 4096 == 0
+    assert mem_b.vaddr % 4096 == 0
+    assert mem_b.iova == region.iova + (mem_b.vaddr - region.vaddr)
+    assert mem_b.in_use is True and mem_b.iova_mapped is True
+    assert mem_b.iova_direction == DMADirection.DEVICE_TO_HOST
+    assert mem_mgr.allocated_mem_list() == [mem_a, mem_b]
+
+    # The region is full
+    mem_mgr.malloc(4096, DMADirection.HOST_TO_DEVICE)
+    with pytest.raises(MemoryError):
+        mem_mgr.malloc(4096, DMADirection.HOST_TO_DEVICE)
+
+    # Freed memory is reused
+    mem_mgr.free(mem_a)
+    assert mem_a.in_use is False
+    assert mem_mgr.malloc(4096, DMADirection.HOST_TO_DEVICE).vaddr == mem_a.vaddr
+
+    mem_mgr.free_all()
+    assert mem_mgr.allocated_mem_list() == []
+    assert mem_mgr.malloc(4 * 4096, DMADirection.HOST_TO_DEVICE).vaddr == region.vaddr
+
+
+def test_process_worker_setup(mocked_nvme_device):
+    ''' def setup(self):
+    '''
+    mocked_nvme_device.init_admin_queues(2, 2)
+    mocked_nvme_device.create_io_queues(3, 4)
+    mocked_nvme_device.enable_prp_pool(max_prps=8)
+    region = mocked_nvme_device.mem_mgr.malloc(16 * 4096, DMADirection.BIDIRECTIONAL)
+
+    worker = NVMeProcessWorker(1, mocked_nvme_device, 2, 2, region)
+    worker.setup()
+
+    # Only the worker's queue pair is left
+    assert list(mocked_nvme_device.queue_mgr.nvme_queues.keys()) == [(2, 2)]
+    assert mocked_nvme_device.queue_mgr.io_sqids == [2]
+    assert list(mocked_nvme_device.outstanding_commands.tables.keys()) == [2]
+
+    # Memory comes from the region
+    assert type(mocked_nvme_device.mem_mgr) is NVMeWorkerMemMgr
+    assert mocked_nvme_device.prp_pool.mem_mgr is mocked_nvme_device.mem_mgr
+    assert mocked_nvme_device.prp_pool.max_prps == 8
+    mem = mocked_nvme_device.mem_mgr.malloc(4096, DMADirection.HOST_TO_DEVICE)
+    assert region.vaddr <= mem.vaddr < region.vaddr + region.size
+
+    # No PRP pool
+    mocked_nvme_device.prp_pool = None
+    worker.setup()
+    assert mocked_nvme_device.prp_pool is None
+
+
+def test_device_processes(mocked_nvme_device):
+    ''' def __init__(self, nvme_device, target, sqids=None, mem_bytes=16 * 1024 * 1024,
+                     poll_interval_s=0):
+    '''
+    mocked_nvme_device.init_admin_queues(2, 2)
+
+    # Memory must be shared with the worker processes
+    with pytest.raises(AssertionError, match='not shared'):
+        NVMeDeviceProcesses(mocked_nvme_device, None)
+    mocked_nvme_device.mem_mgr.fork_shared = True
+
+    # No IO queues
+    with pytest.raises(AssertionError):
+        NVMeDeviceProcesses(mocked_nvme_device, None)
+
+    mocked_nvme_device.create_io_queues(2, 4)
+
+    # Unknown queue
+    with pytest.raises(AssertionError):
+        NVMeDeviceProcesses(mocked_nvme_device, None, sqids=[3])
+
+    # Results come back in worker order
+    procs = NVMeDeviceProcesses(mocked_nvme_device, lambda worker: worker.sqid * 10,
+                                mem_bytes=4096)
+    assert [w.mem.size for w in procs.workers] == [4096, 4096]
+    procs.start()
+    assert procs.join() == [10, 20]
+    assert procs.processes == []
+    procs.free()
+    assert procs.workers == []
+
+    # Exceptions in the target fail the join
+    def target(worker):
+        assert worker.sqid != 2, 'failed worker'
+    procs = NVMeDeviceProcesses(mocked_nvme_device, target, mem_bytes=4096)
+    procs.start()
+    with pytest.raises(AssertionError, match='failed worker'):
+        procs.join()
+
+    # So do workers that exit without a result
+    procs = NVMeDeviceProcesses(mocked_nvme_device, lambda worker: os._exit(3), sqids=[1],
+                                mem_bytes=4096)
+    procs.start()
+    with pytest.raises(AssertionError, match='exited with code 3'):
+        procs.join()
+
+    # Workers still running after the timeout are stopped
+    procs = NVMeDeviceProcesses(mocked_nvme_device, lambda worker: time.sleep(10), sqids=[1],
+                                mem_bytes=4096)
+    procs.start()
+    with pytest.raises(AssertionError, match='did not finish'):
+        procs.join(timeout_s=0.1)
+    assert procs.processes == []
+
+
+def test_device_processes_run_worker(mocked_nvme_device):
+    ''' def run_worker(self, worker, conn):
+    '''
+    mocked_nvme_device.init_admin_queues(2, 2)
+    mocked_nvme_device.create_io_queues(2, 4)
+    mocked_nvme_device.mem_mgr.fork_shared = True
+
+    # Runs in this process here, to check what it sends back
+    procs = NVMeDeviceProcesses(mocked_nvme_device, lambda worker: worker.index, sqids=[2],
+                                mem_bytes=4096)
+    recv_conn, send_conn = procs.context.Pipe(duplex=False)
+    procs.run_worker(procs.workers[0], send_conn)
+    assert recv_conn.recv() == (0, None)
+
+    procs.target = lambda worker: 1 / 0
+    recv_conn, send_conn = procs.context.Pipe(duplex=False)
+    procs.run_worker(procs.workers[0], send_conn)
+    result, error = recv_conn.recv()
+    assert result is None
+    assert 'ZeroDivisionError' in error
+
+
+####################################################################################################
+# NVMeLatencyStats tests
+####################################################################################################
+def test_latency_stats():
+    ''' class NVMeLatencyStats:
+    '''
+    def command(sqid, opcode, latency_ns):
+        return SimpleNamespace(sq=SimpleNamespace(qid=sqid), OPC=opcode,
+                               start_time_ns=1000, end_time_ns=1000 + latency_ns)
+
+    stats = NVMeLatencyStats()
+    for i in range(100):
+        stats.record(command(1, 0x01, 1000 + i))
+        stats.record(command(1, 0x02, 5000 + i))
+        stats.record(command(2, 0x02, 9000 + i))
+    assert sorted(stats.histograms.keys()) == [(1, 0x01), (1, 0x02), (2, 0x02)]
+    assert stats.histograms[(1, 0x01)].min == 1000
+    assert stats.histograms[(1, 0x01)].max == 1099
+
+    # Filtered histograms
+    assert stats.histogram().count == 300
+    assert stats.histogram(sqid=1).count == 200
+    assert stats.histogram(opcode=0x02).count == 200
+    assert stats.histogram(sqid=2, opcode=0x02).min == 9000
+    assert stats.histogram(sqid=3).count == 0
+
+    # Report is sorted by key
+    report = stats.report()
+    assert list(report.keys()) == [(1, 0x01), (1, 0x02), (2, 0x02)]
+    assert report[(2, 0x02)]['count'] == 100
+    assert report[(2, 0x02)]['max'] == 9099
+
+    # Snapshots keep their own counts, and can be merged back
+    snapshot = stats.snapshot()
+    stats.record(command(3, 0x01, 10))
+    assert stats.histogram().count == 301
+    assert snapshot.histogram().count == 300
+    snapshot.merge(stats)
+    assert snapshot.histogram().count == 601
+    assert snapshot.histogram(sqid=3).count == 1
+
+    # Snapshots can be sent to other processes
+    copy = pickle.loads(pickle.dumps(snapshot))
+    assert copy.histogram().count == 601
+    copy.record(command(4, 0x01, 10))
+    assert copy.histogram().count == 602
+
+    # Threads add histograms for their own queues while another reports them
+    def record(sqid):
+        for i in range(1000):
+            stats.record(command(sqid, i % 64, 10))
+    threads = [threading.Thread(target=record, args=(sqid,)) for sqid in range(10, 14)]
+    for thread in threads:
+        thread.start()
+    while any(thread.is_alive() for thread in threads):
+        stats.report()
+    for thread in threads:
+        thread.join()
+    assert stats.histogram().count == 301 + 4000
+
+    stats.reset()
+    assert stats.histograms == {}
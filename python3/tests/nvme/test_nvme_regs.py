@@ -1,6 +1,15 @@
-from lone.nvme.spec.registers.nvme_regs import NVMeRegistersDirect
+from lone.nvme.spec.registers.nvme_regs import (NVMeRegistersDirect,
+                                                nvme_reg_struct_factory,
+                                                NVMeAccessData)
 
 
 def test_nvme_regs():
     regs = NVMeRegistersDirect()
     regs.log()
+
+
+def test_nvme_reg_struct_factory():
+    # Classes are made on every call, with their field tables already built
+    Registers = nvme_reg_struct_factory(NVMeAccessData(None, None, None, None))
+    assert Registers.Cc._field_table_['EN'] == (0, 1)
+    assert Registers is not nvme_reg_struct_factory(NVMeAccessData(None, None, None, None))
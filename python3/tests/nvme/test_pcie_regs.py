@@ -5,6 +5,7 @@ from lone.nvme.spec.registers.pcie_regs import (PCIeRegistersDirect,
                                                 pcie_reg_struct_factory,
                                                 PCIeRegisters,
                                                 PCIeAccessData)
+from lone.nvme.spec.registers import RegsStructAccess
 
 
 def check_registers(pcie_regs):
@@ -103,16 +104,19 @@ def test_cap_offsets():
 
 def test_indirect_access(mocker):
 
-    test_data = [0] * 4096
+    test_data = bytearray(4096)
+    accesses = []
 
-    def read_byte(offset):
-        return test_data[offset]
+    def read(offset, size):
+        accesses.append(('read', offset, size))
+        return test_data[offset:offset + size]
 
-    def write_byte(offset, value):
-        test_data[offset] = value
+    def write(offset, data):
+        accesses.append(('write', offset, len(data)))
+        test_data[offset:offset + len(data)] = data
 
-    class Registers(pcie_reg_struct_factory(PCIeAccessData(read_byte,
-                                                           write_byte,
+    class Registers(pcie_reg_struct_factory(PCIeAccessData(read,
+                                                           write,
                                                            None,
                                                            None)), PCIeRegisters):
         direct = False
@@ -125,7 +129,7 @@ def test_indirect_access(mocker):
     assert type(pcie_regs.ID) is Registers.Id
 
     # Tests that setting default values works
-    test_data = [0] * 4096
+    test_data[:] = bytearray(4096)
     pcie_regs.ID = Registers.Id(VID=0xFFFF)
     pcie_regs.ID.DID = 0xED11
     assert pcie_regs.ID.VID == 0xFFFF
@@ -135,6 +139,16 @@ def test_indirect_access(mocker):
     assert test_data[2] == 0x11
     assert test_data[3] == 0xED
 
+    # Registers are read and written whole, in one access each
+    accesses.clear()
+    pcie_regs.CMD.BME = 1
+    assert accesses == [('read', 0x04, 2), ('write', 0x04, 2)]
+    assert test_data[0x04] == 0x04
+
+    # A short read is an error
+    with pytest.raises(AssertionError):
+        RegsStructAccess.read_data(lambda offset, size: b'', 0, 4)
+
     # Set a new attribute to check that path
     pcie_regs.ID.test = 0
 
@@ -172,6 +186,42 @@ def test_indirect_access(mocker):
 
     pcie_regs.init_capabilities()
 
+    # The capabilities list is walked with a single read of all registers
+    test_data[0x34] = 0x40
+    test_data[0x40:0x42] = bytes([0x01, 0x50])
+    test_data[0x50:0x52] = bytes([0x05, 0x60])
+    test_data[0x60:0x62] = bytes([0x10, 0x70])
+    test_data[0x70:0x72] = bytes([0x09, 0x00])
+    test_data[0x100:0x104] = bytes([0x01, 0x00, 0x01, 0x14])
+    test_data[0x140:0x144] = bytes([0x03, 0x00, 0x01, 0x00])
+    accesses.clear()
+    pcie_regs.init_capabilities()
+    assert accesses == [('read', 0, 4096)]
+    assert [type(c) for c in pcie_regs.capabilities] == [
+        Registers.PCICapPowerManagementInterface, Registers.PCICapMSI, Registers.PCICapExpress,
+        Registers.PCICapExtendedAer, Registers.PCICapExtendeDeviceSerialNumber]
+
+    # Each capability still accesses the registers
+    assert [c._base_offset_ for c in pcie_regs.capabilities] == [0x40, 0x50, 0x60, 0x100, 0x140]
+    assert pcie_regs.capabilities[2].CAP_ID == 0x10
+
+    # Capabilities are looked up by id, extended ones separately
+    assert pcie_regs.get_capability(0x10) is pcie_regs.capabilities[2]
+    assert pcie_regs.get_capability(0x01) is pcie_regs.capabilities[0]
+    assert pcie_regs.get_capability(0x01, extended=True) is pcie_regs.capabilities[3]
+    assert pcie_regs.get_capability(0x03, extended=True) is pcie_regs.capabilities[4]
+    assert pcie_regs.get_capability(0x11) is None
+    assert pcie_regs.get_capability(0x09) is None
+
+    # Bulk reads
+    accesses.clear()
+    assert pcie_regs.read_config(0x40, 2) == bytes([0x01, 0x50])
+    config = pcie_regs.read_config()
+    assert type(config) is PCIeRegistersDirect
+    assert config.CAP.CP == 0x40
+    pcie_regs.log()
+    assert accesses == [('read', 0x40, 2), ('read', 0, 4096), ('read', 0, 4096)]
+
 
 def test_caps_direct():
     # Capabilities, TODO: Clean this up!
@@ -197,3 +247,69 @@ def test_caps_direct():
     pcie_regs.CAPS.DATA[0xC7] = 0x00
 
     pcie_regs.init_capabilities()
+    assert len(pcie_regs.capabilities) == 6
+
+    # Bulk reads work on direct registers too, the copy does not change with them
+    assert pcie_regs.read_config(0x40, 2) == bytes([0x01, 0x50])
+    config = pcie_regs.read_config()
+    pcie_regs.CAP.CP = 0x50
+    assert config.CAP.CP == 0x40
+
+
+def test_field_tables():
+    test_data = bytearray(4096)
+
+    def read(offset, size):
+        return test_data[offset:offset + size]
+
+    def write(offset, data):
+        test_data[offset:offset + len(data)] = data
+
+    # Tables are built by the factory
+    Registers = pcie_reg_struct_factory(PCIeAccessData(read, write, None, None))
+    assert Registers.Cmd._field_table_['BME'] == (2, 1)
+    assert Registers.PCICapMSIX._field_table_['NEXT_PTR'] == (8, 0xFF)
+    assert Registers.PCICapMSIX._field_table_['MXC'] is None
+
+    # Masked int fields match what ctypes does
+    cmd = Registers.Cmd()
+    direct = PCIeRegistersDirect.Cmd()
+    for name, value in [('BME', 1), ('RSVD_1', 0x3F), ('IOSE', 3), ('ID', 1), ('BME', 0)]:
+        setattr(cmd, name, value)
+        setattr(direct, name, value)
+        assert bytes(test_data[4:6]) == bytes(direct)
+        assert getattr(cmd, name) == getattr(direct, name)
+
+    # Classes defined elsewhere build their table on first access
+    class Reg(RegsStructAccess):
+        _pack_ = 1
+        _fields_ = [('LOW', ctypes.c_uint32, 4), ('HIGH', ctypes.c_uint32, 28),
+                    ('DATA', ctypes.c_uint8 * 2)]
+        _access_ = PCIeAccessData(read, write, None, None)
+        _base_offset_ = 0x80
+    assert Reg._field_table_ is None
+    reg = Reg()
+    reg.HIGH = 0xABCDEF1
+    assert Reg._field_table_ == {'LOW': (0, 0xF), 'HIGH': (4, 0xFFFFFFF), 'DATA': None}
+    assert reg.HIGH == 0xABCDEF1
+    assert bytes(test_data[0x80:0x84]) == (0xABCDEF1 << 4).to_bytes(4, 'little')
+
+    # Fields that are not ints go through the structure
+    reg.DATA = (ctypes.c_uint8 * 2)(0x12, 0x34)
+    assert list(reg.DATA) == [0x12, 0x34]
+    assert bytes(test_data[0x84:0x86]) == b'\x12\x34'
+    assert reg.HIGH == 0xABCDEF1
+
+    Reg._field_table_ = None
+    assert reg.LOW == 0
+
+    # An empty table is built once, not on every access
+    class Empty(RegsStructAccess):
+        _access_ = PCIeAccessData(read, write, None, None)
+        _base_offset_ = 0x90
+    empty = Empty()
+    empty.OTHER = 1
+    assert Empty._field_table_ == {}
+    table = Empty._field_table_
+    assert empty.OTHER == 1
+    assert Empty.field_table() is table
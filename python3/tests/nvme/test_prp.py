@@ -1,7 +1,8 @@
 import pytest
 import ctypes
+import threading
 
-from lone.nvme.spec.prp import PRP
+from lone.nvme.spec.prp import PRP, PRPPool
 from lone.system import DMADirection
 
 
@@ -118,10 +119,36 @@ def test_alloc(mocked_nvme_device):
               DMADirection.HOST_TO_DEVICE,
               'test',
               alloc=False)
-    assert prp.pages_needed == 515
+    assert prp.pages_needed == 514
     before = len(mocked_nvme_device.mem_mgr.allocated_mem_list())
-    with pytest.raises(AssertionError):
-        prp.alloc()
+    prp.alloc()
+    assert len(mocked_nvme_device.mem_mgr.allocated_mem_list()) == before + 514
+    assert len(prp.list_mems) == 1
+
+    # More data pages than fit in one list, lists are chained
+    prp = PRP(mocked_nvme_device.mem_mgr,
+              (2 * 1024 * 1024) + (2 * 4096),
+              4096,
+              DMADirection.HOST_TO_DEVICE,
+              'test',
+              alloc=True)
+    assert prp.lists_needed == 2
+    assert len(prp.list_mems) == 2
+    first_list = (ctypes.c_uint64 * 512).from_address(prp.list_mems[0].vaddr)
+    second_list = (ctypes.c_uint64 * 512).from_address(prp.list_mems[1].vaddr)
+    assert first_list[511] == prp.list_mems[1].iova
+    assert second_list[1] != 0
+    assert second_list[2] == 0
+
+    prp = PRP(mocked_nvme_device.mem_mgr,
+              8 * 1024 * 1024,
+              4096,
+              DMADirection.DEVICE_TO_HOST,
+              'test',
+              alloc=True)
+    assert prp.lists_needed == 5
+    assert len(prp.mem_list) == 2048 + 5
+    assert len(prp.get_data_segments()) == 2048
 
 
 def test_from_address(mocked_nvme_device):
@@ -175,6 +202,28 @@ def test_from_address(mocked_nvme_device):
     assert new_prp.prp1_mem is not None
     assert len(mocked_nvme_device.mem_mgr.allocated_mem_list()) == 0
 
+    # Chained lists are followed
+    num_bytes = 4 * 1024 * 1024
+    prp = PRP(mocked_nvme_device.mem_mgr,
+              num_bytes,
+              4096,
+              DMADirection.HOST_TO_DEVICE,
+              'test',
+              alloc=True)
+    prp.set_data_buffer(bytes(range(256)) * (num_bytes // 256))
+    new_prp = PRP(None, num_bytes, 4096, None, 'test', alloc=False).from_address(prp.prp1,
+                                                                                 prp.prp2)
+    assert len(new_prp.list_mems) == 2
+    assert ([m.vaddr for m in new_prp.get_data_segments()] ==
+            [m.vaddr for m in prp.get_data_segments()])
+    assert new_prp.get_data_buffer() == prp.get_data_buffer()
+
+    # Chain pointer missing
+    list_data = (ctypes.c_uint64 * 512).from_address(prp.list_mems[0].vaddr)
+    list_data[511] = 0
+    with pytest.raises(AssertionError):
+        PRP(None, num_bytes, 4096, None, 'test', alloc=False).from_address(prp.prp1, prp.prp2)
+
 
 def test_str(mocked_nvme_device):
     ''' def __str__(self):
@@ -187,15 +236,30 @@ def test_str(mocked_nvme_device):
               alloc=True)
 
     # Test string conversion
-    str(prp)
+    assert 'list0[014]' in str(prp)
+    assert 'list0[015]' not in str(prp)
 
-    # Test string conversion with empty list (mps = 0 gets us down that path)
-    prp.mps = 0
-    str(prp)
+    # Chained lists print the pointer to the next list
+    prp = PRP(mocked_nvme_device.mem_mgr,
+              (2 * 1024 * 1024) + (2 * 4096),
+              4096,
+              DMADirection.HOST_TO_DEVICE,
+              'test',
+              alloc=True)
+    string = str(prp)
+    assert '  list0[511]: 0x{:016x} 0x{:016x}'.format(
+        prp.list_mems[0].vaddr + (8 * 511), prp.list_mems[1].iova) in string
+    assert 'list1[001]' in string
+    assert 'list1[002]' not in string
 
     # Test string conversion with no memory
-    prp.mem_list = []
-    str(prp)
+    prp = PRP(mocked_nvme_device.mem_mgr,
+              4096,
+              4096,
+              DMADirection.HOST_TO_DEVICE,
+              'test',
+              alloc=False)
+    assert str(prp) == ''
 
 
 def test_free_all_memory(mocked_nvme_device):
@@ -211,6 +275,20 @@ def test_free_all_memory(mocked_nvme_device):
     prp.free_all_memory()
     assert len(prp.mem_list) == 0
 
+    # With more than one page, all are freed
+    freed = []
+    mocked_nvme_device.mem_mgr.free = freed.append
+    prp = PRP(mocked_nvme_device.mem_mgr,
+              16 * 4096,
+              4096,
+              DMADirection.HOST_TO_DEVICE,
+              'test',
+              alloc=True)
+    mem_list = list(prp.mem_list)
+    prp.free_all_memory()
+    assert len(prp.mem_list) == 0
+    assert freed == mem_list
+
 
 def test_get_data_segments(mocked_nvme_device):
     ''' def get_data_segments(self):
@@ -225,6 +303,77 @@ def test_get_data_segments(mocked_nvme_device):
     segments = prp.get_data_segments()
     assert len(segments) == 10
 
+    # PRP1 and PRP2 both point to data
+    prp = PRP(mocked_nvme_device.mem_mgr,
+              2 * 4096,
+              4096,
+              DMADirection.HOST_TO_DEVICE,
+              'test',
+              alloc=True)
+    prp.set_data_buffer(bytes([0xFF] * 2 * 4096))
+    assert prp.get_data_segments() == [prp.prp1_mem, prp.prp2_mem]
+
+    # No memory
+    prp = PRP(mocked_nvme_device.mem_mgr,
+              4096,
+              4096,
+              DMADirection.HOST_TO_DEVICE,
+              'test',
+              alloc=False)
+    assert prp.get_data_segments() == []
+
+
+def test_get_data_views(mocked_nvme_device):
+    ''' def get_data_views(self):
+    '''
+    prp = PRP(mocked_nvme_device.mem_mgr,
+              (3 * 4096) + 512,
+              4096,
+              DMADirection.HOST_TO_DEVICE,
+              'test',
+              alloc=True)
+    views = prp.get_data_views()
+    assert [len(view) for view in views] == [4096, 4096, 4096, 512]
+
+    # Views point straight to the PRP memory
+    views[3][0] = 0xAB
+    assert ctypes.c_uint8.from_address(prp.get_data_segments()[3].vaddr).value == 0xAB
+
+
+def test_get_data_view(mocked_nvme_device):
+    ''' def get_data_view(self):
+    '''
+    # Mocked memory manager allocations are not contiguous
+    prp = PRP(mocked_nvme_device.mem_mgr,
+              2 * 4096,
+              4096,
+              DMADirection.HOST_TO_DEVICE,
+              'test',
+              alloc=True)
+    assert prp.get_data_view() is None
+
+    prp = PRP(mocked_nvme_device.mem_mgr,
+              4096,
+              4096,
+              DMADirection.HOST_TO_DEVICE,
+              'test',
+              alloc=False)
+    assert prp.get_data_view() is None
+
+    # Contiguous memory
+    memory = (ctypes.c_uint8 * (3 * 4096))()
+    prp = PRP(mocked_nvme_device.mem_mgr,
+              2 * 4096,
+              4096,
+              DMADirection.HOST_TO_DEVICE,
+              'test',
+              alloc=False)
+    prp.from_address(ctypes.addressof(memory), ctypes.addressof(memory) + 4096)
+    view = prp.get_data_view()
+    assert len(view) == 2 * 4096
+    view[4096] = 0x12
+    assert memory[4096] == 0x12
+
 
 def test_get_data_buffer(mocked_nvme_device):
     ''' def get_data_buffer(self):
@@ -237,6 +386,11 @@ def test_get_data_buffer(mocked_nvme_device):
               alloc=True)
     assert len(prp.get_data_buffer()) == 10 * 4096
 
+    # Data comes from every page, in order
+    data = bytes([i % 256 for i in range(10 * 4096)])
+    prp.set_data_buffer(data)
+    assert prp.get_data_buffer() == data
+
 
 def test_set_data_buffer(mocked_nvme_device):
     ''' def set_data_buffer(self, data):
@@ -251,3 +405,156 @@ def test_set_data_buffer(mocked_nvme_device):
     prp.set_data_buffer(bytearray(10 * 4096))
 
     prp.set_data_buffer(bytearray(9 * 4096))
+
+    # Less than a page in the last segment
+    prp.set_data_buffer(bytes([0xAA] * ((9 * 4096) + 1)))
+    data = prp.get_data_buffer()
+    assert data[:(9 * 4096) + 1] == bytes([0xAA] * ((9 * 4096) + 1))
+    assert data[(9 * 4096) + 1:] == bytes(4095)
+
+
+def test_contiguous(mocked_nvme_device):
+    ''' def alloc_contiguous(self):
+    '''
+    mem_mgr = mocked_nvme_device.mem_mgr
+
+    # One page, one buffer
+    prp = PRP(mem_mgr, 100, 4096, DMADirection.HOST_TO_DEVICE, 'test', contiguous=True)
+    assert len(prp.mem_list) == 1
+    assert prp.prp1 == prp.mem_list[0].iova
+    assert prp.prp2 == 0
+
+    # Two pages, PRP2 is the second page of the buffer
+    prp = PRP(mem_mgr, 2 * 4096, 4096, DMADirection.HOST_TO_DEVICE, 'test', contiguous=True)
+    assert len(prp.mem_list) == 1
+    assert prp.mem_list[0].size == 2 * 4096
+    assert prp.prp2 == prp.prp1 + 4096
+    assert prp.prp2_mem.vaddr == prp.prp1_mem.vaddr + 4096
+
+    # Lists, data and list pages each in one buffer
+    num_bytes = (2 * 1024 * 1024) + (2 * 4096)
+    prp = PRP(mem_mgr, num_bytes, 4096, DMADirection.HOST_TO_DEVICE, 'test', contiguous=True)
+    assert len(prp.mem_list) == 2
+    assert prp.mem_list[1].size == 2 * 4096
+    assert len(prp.list_mems) == 2
+    first_list = (ctypes.c_uint64 * 512).from_address(prp.list_mems[0].vaddr)
+    second_list = (ctypes.c_uint64 * 512).from_address(prp.list_mems[1].vaddr)
+    assert list(first_list[:511]) == [prp.prp1 + (i * 4096) for i in range(1, 512)]
+    assert first_list[511] == prp.list_mems[1].iova
+    assert list(second_list[:3]) == [prp.prp1 + (512 * 4096), prp.prp1 + (513 * 4096), 0]
+    assert 'list1[001]' in str(prp)
+
+    # Data is one flat view
+    assert prp.get_data_segments() == [prp.prp1_mem]
+    views = prp.get_data_views()
+    assert len(views) == 1
+    assert len(views[0]) == num_bytes
+    prp.set_data_buffer(bytes(range(256)) * (num_bytes // 256))
+    assert prp.get_data_buffer() == bytes(range(256)) * (num_bytes // 256)
+
+    # Less data than the PRP holds
+    prp.set_data_buffer(bytes(10))
+    assert prp.get_data_buffer()[:12] == bytes(10) + bytes([10, 11])
+
+    # Parsing it gives the same data
+    new_prp = PRP(None, num_bytes, 4096, None, 'test', alloc=False).from_address(prp.prp1,
+                                                                                 prp.prp2)
+    assert new_prp.get_data_buffer() == prp.get_data_buffer()
+
+    # No memory
+    prp.free_all_memory()
+    prp.prp1_mem = None
+    assert prp.get_data_views() == []
+
+
+####################################################################################################
+# PRPPool tests
+####################################################################################################
+def test_prp_pool(mocked_nvme_device):
+    ''' class PRPPool:
+    '''
+    pool = PRPPool(mocked_nvme_device.mem_mgr, 4096, max_prps=3, max_bytes=10 * 4096)
+
+    # Nothing in the pool, new PRPs are created
+    prp_r = pool.get(4096, DMADirection.DEVICE_TO_HOST, 'test')
+    prp_w = pool.get(4096, DMADirection.HOST_TO_DEVICE, 'test')
+    assert prp_r.pool is pool
+    assert prp_r.direction == DMADirection.DEVICE_TO_HOST
+    assert pool.misses == 2
+
+    # PRPs come back for the same size and direction only
+    pool.put(prp_r)
+    pool.put(prp_w)
+    assert pool.num_prps == 2
+    assert pool.num_bytes == 2 * 4096
+    assert pool.get(4096, DMADirection.DEVICE_TO_HOST, 'test') is prp_r
+    assert pool.get(8192, DMADirection.HOST_TO_DEVICE, 'test') is not prp_w
+    assert pool.get(4096, DMADirection.HOST_TO_DEVICE, 'test2') is prp_w
+    assert prp_w.client == 'test2'
+    assert pool.hits == 2
+    assert pool.num_prps == 0
+    assert pool.num_bytes == 0
+
+    # PRPs from somewhere else can't be returned
+    with pytest.raises(AssertionError):
+        pool.put(PRP(mocked_nvme_device.mem_mgr, 4096, 4096, DMADirection.HOST_TO_DEVICE, 'test'))
+
+    # Over max_prps, the least recently used go first
+    prps = [pool.get(4096, DMADirection.HOST_TO_DEVICE, 'test') for i in range(4)]
+    for prp in prps:
+        pool.put(prp)
+    assert pool.num_prps == 3
+    assert pool.evictions == 1
+    assert len(prps[0].mem_list) == 0
+
+    # Over max_bytes (8 data pages + 1 list page)
+    big_prp = pool.get(8 * 4096, DMADirection.DEVICE_TO_HOST, 'test')
+    pool.put(big_prp)
+    assert pool.num_bytes == 10 * 4096
+    assert pool.evictions == 3
+    assert list(pool.free_prps.keys()) == [(4096, DMADirection.HOST_TO_DEVICE, False),
+                                           (8 * 4096, DMADirection.DEVICE_TO_HOST, False)]
+
+    # More than one free PRP for the same key
+    prp_a = pool.get(4096, DMADirection.HOST_TO_DEVICE, 'test')
+    prp_b = pool.get(4096, DMADirection.HOST_TO_DEVICE, 'test')
+    pool.put(prp_a)
+    pool.put(prp_b)
+    assert pool.get(4096, DMADirection.HOST_TO_DEVICE, 'test') is prp_b
+    assert pool.free_prps[(4096, DMADirection.HOST_TO_DEVICE, False)] == [prp_a]
+
+    # Contiguous PRPs are kept separately
+    prp_c = pool.get(4096, DMADirection.HOST_TO_DEVICE, 'test', contiguous=True)
+    assert prp_c.contiguous is True
+    pool.put(prp_c)
+    assert pool.get(4096, DMADirection.HOST_TO_DEVICE, 'test') is prp_a
+    assert pool.get(4096, DMADirection.HOST_TO_DEVICE, 'test', contiguous=True) is prp_c
+    pool.put(prp_c)
+
+    pool.free_all()
+    assert pool.num_prps == 0
+    assert len(pool.free_prps) == 0
+
+    # Once mem_mgr frees all memory, PRPs kept or handed out before are forgotten
+    prp_a = pool.get(4096, DMADirection.HOST_TO_DEVICE, 'test')
+    prp_b = pool.get(4096, DMADirection.HOST_TO_DEVICE, 'test')
+    pool.put(prp_a)
+    mocked_nvme_device.mem_mgr.free_all()
+    misses = pool.misses
+    assert pool.get(4096, DMADirection.HOST_TO_DEVICE, 'test') is not prp_a
+    assert pool.misses == misses + 1
+    assert pool.num_prps == 0 and pool.num_bytes == 0
+    pool.put(prp_b)
+    assert pool.num_prps == 0
+    assert prp_b.mem_list == []
+
+    # Threads getting and putting at the same time
+    def get_put():
+        for i in range(500):
+            pool.put(pool.get(4096, DMADirection.HOST_TO_DEVICE, 'test'))
+    threads = [threading.Thread(target=get_put) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert pool.num_prps == sum(len(prps) for prps in pool.free_prps.values()) <= 3
@@ -149,6 +149,34 @@ def test_nvme_subq_post_command(mocked_admin_cmd):
     assert sq.tail.value == 1
 
 
+def test_nvme_subq_post_commands(mocked_admin_cmd):
+    ''' def post_commands(self, commands):
+    '''
+    sq = NVMeSubmissionQueue(mem_loc, 16, 64, 0, mem1_address)
+    sq.head.set(0)
+    sq.tail.set(0)
+    sq.post_commands([mocked_admin_cmd] * 3)
+    assert sq.tail.value == 3
+
+    # With wrapping
+    sq.head.set(14)
+    sq.tail.set(14)
+    sq.post_commands([mocked_admin_cmd] * 4)
+    assert sq.tail.value == 2
+
+    # Fill it up
+    sq.post_commands([mocked_admin_cmd] * 11)
+    assert sq.tail.value == 13
+    assert sq.is_full()
+
+    # Not enough room
+    sq.head.set(0)
+    sq.tail.set(0)
+    with pytest.raises(AssertionError):
+        sq.post_commands([mocked_admin_cmd] * 16)
+    assert sq.tail.value == 0
+
+
 def test_nvme_subq_get_command():
     ''' def get_command(self):
     '''
@@ -196,6 +224,61 @@ def test_nvme_cmpq_consume_completion():
     assert cq.head.value == 0
 
 
+def test_nvme_cmpq_get_completions():
+    ''' def get_completions(self, max_completions=None):
+    '''
+    cq_mem = (ctypes.c_uint8 * (16 * 16))()
+    cq_address = ctypes.addressof(cq_mem)
+    cq_loc = MemoryLocation(cq_address, cq_address, 16 * 16, 'cq')
+    cq = NVMeCompletionQueue(cq_loc, 16, 16, 0, mem1_address, 0)
+    cq.head.set(0)
+    cq.tail.set(0)
+    assert cq.get_completions() == []
+
+    # Post a few, none are consumed by looking at them
+    for i in range(3):
+        cq.post_completion(CQE(CID=i))
+    assert [cqe.CID for cqe in cq.get_completions()] == [0, 1, 2]
+    assert [cqe.CID for cqe in cq.get_completions(2)] == [0, 1]
+    assert cq.head.value == 0
+
+    # With wrapping
+    cq.head.set(14)
+    cq.tail.set(14)
+    for i in range(4):
+        cq.post_completion(CQE(CID=i))
+    cq.head.set(14)
+    assert [cqe.CID for cqe in cq.get_completions()] == [0, 1, 2, 3]
+
+    # Every slot looks new, only entries - 1 can be valid
+    cq.head.set(0)
+    for i in range(16):
+        CQE.from_address(cq_address + (i * 16)).SF.P = cq.phase
+    assert len(cq.get_completions()) == 15
+
+
+def test_nvme_cmpq_consume_completions():
+    ''' def consume_completions(self, num_completions):
+    '''
+    cq = NVMeCompletionQueue(mem_loc, 16, 16, 0, mem1_address, 0)
+    cq.head.set(0)
+    cq.consume_completions(5)
+    assert cq.head.value == 5
+    assert cq.phase == 1
+
+    # With wrapping, phase flips
+    cq.head.set(14)
+    cq.consume_completions(5)
+    assert cq.head.value == 3
+    assert cq.phase == 0
+
+    cq.head.set(11)
+    cq.consume_completions(5)
+    assert cq.head.value == 0
+    assert cq.phase == 1
+    assert cq.reap_counts == {5: 3}
+
+
 def test_nvme_cmpq_post_completion():
     ''' def post_completion(self, cqe):
     '''
@@ -218,6 +301,38 @@ def test_queue_mgr_init():
     assert len(qm.io_sqids) == 0
     assert qm.io_sqid_index == 0
     assert len(qm.io_cqids) == 0
+    assert len(qm.sq_index) == 0
+    assert len(qm.cq_index) == 0
+    assert len(qm.cqs) == 0
+
+
+def test_queue_mgr_update_indexes():
+    ''' def _update_indexes(self):
+    '''
+    qm = QueueMgr()
+
+    # Two sqs sharing cq 1
+    cq = NVMeCompletionQueue(mem_loc, 16, 16, 1, mem1_address, 2)
+    sq1 = NVMeSubmissionQueue(mem_loc, 16, 64, 1, mem1_address)
+    sq2 = NVMeSubmissionQueue(mem_loc, 16, 64, 2, mem1_address)
+    qm.add(sq1, cq)
+    qm.add(sq2, cq)
+    assert qm.sq_index == {1: (sq1, cq), 2: (sq2, cq)}
+    assert qm.cq_index == {1: (sq1, cq)}
+    assert qm.cqs == [cq, cq]
+    assert qm.cq_vectors == [2, 2]
+    assert qm.first_ids == (1, 1)
+
+    # Removing queues keeps the indexes in sync
+    qm.remove_sq(1)
+    assert qm.get(1, None) == (None, cq)
+    assert qm.get(None, 1) == (None, cq)
+    qm.remove_sq(2)
+    qm.remove_cq(1)
+    assert qm.sq_index == {}
+    assert qm.cq_index == {}
+    assert qm.cqs == []
+    assert qm.first_ids == (None, None)
 
 
 def test_queue_mgr_add():
@@ -248,6 +363,8 @@ def test_queue_mgr_remove_cq():
 
     qm.remove_sq(0)
     qm.remove_cq(0)
+    assert qm.get(None, 0) == (None, None)
+    assert len(qm.get_cqs()) == 0
 
 
 def test_queue_mgr_remove_sq():
@@ -260,6 +377,7 @@ def test_queue_mgr_remove_sq():
     qm.add(sq, cq)
 
     qm.remove_sq(0)
+    assert qm.get(0, None) == (None, cq)
 
 
 def test_queue_mgr_get_cqs():
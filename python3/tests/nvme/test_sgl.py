@@ -0,0 +1,193 @@
+import pytest
+import ctypes
+
+from lone.nvme.spec.sgl import SGL
+from lone.nvme.spec.structures import SGLDescriptor
+from lone.system import DMADirection
+
+
+####################################################################################################
+# SGL tests
+####################################################################################################
+def test_init(mocker, mocked_nvme_device):
+    ''' def __init__(self, mem_mgr, num_bytes, mps, direction, client, alloc=True,
+                     max_block_bytes=None):
+    '''
+    sgl = SGL(mocked_nvme_device.mem_mgr, 4096, 4096, DMADirection.HOST_TO_DEVICE, 'test',
+              alloc=False)
+    assert sgl.blocks_needed == 1
+    assert sgl.descs_per_segment == 256
+
+    sgl = SGL(mocked_nvme_device.mem_mgr, 10 * 4096, 4096, DMADirection.HOST_TO_DEVICE, 'test',
+              alloc=False, max_block_bytes=4096)
+    assert sgl.blocks_needed == 10
+
+    with pytest.raises(AssertionError):
+        SGL(mocked_nvme_device.mem_mgr, 0, 4096, DMADirection.HOST_TO_DEVICE, 'test')
+
+
+def test_alloc(mocked_nvme_device):
+    ''' def alloc(self):
+    '''
+    # A single data block
+    sgl = SGL(mocked_nvme_device.mem_mgr, 1024 * 1024, 4096, DMADirection.HOST_TO_DEVICE, 'test')
+    assert len(sgl.mem_list) == 1
+    assert sgl.sgl1.TYPE == SGLDescriptor.DATA_BLOCK
+    assert sgl.sgl1.ADDR == sgl.data_mems[0].iova
+    assert sgl.sgl1.LEN == 1024 * 1024
+
+    # Data blocks in one last segment
+    sgl = SGL(mocked_nvme_device.mem_mgr, (3 * 4096) + 1, 4096, DMADirection.HOST_TO_DEVICE,
+              'test', max_block_bytes=4096)
+    assert len(sgl.data_mems) == 4
+    assert len(sgl.segment_mems) == 1
+    assert sgl.sgl1.TYPE == SGLDescriptor.LAST_SEGMENT
+    assert sgl.sgl1.ADDR == sgl.segment_mems[0].iova
+    assert sgl.sgl1.LEN == 4 * 16
+    descs = (SGLDescriptor * 4).from_address(sgl.segment_mems[0].vaddr)
+    assert [d.TYPE for d in descs] == [SGLDescriptor.DATA_BLOCK] * 4
+    assert [d.LEN for d in descs] == [4096, 4096, 4096, 1]
+    assert [d.ADDR for d in descs] == [m.iova for m in sgl.data_mems]
+
+    # More data blocks than fit in a segment, segments are chained
+    sgl = SGL(mocked_nvme_device.mem_mgr, 600 * 512, 4096, DMADirection.DEVICE_TO_HOST,
+              'test', max_block_bytes=512)
+    assert len(sgl.data_mems) == 600
+    assert len(sgl.segment_mems) == 3
+    assert sgl.sgl1.TYPE == SGLDescriptor.SEGMENT
+    assert sgl.sgl1.LEN == 256 * 16
+    first = (SGLDescriptor * 256).from_address(sgl.segment_mems[0].vaddr)
+    second = (SGLDescriptor * 256).from_address(sgl.segment_mems[1].vaddr)
+    assert first[255].TYPE == SGLDescriptor.SEGMENT
+    assert first[255].ADDR == sgl.segment_mems[1].iova
+    assert second[255].TYPE == SGLDescriptor.LAST_SEGMENT
+    assert second[255].ADDR == sgl.segment_mems[2].iova
+    assert second[255].LEN == (600 - 255 - 255) * 16
+
+
+def test_from_address(mocked_nvme_device):
+    ''' def from_address(self, sgl1):
+    '''
+    # Single data block
+    sgl = SGL(mocked_nvme_device.mem_mgr, 8192, 4096, DMADirection.HOST_TO_DEVICE, 'test')
+    sgl.set_data_buffer(bytes(range(256)) * 32)
+    new_sgl = SGL(None, 8192, 4096, None, 'test', alloc=False).from_address(sgl.sgl1)
+    assert len(new_sgl.data_mems) == 1
+    assert new_sgl.get_data_buffer() == sgl.get_data_buffer()
+
+    # Chained segments
+    sgl = SGL(mocked_nvme_device.mem_mgr, 600 * 512, 4096, DMADirection.HOST_TO_DEVICE,
+              'test', max_block_bytes=512)
+    sgl.set_data_buffer(bytes(range(256)) * 1200)
+    new_sgl = SGL(None, 600 * 512, 4096, None, 'test', alloc=False).from_address(sgl.sgl1)
+    assert len(new_sgl.segment_mems) == 3
+    assert [m.vaddr for m in new_sgl.data_mems] == [m.vaddr for m in sgl.data_mems]
+    assert new_sgl.get_data_buffer() == sgl.get_data_buffer()
+
+    # Not enough data for num_bytes
+    with pytest.raises(AssertionError):
+        SGL(None, 600 * 513, 4096, None, 'test', alloc=False).from_address(sgl.sgl1)
+
+    # Segment descriptor that is not the last in its segment
+    segment = (SGLDescriptor * 256).from_address(sgl.segment_mems[0].vaddr)
+    segment[0].TYPE = SGLDescriptor.SEGMENT
+    with pytest.raises(AssertionError):
+        SGL(None, 600 * 512, 4096, None, 'test', alloc=False).from_address(sgl.sgl1)
+
+    # Non data block descriptor in the last segment
+    sgl = SGL(mocked_nvme_device.mem_mgr, 2 * 512, 4096, DMADirection.HOST_TO_DEVICE,
+              'test', max_block_bytes=512)
+    segment = (SGLDescriptor * 2).from_address(sgl.segment_mems[0].vaddr)
+    segment[1].TYPE = SGLDescriptor.SEGMENT
+    with pytest.raises(AssertionError):
+        SGL(None, 2 * 512, 4096, None, 'test', alloc=False).from_address(sgl.sgl1)
+
+    # Invalid segment length
+    sgl.sgl1.LEN = 17
+    with pytest.raises(AssertionError):
+        SGL(None, 2 * 512, 4096, None, 'test', alloc=False).from_address(sgl.sgl1)
+
+    # Unsupported descriptor type
+    sgl.sgl1.TYPE = SGLDescriptor.BIT_BUCKET
+    with pytest.raises(AssertionError):
+        SGL(None, 2 * 512, 4096, None, 'test', alloc=False).from_address(sgl.sgl1)
+
+
+def test_str(mocked_nvme_device):
+    ''' def __str__(self):
+    '''
+    sgl = SGL(mocked_nvme_device.mem_mgr, 2 * 4096, 4096, DMADirection.HOST_TO_DEVICE, 'test',
+              max_block_bytes=4096)
+    string = str(sgl)
+    assert string.startswith('SGL1: type 3 addr 0x{:016x} len 32'.format(
+        sgl.segment_mems[0].iova))
+    assert len(string.split('\n')) == 3
+
+
+def test_free_all_memory(mocked_nvme_device):
+    ''' def free_all_memory(self):
+    '''
+    freed = []
+    mocked_nvme_device.mem_mgr.free = freed.append
+    sgl = SGL(mocked_nvme_device.mem_mgr, 2 * 4096, 4096, DMADirection.HOST_TO_DEVICE, 'test',
+              max_block_bytes=4096)
+    mem_list = list(sgl.mem_list)
+    sgl.free_all_memory()
+    assert freed == mem_list
+    assert sgl.mem_list == []
+    assert sgl.get_data_segments() == []
+
+
+def test_get_data_views(mocked_nvme_device):
+    ''' def get_data_views(self):
+    '''
+    sgl = SGL(mocked_nvme_device.mem_mgr, 4096 + 100, 4096, DMADirection.HOST_TO_DEVICE, 'test',
+              max_block_bytes=4096)
+    views = sgl.get_data_views()
+    assert [len(v) for v in views] == [4096, 100]
+
+    views[1][:] = bytes([0xAA] * 100)
+    assert sgl.get_data_buffer()[4096:] == bytes([0xAA] * 100)
+
+
+def test_get_data_view(mocked_nvme_device):
+    ''' def get_data_view(self):
+    '''
+    sgl = SGL(mocked_nvme_device.mem_mgr, 3 * 4096, 4096, DMADirection.HOST_TO_DEVICE, 'test')
+    view = sgl.get_data_view()
+    assert len(view) == 3 * 4096
+    view[:] = bytes([0x55] * 3 * 4096)
+    assert sgl.get_data_buffer() == bytes([0x55] * 3 * 4096)
+
+    # Not contiguous
+    sgl = SGL(mocked_nvme_device.mem_mgr, 3 * 4096, 4096, DMADirection.HOST_TO_DEVICE, 'test',
+              max_block_bytes=4096)
+    assert sgl.get_data_view() is None
+
+    # Contiguous blocks
+    sgl.data_mems[1].vaddr = sgl.data_mems[0].vaddr + 4096
+    sgl.data_mems[2].vaddr = sgl.data_mems[0].vaddr + 8192
+    assert sgl.get_data_view() is not None
+
+    # No memory
+    sgl = SGL(mocked_nvme_device.mem_mgr, 4096, 4096, DMADirection.HOST_TO_DEVICE, 'test',
+              alloc=False)
+    assert sgl.get_data_view() is None
+
+
+def test_set_data_buffer(mocked_nvme_device):
+    ''' def set_data_buffer(self, data):
+    '''
+    sgl = SGL(mocked_nvme_device.mem_mgr, 3 * 4096, 4096, DMADirection.HOST_TO_DEVICE, 'test',
+              max_block_bytes=4096)
+
+    # Less data than the SGL holds
+    sgl.set_data_buffer(bytes([0xFF] * 5000))
+    data = sgl.get_data_buffer()
+    assert data[:5000] == bytes([0xFF] * 5000)
+    assert data[5000:] == bytes(3 * 4096 - 5000)
+
+    # Structures work too
+    data = (ctypes.c_uint8 * (3 * 4096))(*([0x11] * 3 * 4096))
+    sgl.set_data_buffer(data)
+    assert sgl.get_data_buffer() == bytes(data)
@@ -0,0 +1,122 @@
+import pytest
+import ctypes
+
+from lone.nvme.spec.registers.snapshot import RegsSnapshot, RegsChange, regs_layout
+from lone.nvme.spec.registers.nvme_regs import (NVMeRegistersDirect,
+                                                nvme_reg_struct_factory,
+                                                NVMeAccessData)
+from lone.nvme.spec.registers.pcie_regs import (PCIeRegistersDirect,
+                                                pcie_reg_struct_factory,
+                                                PCIeRegisters,
+                                                PCIeAccessData)
+from lone.nvme.spec.registers import RegsStructAccess
+
+
+def test_regs_layout():
+    ''' def regs_layout(regs_type):
+    '''
+    offsets, registers = regs_layout(NVMeRegistersDirect)
+    assert offsets == sorted(offsets)
+    assert registers[0] == ('CAP', 0, 8, NVMeRegistersDirect.Cap._field_table_)
+    assert ('RSVD_0', 0x18, 4, None) in registers
+    assert ('RSVD_1[0]', 0x6C, 4, None) in registers
+    assert registers[-1] == ('SQNDBS[1023]', 0x1000 + 1023 * 8, 8,
+                             NVMeRegistersDirect.Sqndbs._field_table_)
+
+    # Every byte is in one register
+    assert sum(register[2] for register in registers) == ctypes.sizeof(NVMeRegistersDirect)
+
+    offsets, registers = regs_layout(PCIeRegistersDirect)
+    assert ('CAPS.DATA[0]', 0x40, 1, None) in registers
+    assert sum(register[2] for register in registers) == ctypes.sizeof(PCIeRegistersDirect)
+
+    # Registers from structures without a field table yet
+    class Reg(RegsStructAccess):
+        _pack_ = 1
+        _fields_ = [('LOW', ctypes.c_uint8, 4), ('HIGH', ctypes.c_uint8, 4)]
+
+    class Regs(ctypes.Structure):
+        _pack_ = 1
+        _fields_ = [('REG', Reg), ('DATA', ctypes.c_uint8 * 2)]
+
+    assert regs_layout(Regs)[1] == [('REG', 0, 1, {'LOW': (0, 0xF), 'HIGH': (4, 0xF)}),
+                                    ('DATA[0]', 1, 1, None),
+                                    ('DATA[1]', 2, 1, None)]
+
+
+def test_regs_snapshot():
+    ''' class RegsSnapshot:
+    '''
+    regs = NVMeRegistersDirect()
+    before = regs.snapshot()
+    assert before.regs_type is NVMeRegistersDirect
+    assert len(before.data) == ctypes.sizeof(NVMeRegistersDirect)
+    assert before.diff(regs.snapshot()) == []
+
+    regs.CC.EN = 1
+    regs.CC.IOSQES = 6
+    regs.AQA.ACQS = 15
+    regs.RSVD_1[1] = 0x12345678
+    regs.SQNDBS[3].SQTAIL = 5
+    regs.SQNDBS[4].SQTAIL = 1
+    regs.SQNDBS[4].CQHEAD = 2
+    after = regs.snapshot()
+    assert after.time_ns >= before.time_ns
+
+    assert before.diff(after) == [
+        RegsChange('CC', 0x14, 0, 0x60001, {'EN': (0, 1), 'IOSQES': (0, 6)}),
+        RegsChange('AQA', 0x24, 0, 15 << 16, {'ACQS': (0, 15)}),
+        RegsChange('RSVD_1[1]', 0x70, 0, 0x12345678, {}),
+        RegsChange('SQNDBS[3]', 0x1018, 0, 5, {'SQTAIL': (0, 5)}),
+        RegsChange('SQNDBS[4]', 0x1020, 0, (2 << 32) | 1, {'SQTAIL': (0, 1), 'CQHEAD': (0, 2)}),
+    ]
+    assert after.diff(before)[0] == RegsChange('CC', 0x14, 0x60001, 0,
+                                               {'EN': (1, 0), 'IOSQES': (6, 0)})
+
+    # The registers in the snapshot do not change with the real ones
+    regs.CC.EN = 0
+    assert after.regs().CC.EN == 1
+    assert type(after.regs()) is NVMeRegistersDirect
+
+    # Only snapshots of the same registers can be compared
+    with pytest.raises(AssertionError):
+        before.diff(PCIeRegistersDirect().snapshot())
+    with pytest.raises(AssertionError):
+        RegsSnapshot(NVMeRegistersDirect, b'')
+
+
+def test_regs_snapshot_indirect():
+    ''' def snapshot(self):
+    '''
+    nvme_data = bytearray(ctypes.sizeof(NVMeRegistersDirect))
+    pcie_data = bytearray(ctypes.sizeof(PCIeRegistersDirect))
+    accesses = []
+
+    def nvme_read(offset, size):
+        accesses.append(('nvme', offset, size))
+        return nvme_data[offset:offset + size]
+
+    def pcie_read(offset, size):
+        accesses.append(('pcie', offset, size))
+        return pcie_data[offset:offset + size]
+
+    nvme_regs = nvme_reg_struct_factory(NVMeAccessData(nvme_read, None, None, None))()
+
+    class Registers(pcie_reg_struct_factory(PCIeAccessData(pcie_read, None, None, None)),
+                    PCIeRegisters):
+        direct = False
+    pcie_regs = Registers()
+
+    # Each snapshot is one read of all registers
+    nvme_before = nvme_regs.snapshot()
+    pcie_before = pcie_regs.snapshot()
+    assert accesses == [('nvme', 0, ctypes.sizeof(NVMeRegistersDirect)),
+                        ('pcie', 0, ctypes.sizeof(PCIeRegistersDirect))]
+
+    nvme_data[0x1C] = 1
+    pcie_data[4] = 4
+    assert nvme_before.diff(nvme_regs.snapshot()) == [
+        RegsChange('CSTS', 0x1C, 0, 1, {'RDY': (0, 1)})]
+    assert pcie_before.diff(pcie_regs.snapshot()) == [
+        RegsChange('CMD', 0x04, 0, 4, {'BME': (0, 1)})]
+    assert pcie_before.regs_type is PCIeRegistersDirect
@@ -1,6 +1,10 @@
 import pytest
 import ctypes
+import threading
 from lone.nvme.spec.structures import SQECommon, DataOutCommon, DataInCommon, CQE, DataDumper
+from lone.nvme.spec.structures import CommandPool
+from lone.nvme.spec.commands.nvm.read import Read
+from lone.nvme.spec.commands.admin.identify import IdentifyController
 
 
 def test_sqe_common(mocked_nvme_device):
@@ -50,6 +54,105 @@ def test_sqe_common(mocked_nvme_device):
     sqe.free_prps()
     mocked_nvme_device.alloc(sqe)
     sqe.free_prps()
+    assert sqe.prp is None
+
+    # PRPs from a pool go back to it
+    mocked_nvme_device.enable_prp_pool()
+    mocked_nvme_device.alloc(sqe)
+    prp = sqe.prp
+    sqe.free_prps()
+    assert mocked_nvme_device.prp_pool.num_prps == 1
+    mocked_nvme_device.alloc(sqe)
+    assert sqe.prp is prp
+
+
+def test_command_pool():
+    pool = CommandPool(Read, 4, NSID=1)
+    assert pool.num_free() == 4
+    assert pool.num_created == 4
+
+    # Commands come out with the template's values plus the ones passed in
+    read = pool.get(SLBA=10, NLB=7)
+    assert type(read) is Read
+    assert read.pool is pool
+    assert read.OPC == 0x02
+    assert read.NSID == 1
+    assert read.SLBA == 10
+    assert read.NLB == 7
+    assert pool.num_free() == 3
+
+    # Can't return a posted command, or one from another pool
+    read.posted = True
+    with pytest.raises(AssertionError):
+        pool.put(read)
+    with pytest.raises(AssertionError):
+        CommandPool(Read, 0).put(read)
+
+    # Use it, return it, and get it back reset
+    read.CID = 5
+    read.DPTR.PRP.PRP1 = 0x1000
+    read.complete = True
+    read.posted = False
+    read.context = 'context'
+    read.callback = print
+    read.start_time_ns = 1
+    pool.put(read)
+    assert pool.num_free() == 4
+    read = pool.get()
+    assert read.SLBA == 0
+    assert read.NSID == 1
+    assert read.CID == 0
+    assert read.DPTR.PRP.PRP1 == 0
+    assert read.complete is False
+    assert read.context is None
+    assert read.callback is None
+    assert read.start_time_ns == 0
+
+    # Pool grows when empty
+    commands = [pool.get() for i in range(4)]
+    assert pool.num_free() == 0
+    assert pool.num_created == 5
+    for command in commands:
+        pool.put(command)
+
+    # Commands can only be put back once
+    with pytest.raises(AssertionError, match='already in the pool'):
+        pool.put(commands[0])
+
+    # Threads getting and putting at the same time
+    def get_put():
+        for i in range(1000):
+            pool.put(pool.get())
+    threads = [threading.Thread(target=get_put) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert pool.num_free() == pool.num_created - 1
+    assert len(set(map(id, pool.free_commands))) == pool.num_free()
+
+
+def test_command_pool_reset(mocked_nvme_device):
+    pool = CommandPool(IdentifyController, 1)
+
+    # PRPs are freed when the command goes back to the pool
+    command = pool.get()
+    mocked_nvme_device.enable_prp_pool()
+    mocked_nvme_device.alloc(command)
+    prp = command.prp
+    command.data_in.VID = 0x1234
+    command.cqe.SF.SC = 5
+    pool.put(command)
+    assert command.prp is None
+    assert mocked_nvme_device.prp_pool.num_prps == 1
+
+    # Data and completion do not carry over
+    command = pool.get()
+    assert command.data_in is not None and command.data_in.VID == 0
+    assert command.data_out is None
+    assert command.cqe.SF.SC == 0
+    mocked_nvme_device.alloc(command)
+    assert command.prp is prp
 
 
 def test_dump():
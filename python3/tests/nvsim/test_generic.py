@@ -0,0 +1,121 @@
+import logging
+
+from nvsim.simulators.generic import GenericNVMeNVSim
+
+
+def test_reg_offset():
+    ''' def reg_offset(regs_address, register, name):
+    '''
+    sim = GenericNVMeNVSim()
+    regs, address = sim.nvme_regs, sim.nvme_regs_address
+
+    # Fields are at the offset of the bytes they are in, registers at their own
+    assert sim.reg_offset(address, regs.CC, 'EN') == 0x14
+    assert sim.reg_offset(address, regs, 'CC') == 0x14
+    assert sim.reg_offset(address, regs.SQNDBS[2], 'SQTAIL') == 0x1010
+    assert sim.reg_offset(address, regs.SQNDBS[2], 'CQHEAD') == 0x1014
+
+
+def test_nvme_reg_written(mocker):
+    ''' def nvme_reg_written(self, register, name):
+    '''
+    sim = GenericNVMeNVSim()
+    nvme_changed = mocker.patch.object(sim.thread, 'nvme_changed')
+    sim.nvme_regs_written.clear()
+
+    # Registers we act on are queued in the order they are written, with CC.EN as written
+    sim.nvme_regs.CC.EN = 1
+    sim.nvme_regs.AQA.ASQS = 3
+    sim.nvme_regs.CC.EN = 0
+    sim.nvme_regs.SQNDBS[1].SQTAIL = 1
+    assert list(sim.nvme_regs_written) == [('CC', 1), ('AQA', None), ('CC', 0), ('DB', None)]
+    assert nvme_changed.call_count == 4
+
+    # Anything else does not wake up the simulator thread
+    sim.nvme_regs.INTMS.IVMS = 1
+    sim.nvme_regs.CSTS.RDY = 0
+    assert len(sim.nvme_regs_written) == 4
+    assert nvme_changed.call_count == 4
+
+
+def test_nvsim_nvme_regs_changed(mocker, caplog):
+    ''' def nvsim_nvme_regs_changed(self):
+    '''
+    sim = GenericNVMeNVSim()
+    mocker.patch.object(sim.thread, 'nvme_changed')
+    calls = []
+    sim.enable = lambda: calls.append('enable')
+    sim.disable = lambda: calls.append('disable')
+    sim.check_commands = lambda: calls.append('check_commands')
+
+    # Enable and disable are both seen, even if both writes are handled at once
+    sim.nvme_regs_written.clear()
+    sim.nvme_regs.CC.EN = 1
+    sim.nvme_regs.CC.EN = 0
+    sim.nvsim_nvme_regs_changed()
+    assert calls == ['enable', 'disable']
+    assert sim.cc_en == 0
+    assert len(sim.nvme_regs_written) == 0
+
+    # Admin queue registers written while enabled are ignored, with a warning
+    calls.clear()
+    sim.nvme_regs.AQA.ASQS = 3
+    sim.nvme_regs.CC.EN = 1
+    with caplog.at_level(logging.WARNING):
+        sim.nvme_regs.ASQ.ASQB = 0x1000
+        sim.nvme_regs.ACQ.ACQB = 0x2000
+        sim.nvsim_nvme_regs_changed()
+    assert calls == ['enable']
+    assert [r.getMessage() for r in caplog.records] == [
+        'ASQ written while enabled, ignored until the next enable',
+        'ACQ written while enabled, ignored until the next enable']
+
+    # Doorbells only check for commands once ready
+    calls.clear()
+    sim.nvme_regs.SQNDBS[0].SQTAIL = 1
+    sim.nvsim_nvme_regs_changed()
+    assert calls == []
+
+    sim.nvme_regs.CSTS.RDY = 1
+    sim.nvme_regs.SQNDBS[0].SQTAIL = 2
+    sim.nvme_regs.SQNDBS[0].SQTAIL = 3
+    sim.nvsim_nvme_regs_changed()
+    assert calls == ['check_commands']
+
+
+def test_pcie_reg_written(mocker):
+    ''' def pcie_reg_written(self, register, name):
+    '''
+    sim = GenericNVMeNVSim()
+    pcie_changed = mocker.patch.object(sim.thread, 'pcie_changed')
+    express = sim.pcie_regs.get_capability(sim.pcie_regs.PCICapExpress._cap_id_)
+
+    # Only PXDC writes wake up the simulator thread
+    sim.pcie_regs.CMD.BME = 1
+    express.PXDS.CED = 1
+    assert pcie_changed.call_count == 0
+
+    express.PXDC.IFLR = 1
+    assert pcie_changed.call_count == 1
+
+
+def test_nvsim_pcie_regs_changed(mocker):
+    ''' def nvsim_pcie_regs_changed(self):
+    '''
+    sim = GenericNVMeNVSim()
+    mocker.patch.object(sim.thread, 'pcie_changed')
+    mocker.patch.object(sim.thread, 'nvme_changed')
+    express = sim.pcie_regs.get_capability(sim.pcie_regs.PCICapExpress._cap_id_)
+
+    # PXDC written without IFLR, nothing happens
+    config = sim.config
+    sim.cc_en = 1
+    sim.nvsim_pcie_regs_changed()
+    assert sim.config is config
+
+    # FLR makes a new config, resetting registers
+    sim.nvme_regs.CC.EN = 1
+    express.PXDC.IFLR = 1
+    sim.nvsim_pcie_regs_changed()
+    assert sim.config is not config
+    assert sim.cc_en == sim.nvme_regs.CC.EN
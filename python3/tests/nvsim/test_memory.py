@@ -0,0 +1,58 @@
+import os
+import ctypes
+
+from nvsim.memory import SimMemMgr
+from lone.system import DMADirection
+
+
+def test_sim_mem_mgr():
+    ''' class SimMemMgr(DevMemMgr):
+    '''
+    mem_mgr = SimMemMgr(4096, arena_size=4 * 4096)
+    assert mem_mgr.fork_shared is True
+
+    # Allocations are carved out of one arena, vaddr == iova
+    mem_a = mem_mgr.malloc(100, DMADirection.HOST_TO_DEVICE)
+    mem_b = mem_mgr.malloc(4096, DMADirection.DEVICE_TO_HOST, client='b')
+    assert len(mem_mgr.arenas) == 1
+    assert mem_a.vaddr % 4096 == 0 and mem_b.vaddr % 4096 == 0
+    assert mem_a.vaddr == mem_a.iova
+    assert mem_mgr.allocated_mem_list() == [mem_a, mem_b]
+
+    # Freed memory is zeroed and reused
+    ctypes.memset(mem_a.vaddr, 0xFF, mem_a.size)
+    mem_mgr.free(mem_a)
+    mem_mgr.free(mem_a)
+    mem_c = mem_mgr.malloc(4096, DMADirection.HOST_TO_DEVICE)
+    assert mem_c.vaddr == mem_a.vaddr
+    assert bytes((ctypes.c_uint8 * 100).from_address(mem_c.vaddr)) == bytes(100)
+
+    # A new arena is only added when the ones we have are full, large enough for the
+    #   allocation
+    mem_mgr.malloc(2 * 4096, DMADirection.HOST_TO_DEVICE)
+    assert len(mem_mgr.arenas) == 1
+    mem_d = mem_mgr.malloc(8 * 4096, DMADirection.HOST_TO_DEVICE)
+    assert len(mem_mgr.arenas) == 2
+    assert len(mem_mgr.arenas[1][0]) == 8 * 4096
+
+    pages = mem_mgr.malloc_pages(2, client='pages')
+    assert [page.size for page in pages] == [4096, 4096]
+
+    mem_mgr.free(mem_d)
+    mem_mgr.free_all()
+    assert mem_mgr.allocated_mem_list() == []
+
+
+def test_sim_mem_mgr_fork():
+    ''' Memory is shared with forked processes
+    '''
+    mem_mgr = SimMemMgr(4096)
+    mem = mem_mgr.malloc(4096, DMADirection.BIDIRECTIONAL)
+
+    pid = os.fork()
+    if pid == 0:
+        ctypes.c_uint32.from_address(mem.vaddr).value = 0x12345678
+        os._exit(0)
+    os.waitpid(pid, 0)
+
+    assert ctypes.c_uint32.from_address(mem.vaddr).value == 0x12345678
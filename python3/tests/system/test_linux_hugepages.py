@@ -1,15 +1,13 @@
 import pytest
-from types import SimpleNamespace
 
-
-from lone.system.linux.hugepages_mgr import HugePagesMemoryMgr
+from lone.system.linux.hugepages_mgr import HugePagesMemoryMgr, HugePagesIovaMgr
 from lone.system import DMADirection
 
 
 @pytest.fixture(scope='function')
 def mocked_hugepages(mocker):
     mocker.patch('hugepages.init', return_value=None)
-    mocker.patch('hugepages.malloc', side_effect=range(0x1000, 0x10000000, 2 * 1024 * 1024))
+    mocker.patch('hugepages.malloc', side_effect=range(0x10000000, 0x1000000000, 0x10000000))
     mocker.patch('hugepages.get_size', return_value=2 * 1024 * 1024)
     mocker.patch('hugepages.free', return_value=None)
     mocker.patch('ctypes.memset', return_value=None)
@@ -22,7 +20,7 @@ def test_hugepages_memory_mgr(mocked_hugepages):
                                     lambda x, y: None,
                                     [(0, 0xFFFFFFFF)])
 
-    assert len(hp_mem_mgr.free_pages()) != 0
+    assert hp_mem_mgr.num_free_pages() == 512
     assert hp_mem_mgr.allocated_mem_list() is not None
 
     # Test malloc
@@ -43,6 +41,11 @@ def test_hugepages_memory_mgr(mocked_hugepages):
     with pytest.raises(AssertionError):
         hp_mem_mgr.malloc(100 * 4096, DMADirection.BIDIRECTIONAL)
 
+    # Allocations larger than a hugepage get a single iova
+    mem = hp_mem_mgr.malloc(4 * 1024 * 1024, DMADirection.DEVICE_TO_HOST)
+    assert mem.size == 4 * 1024 * 1024
+    assert hp_mem_mgr.iova_mgr.allocated[mem.iova] == mem.size
+
 
 def test_hugepages_alloc(mocked_hugepages):
     hp_mem_mgr = HugePagesMemoryMgr(4096,
@@ -50,27 +53,131 @@ def test_hugepages_alloc(mocked_hugepages):
                                     lambda x, y, z: None,
                                     lambda x, y: None,
                                     [(0, 0xFFFFFFFF)])
-
-    def test(num):
-        return None
-    hp_mem_mgr._malloc_hps = test
-    free_pages = []
-    for page in range(10):
-        free_pages.append(SimpleNamespace(vaddr=1000, size=4096, in_use=True))
-    for page in range(10):
-        free_pages.append(SimpleNamespace(vaddr=1000, size=4096, in_use=False))
-    hp_mem_mgr.free_pages = lambda: free_pages
+    arena = list(hp_mem_mgr.arenas.keys())[0]
+    assert hp_mem_mgr.arenas[arena] == 9
+
+    # Allocations are contiguous blocks, split from the arena
+    mem_1 = hp_mem_mgr.malloc(4096, DMADirection.HOST_TO_DEVICE)
+    mem_2 = hp_mem_mgr.malloc(4096, DMADirection.HOST_TO_DEVICE)
+    mem_3 = hp_mem_mgr.malloc(3 * 4096, DMADirection.HOST_TO_DEVICE)
+    assert mem_1.vaddr == arena
+    assert mem_2.vaddr == arena + 4096
+    assert mem_3.vaddr == arena + (4 * 4096)
+    assert mem_3.size == 3 * 4096
+    assert hp_mem_mgr.num_free_pages() == 512 - 6
+
+    # Sizes that are not a multiple of the page size round up
+    mem_4 = hp_mem_mgr.malloc(4097, DMADirection.HOST_TO_DEVICE)
+    assert hp_mem_mgr.allocated_blocks[mem_4.vaddr] == (arena, 1)
+
+    # Freeing merges buddies back together
+    for mem in [mem_2, mem_4, mem_1, mem_3]:
+        hp_mem_mgr.free(mem)
+    assert hp_mem_mgr.num_free_pages() == 512
+    assert hp_mem_mgr.free_blocks[9] == {arena: arena}
+    assert len(hp_mem_mgr.allocated_blocks) == 0
+
+    # No room left in the arena, a new one is allocated
+    mem = hp_mem_mgr.malloc(2 * 1024 * 1024, DMADirection.HOST_TO_DEVICE)
+    assert mem.vaddr == arena
+    mem = hp_mem_mgr.malloc(2 * 1024 * 1024, DMADirection.HOST_TO_DEVICE)
+    assert mem.vaddr != arena
+    assert len(hp_mem_mgr.arenas) == 2
+    assert hp_mem_mgr.num_free_pages() == 0
+
+    # Not able to get memory after allocating more hugepages
+    hp_mem_mgr._malloc_hps = lambda num_hps: None
     with pytest.raises(MemoryError):
-        hp_mem_mgr.malloc(10 * 4096, DMADirection.HOST_TO_DEVICE)
+        hp_mem_mgr.malloc(4096, DMADirection.HOST_TO_DEVICE)
+    del hp_mem_mgr._malloc_hps
+
+    # Areas are a power of 2 hugepages
+    hp_mem_mgr._malloc_hps(3)
+    assert hp_mem_mgr.arenas[max(hp_mem_mgr.arenas.keys())] == 11
+    assert hp_mem_mgr.num_free_pages() == 2048
 
     # Test malloc_pages
-    free_pages = []
-    for page in range(10):
-        free_pages.append(SimpleNamespace(vaddr=1000, size=4096, in_use=True))
-    hp_mem_mgr.free_pages = lambda: free_pages
-    hp_mem_mgr.malloc_pages(1)
+    pages = hp_mem_mgr.malloc_pages(10)
+    assert len(pages) == 10
+    assert all(page.in_use for page in pages)
+    assert hp_mem_mgr.num_free_pages() == 2048 - 10
+
+    hp_mem_mgr = HugePagesMemoryMgr(4096,
+                                    lambda x, y, z: None,
+                                    lambda x, y, z: None,
+                                    lambda x, y: None,
+                                    [(0, 0xFFFFFFFF)])
+    pages = hp_mem_mgr.malloc_pages(513)
+    assert len(pages) == 513
+    assert len(hp_mem_mgr.arenas) == 2
+
+
+def test_hugepages_premap(mocked_hugepages):
+    maps = []
+    unmaps = []
+    hp_mem_mgr = HugePagesMemoryMgr(4096,
+                                    lambda x, y, z: pytest.fail('mapped on malloc'),
+                                    lambda x, y, z: pytest.fail('mapped on malloc'),
+                                    lambda x, y: unmaps.append((x, y)),
+                                    [(0, 0xFFFFFFFF)],
+                                    lambda x, y, z: maps.append((x, y, z)))
+    arena = list(hp_mem_mgr.arenas.keys())[0]
+
+    # The arena is mapped once, aligned to the hugepage size
+    assert maps == [(arena, 0x200000, 0x200000)]
+
+    # Memory iovas are relative to the arena, no mapping on malloc or free
+    mem_1 = hp_mem_mgr.malloc(4096, DMADirection.HOST_TO_DEVICE)
+    mem_2 = hp_mem_mgr.malloc(8192, DMADirection.BIDIRECTIONAL)
+    assert mem_1.iova == 0x200000
+    assert mem_2.iova == 0x202000
+    assert mem_2.iova_mapped is True
+    assert mem_2.iova_direction == DMADirection.BIDIRECTIONAL
+    hp_mem_mgr.free(mem_2)
+    assert mem_2.iova_mapped is False
+    assert hp_mem_mgr.iova_mgr.num_allocated_iovas() == 1
+
+    # Direction is still checked
     with pytest.raises(AssertionError):
-        hp_mem_mgr.malloc_pages(11)
+        hp_mem_mgr.malloc(4096, None)
+
+    # New arenas get mapped when allocated
+    mem_3 = hp_mem_mgr.malloc(4 * 1024 * 1024, DMADirection.DEVICE_TO_HOST)
+    assert len(maps) == 2
+    assert mem_3.iova == maps[1][1]
+
+    # Arenas unmapped on free_all
+    hp_mem_mgr.free_all()
+    assert unmaps == [(0x200000, 0x200000), (maps[1][1], 4 * 1024 * 1024)]
+    assert hp_mem_mgr.iova_mgr.num_allocated_iovas() == 0
+    assert hp_mem_mgr.arena_iovas == {}
+
+
+def test_hugepages_stats(mocked_hugepages):
+    hp_mem_mgr = HugePagesMemoryMgr(4096,
+                                    lambda x, y, z: None,
+                                    lambda x, y, z: None,
+                                    lambda x, y: None,
+                                    [(0, 0xFFFFFFFF)])
+    stats = hp_mem_mgr.stats()
+    assert stats['total_pages'] == 512
+    assert stats['free_pages'] == 512
+    assert stats['largest_free_pages'] == 512
+    assert stats['fragmentation'] == 0
+
+    # Leave a hole at the start of the arena
+    mems = [hp_mem_mgr.malloc(4096, DMADirection.HOST_TO_DEVICE) for i in range(2)]
+    hp_mem_mgr.free(mems[0])
+    stats = hp_mem_mgr.stats()
+    assert stats['used_pages'] == 1
+    assert stats['requested_bytes'] == 4096
+    assert stats['largest_free_pages'] == 256
+    assert stats['free_blocks_per_order'] == [1, 1, 1, 1, 1, 1, 1, 1, 1, 0]
+    assert stats['fragmentation'] == 1 - (256 / 511)
+
+    # Nothing free
+    hp_mem_mgr.free_blocks = []
+    assert hp_mem_mgr.stats()['fragmentation'] == 0
 
 
 def test_hugepages_free(mocked_hugepages):
@@ -118,6 +225,12 @@ def test_hugepages_iova_mgr(mocked_hugepages):
     hp_mem_mgr.iova_mgr.free(0x1000)
     assert hp_mem_mgr.iova_mgr.num_allocated_iovas() == 0
 
+    # Ranges too small for the alignment are skipped, and no valid range asserts
+    iova_mgr = HugePagesIovaMgr([(0x1001, 0x1FFF), (0x2000, 0x2FFF)])
+    assert iova_mgr.free_starts == [0x2000]
+    with pytest.raises(AssertionError):
+        HugePagesIovaMgr([(0x1001, 0x1FFF)])
+
 
 def test_hugepages_malloc_failure(mocker, mocked_hugepages):
     mocker.patch('hugepages.malloc', return_value=0)
@@ -1,3 +1,4 @@
+import os
 import pytest
 import subprocess
 import ctypes
@@ -66,6 +67,34 @@ def test_enable_msix(mocker):
     ifc.enable_msix(1, 0)
 
 
+def test_wait_msix_vectors(mocker):
+    mocker.patch('fcntl.ioctl', return_value=0)
+    ifc = SysVfioIfc('test', init=False)
+    ifc.device_fd = 1
+
+    # MSI-X has to be enabled first
+    with pytest.raises(AssertionError, match='MSI-X not enabled'):
+        ifc.wait_msix_vectors(0)
+
+    ifc.enable_msix(2, 3)
+    ifc.enable_msix(1, 5)
+    assert list(ifc.eventfd_vectors.values()) == [3, 4, 5]
+
+    # Nothing fired
+    assert ifc.wait_msix_vectors(0) == []
+
+    # Vectors that fired are returned once
+    os.eventfd_write(ifc.eventfds[0], 1)
+    os.eventfd_write(ifc.eventfds[2], 2)
+    assert sorted(ifc.wait_msix_vectors()) == [3, 5]
+    assert ifc.wait_msix_vectors(0) == []
+
+    # Fired, but cleared before we got to it
+    os.eventfd_write(ifc.eventfds[1], 1)
+    mocker.patch('os.read', side_effect=BlockingIOError())
+    assert ifc.wait_msix_vectors(0) == []
+
+
 def test_get_msix_vector_pending_count(mocker):
     mocker.patch('os.read', side_effect=[bytes(0), BlockingIOError()])
     ifc = SysVfioIfc('test', init=False)
@@ -78,11 +107,30 @@ def test_get_msix_vector_pending_count(mocker):
 def test_sysvfioifc_pci_regs(mocker):
     ifc = SysVfioIfc('test', init=False)
     ifc.device_fd = 1
-    ifc.pci_region = {'size': 0, 'offset': 0}
+    ifc.pci_region = {'size': 0, 'offset': 0x1000}
     pci_regs = ifc.pci_regs()
 
+    # Classes are made once for each interface
+    assert type(ifc.pci_regs()) is type(pci_regs) is ifc.pci_regs_type
+    assert SysVfioIfc('test', init=False).pci_regs_type is None
+
+    # One pread/pwrite for each register access, at its width
+    config = bytearray(4096)
+    pread = mocker.patch('os.pread', side_effect=lambda fd, size, offset:
+                         bytes(config[offset - 0x1000:offset - 0x1000 + size]))
+    pwrite = mocker.patch('os.pwrite', side_effect=lambda fd, data, offset: len(data))
+
     assert pci_regs.ID.VID == 0x0000
-    pci_regs.ID.VID = 0x1234
+    pread.assert_called_once_with(1, 4, 0x1000)
+
+    pci_regs.CMD.BME = 1
+    assert pread.call_count == 2
+    pwrite.assert_called_once_with(1, bytes([0x04, 0x00]), 0x1004)
+
+    # Bulk read of all of config space
+    config[0:2] = bytes([0x34, 0x12])
+    assert pci_regs.read_config().ID.VID == 0x1234
+    pread.assert_called_with(1, 4096, 0x1000)
 
 
 def test_sysvfioifc_nvme_regs(mocker):
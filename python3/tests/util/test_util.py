@@ -5,6 +5,8 @@ from lone.util.logging import log_init, log_get
 from lone.util.hexdump import hexdump, hexdump_print
 from lone.util.struct_tools import ComparableStruct, StructFieldsIterator
 from lone.util.lba_gen import LBARandGenLFSR
+from lone.util.histogram import LatencyHistogram
+from lone.util.address_mgr import AddressRangeMgr
 
 
 def test_hexdump(mocker):
@@ -118,3 +120,120 @@ def test_lba_gen():
     except StopIteration:
         stopped = True
     assert stopped is True
+
+
+def test_latency_histogram():
+    histogram = LatencyHistogram(sub_bucket_bits=4)
+    assert histogram.percentile(50) is None
+    assert histogram.mean is None
+
+    # Small values have their own bucket
+    for value in range(32):
+        assert histogram.bucket_index(value) == value
+        assert histogram.bucket_range(value) == (value, value)
+
+    # Larger ones share buckets, with a relative error below 1 / 16
+    for value in [32, 33, 100, 1000, 123456789]:
+        low, high = histogram.bucket_range(histogram.bucket_index(value))
+        assert low <= value <= high
+        assert (high - low) / value < 1 / 16
+    assert histogram.bucket_index(32) == histogram.bucket_index(33)
+    assert histogram.bucket_index(31) + 1 == histogram.bucket_index(32)
+
+    with pytest.raises(AssertionError):
+        histogram.record(-1)
+
+    # Percentiles
+    for value in range(1, 10001):
+        histogram.record(value)
+    assert histogram.count == 10000
+    assert histogram.min == 1
+    assert histogram.max == 10000
+    assert histogram.mean == 5000.5
+    for percent in [50, 99, 99.9, 99.99]:
+        expected = 10000 * percent / 100
+        assert abs(histogram.percentile(percent) - expected) / expected < 1 / 16
+    assert histogram.percentile(100) == 10000
+    assert histogram.percentile(0) == 1
+
+    summary = histogram.summary()
+    assert list(summary.keys()) == ['count', 'min', 'max', 'mean', 'p50', 'p99', 'p99.9',
+                                    'p99.99']
+    assert str(histogram).startswith('count: 10000 min: 1 max: 10000')
+
+    # Merging adds counts, including buckets only one side has
+    other = LatencyHistogram(sub_bucket_bits=4)
+    other.merge(histogram)
+    other.record(10 ** 9, count=2)
+    merged = histogram.snapshot()
+    merged.merge(other)
+    assert merged.count == 20002
+    assert merged.max == 10 ** 9
+    assert merged.min == 1
+    assert histogram.count == 10000
+    merged.merge(LatencyHistogram(sub_bucket_bits=4))
+    assert merged.count == 20002
+
+    # Lower minimum from the other side
+    small = LatencyHistogram(sub_bucket_bits=4)
+    small.record(0)
+    small.record(0)
+    merged.merge(small)
+    assert merged.min == 0
+
+    with pytest.raises(AssertionError):
+        merged.merge(LatencyHistogram(sub_bucket_bits=5))
+
+    histogram.reset()
+    assert histogram.count == 0
+    assert histogram.max is None
+
+
+def test_address_range_mgr_alloc():
+    address_mgr = AddressRangeMgr([(0, 0xFFFFFFFF)])
+
+    # Any size, rounded up to the alignment
+    assert address_mgr.get(1) == 0x1000
+    assert address_mgr.get(4 * 1024 * 1024) == 0x2000
+    assert address_mgr.get(4097) == 0x402000
+    assert address_mgr.allocated[0x402000] == 0x2000
+
+    # Alignment leaves the space before the address free
+    assert address_mgr.get(4096, align=0x200000) == 0x600000
+    assert address_mgr.free_ends[0x404000] == 0x600000
+
+    # Smallest interval that fits is used first
+    assert address_mgr.get(4096) == 0x404000
+
+    # Intervals that are large enough but not once aligned are skipped
+    address_mgr = AddressRangeMgr([(0x1000, 0x2FFF), (0x10000, 0x1FFFF)])
+    assert address_mgr.get(4096, align=0x10000) == 0x10000
+
+    # Out of space
+    with pytest.raises(MemoryError):
+        address_mgr.get(0x100000)
+
+
+def test_address_range_mgr_free():
+    address_mgr = AddressRangeMgr([(0x1000, 0x4FFF)])
+    addresses = [address_mgr.get(4096) for i in range(4)]
+    assert addresses == [0x1000, 0x2000, 0x3000, 0x4000]
+    assert len(address_mgr.free_starts) == 0
+
+    # No neighbors free
+    address_mgr.free(0x2000)
+    assert address_mgr.free_ends == {0x2000: 0x3000}
+
+    # Coalesce with the interval before and after
+    address_mgr.free(0x4000)
+    address_mgr.free(0x3000)
+    assert address_mgr.free_ends == {0x2000: 0x5000}
+    address_mgr.free(0x1000)
+    assert address_mgr.free_ends == {0x1000: 0x5000}
+    assert address_mgr.free_sizes == [(0x4000, 0x1000)]
+
+    # All the space can be used at once again
+    assert address_mgr.get(0x4000) == 0x1000
+    address_mgr.reset()
+    assert address_mgr.num_allocated() == 0
+    assert address_mgr.free_starts == [0x1000]